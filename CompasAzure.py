@@ -10,6 +10,10 @@ assert nBinariesPerGridPoint % nBinariesPerTask == 0
 
 nTasksPerGridPoint = nBinariesPerGridPoint/nBinariesPerTask
 
+#how many commands are packed into each job by prepareBundles, and whether the commands in a job run at the same time
+nTasksPerBundle = 1
+runBundlesInParallel = False
+
 gridDictionary = {}
 gridDictionary['--common-envelope-alpha'] = np.linspace(0.1,3.,7)
 gridDictionary['--luminous-blue-variable-multiplier'] = np.linspace(2.,8.,7)
@@ -26,6 +30,25 @@ def prepareCommands():
         
     return commands
 
+def prepareBundles(nTasksPerBundle = nTasksPerBundle):
+    """Packs the commands into bundles of nTasksPerBundle, each of which is meant to be run as one CompasJob, so that
+    the cost of activating a job is shared between several commands. Returns a list of (commands, gridPoints) tuples,
+    where gridPoints[k] is the index of the grid point which commands[k] belongs to
+    
+    """
+    
+    commands = prepareCommands()
+    
+    bundles = []
+    
+    for start in range(0, len(commands), nTasksPerBundle):
+    
+        indices = range(start, min(start + nTasksPerBundle, len(commands)))
+        
+        bundles.append(([commands[i] for i in indices], [i / nTasksPerGridPoint for i in indices]))
+        
+    return bundles
+
 def specifyCommandLineOptions():
     """Generates a string for the terminal command to run COMPAS. This function is intended to be modified by the user, so that they may swap out constant values for functions etc.
         Options not to be included in the command line should be set to pythons None (except booleans, which should be set to False)
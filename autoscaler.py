@@ -0,0 +1,140 @@
+import time
+import math
+
+class Autoscaler(object):
+    """Decides how many VMs a run should have as it goes along. The target comes from how many jobs are waiting,
+    how long jobs have been taking and when the run should be finished by. Failed launches, often a sign of hitting
+    a quota, are retried with an exponential backoff. VMs with nothing to do are released once the wait for work to
+    turn up is expected to be longer than maxIdleWait, judging by how often jobs have been put back in the queue
+
+    """
+
+    @property
+    def maxVirtualMachines(self):
+        """The most VMs the run may have at once
+
+        """
+
+        return self._maxVirtualMachines
+
+    @property
+    def minVirtualMachines(self):
+        """The fewest VMs the run keeps while there are jobs left, including the head node
+
+        """
+
+        return self._minVirtualMachines
+
+    @property
+    def targetDuration(self):
+        """How many seconds after it starts the run should be finished, None to finish as soon as possible
+
+        """
+
+        return self._targetDuration
+
+    @property
+    def defaultJobDuration(self):
+        """How many seconds a job is assumed to take before any have finished
+
+        """
+
+        return self._defaultJobDuration
+
+    @property
+    def maxIdleWait(self):
+        """How many seconds a VM with nothing to do is kept for on the chance of work turning up
+
+        """
+
+        return self._maxIdleWait
+
+    @property
+    def backoff(self):
+        """How many seconds to wait after a failed launch before launching again
+
+        """
+
+        return self._backoff
+
+    @property
+    def startTime(self):
+        """When the run started
+
+        """
+
+        return self._startTime
+
+    def __init__(self, maxVirtualMachines, minVirtualMachines = 1, targetDuration = None, defaultJobDuration = 3600., \
+                 maxIdleWait = 300., initialBackoff = 60., maxBackoff = 1800., maxLaunchesPerStep = 20):
+
+        assert 1 <= minVirtualMachines <= maxVirtualMachines
+
+        self._maxVirtualMachines = maxVirtualMachines
+        self._minVirtualMachines = minVirtualMachines
+        self._targetDuration = targetDuration
+        self._defaultJobDuration = defaultJobDuration
+        self._maxIdleWait = maxIdleWait
+        self._initialBackoff = initialBackoff
+        self._maxBackoff = maxBackoff
+        self._maxLaunchesPerStep = maxLaunchesPerStep
+
+        self._backoff = 0.
+        self._lastFailure = None
+        self._startTime = time.time()
+
+    def start(self):
+
+        self._startTime = time.time()
+
+    def targetVirtualMachines(self, nWaitingJobs, nRunningJobs, jobDuration, slotsPerVm):
+        """How many VMs are needed for the waiting jobs to be done by the target time, alongside the running ones. Once
+        the target has passed, or without one, that's enough for every waiting job to run at once
+
+        """
+
+        if self._targetDuration is None:
+            nSlots = nRunningJobs + nWaitingJobs
+        else:
+            timeLeft = self._startTime + self._targetDuration - time.time()
+            rounds = max(1., timeLeft / max(jobDuration, 1.))
+            nSlots = nRunningJobs + min(nWaitingJobs, int(math.ceil(nWaitingJobs / rounds)))
+
+        target = int(math.ceil(nSlots / float(max(slotsPerVm, 1))))
+
+        return max(self._minVirtualMachines, min(self._maxVirtualMachines, target))
+
+    def nToLaunch(self, target, nVirtualMachines):
+        """How many VMs to launch now, given the target and how many there are or are launching. None are launched
+        while backing off from a failure
+
+        """
+
+        if self._lastFailure is not None and time.time() < self._lastFailure + self._backoff:
+            return 0
+
+        return max(0, min(self._maxLaunchesPerStep, target - nVirtualMachines))
+
+    def recordLaunchFailure(self):
+        """Doubles the backoff, up to maxBackoff
+
+        """
+
+        self._lastFailure = time.time()
+        self._backoff = min(self._maxBackoff, max(self._initialBackoff, 2 * self._backoff))
+
+    def recordLaunchSuccess(self):
+
+        self._lastFailure = None
+        self._backoff = 0.
+
+    def nToKeepIdle(self, nRequeues):
+        """How many VMs with nothing to do are worth keeping. Jobs have been put back in the queue nRequeues times so
+        far, so the k'th idle VM expects to wait k / rate seconds for a job, and is kept while that's under maxIdleWait
+
+        """
+
+        elapsed = max(time.time() - self._startTime, 1.)
+        rate = nRequeues / elapsed
+
+        return int(math.floor(rate * self._maxIdleWait))
@@ -1,4 +1,5 @@
 import numpy as np
+import time
 
 class AzureJob(object):
 
@@ -9,20 +10,171 @@ class AzureJob(object):
         """
         
         return self._vm
+        
+    @property
+    def slot(self):
+        """Which of the VM's slots the job is running in
+        
+        """
+        
+        return self._slot
+        
+    @property
+    def workingDirectory(self):
+        """The directory on the VM, relative to the home directory, which the job runs in. Every slot has its
+        own, so jobs sharing a VM don't trample each other
+        
+        """
+        
+        return 'slot' + str(self._slot)
+        
+    @property
+    def state(self):
+        """What the job was last seen doing: one of 'idle', 'running', 'completed' or 'failed'
+        
+        """
+        
+        return self._state
+        
+    @property
+    def exitCode(self):
+        """The exit code of the job once it has finished, None until then
+        
+        """
+        
+        return self._exitCode
+        
+    @property
+    def progress(self):
+        """The last progress count reported by the agent running the job, None if there hasn't been one
+        
+        """
+        
+        return self._progress
+        
+    @property
+    def lastHeartbeat(self):
+        """When the last event from the agent running the job arrived, None if there hasn't been one
+        
+        """
+        
+        return self._lastHeartbeat
+        
+    @property
+    def transferStats(self):
+        """A dictionary describing how the job's outputs were transferred, with 'bytesTransferred', 'uncompressedBytes' 
+        and 'compressionRatio' keys, None if nothing was recorded
+        
+        """
+        
+        return self._transferStats
+        
+    @property
+    def pid(self):
+        """The process ID of the job on its VM, which leads the session the job runs in, None if it isn't known
+        
+        """
+        
+        return self._pid
+        
+    @property
+    def stopAt(self):
+        """The progress count at which the job is stopped, because the rest of its work has been split off into
+        sub-jobs, None if it runs to the end
+        
+        """
+        
+        return self._stopAt
+        
+    @property
+    def parentJob(self):
+        """The job this one was split off from, None if it wasn't
+        
+        """
+        
+        return self._parentJob
+        
+    @property
+    def subJobs(self):
+        """The jobs which have been split off from this one
+        
+        """
+        
+        return self._subJobs
+        
+    @property
+    def startTime(self):
+        """When the job last started running, None if it hasn't
+        
+        """
+        
+        return self._startTime
+        
+    @property
+    def finishTime(self):
+        """When the job was seen to have finished, None if it hasn't
+        
+        """
+        
+        return self._finishTime
+        
+    @property
+    def runTime(self):
+        """How long the job ran for, or has been running for so far, in seconds. None if it hasn't started
+        
+        """
+        
+        if self._startTime is None:
+            return None
+            
+        return (self._finishTime if self._finishTime is not None else time.time()) - self._startTime
      
 
     def __init__(self):
     
         self._vm = None
+        self._slot = 0
+        self._state = 'idle'
+        self._exitCode = None
+        self._progress = None
+        self._lastHeartbeat = None
+        self._transferStats = None
+        self._pid = None
+        self._startTime = None
+        self._finishTime = None
+        self._stopAt = None
+        self._parentJob = None
+        self._subJobs = []
         
     def initialise(self):
         
         raise NotImplementedError("This is the base class, you should have implemented the initialise() method")
         
-    def activate(self, virtualMachine):
+    def activate(self, virtualMachine, slot = 0):
+        """Starts the job in the given slot of the given VM. Whatever an earlier job left in the slot must be cleared
+        out first, since the manager reuses slots without cleaning them
+        
+        """
     
         raise NotImplementedError("This is the base class, you should have implemented the activate() method")
         
+    def bootScript(self, virtualMachine, slot = 0):
+        """A script which, passed to a new VM as its custom data, starts the job in the given slot as soon as the VM 
+        has booted. None if the job can't be started that way
+        
+        """
+        
+        return None
+        
+    def reattach(self, virtualMachine, slot = 0):
+        """Takes the job back over when it's already running in the given slot of the given VM, without activating it again
+        
+        """
+        
+        self._vm = virtualMachine
+        self._slot = slot
+        self.setStatus('running')
+        
     def checkCompleted(self):
     
         raise NotImplementedError("This is the base class, you should have implemented the checkCompleted() method")
@@ -31,5 +183,111 @@ class AzureJob(object):
     
         raise NotImplementedError("This is the base class, you should have implemented the postProcess() method")
         
+    def statusCommand(self):
+        """A shell command which, run on the job's VM, prints 'running', or 'completed'/'failed' followed by the exit code.
+        A job whose process has died without finishing should be reported as failed. It must not contain single quotes,
+        since it is sent on through the head node
+        
+        """
+    
+        raise NotImplementedError("This is the base class, you should have implemented the statusCommand() method")
+        
+    def kill(self):
+        """Kills the job on its VM, along with everything it started
+        
+        """
+        
+        if self._pid is None:
+            return
+            
+        self._vm.sendCommand('kill -TERM -- -' + str(self._pid) + ' 2>/dev/null; true')
+        
+    def speculativeCopy(self):
+        """A copy of the job, not yet activated, which does the same work under its own id, to race the job when 
+        it's straggling
+        
+        """
+    
+        raise NotImplementedError("This is the base class, you should have implemented the speculativeCopy() method")
+        
+    def canSplit(self):
+        """Whether the rest of the job's work can be split off into a sub-job
+        
+        """
+        
+        return False
+        
+    def remainingWork(self):
+        """How much of the job's work is left, in the same units as its progress, None if it isn't known
+        
+        """
+        
+        return None
+        
+    def split(self, splitAt):
+        """Splits the work after splitAt off into a new job, which is returned, and stops this one once its progress 
+        reaches splitAt
+        
+        """
+        
+        raise NotImplementedError("This is the base class, you should have implemented the split() method")
+
+    def cancelSplit(self, subJob):
+        """Takes back the work split off into the given sub-job, which never started, so that this job runs to the end
+
+        """
+
+        self._subJobs.remove(subJob)
+        self._stopAt = None
+
+    def mergeSubJobs(self):
+        """Merges the outputs of the sub-jobs split off from this job into its own, once they're all complete
+        
+        """
+        
+        pass
+        
+    def adopt(self, other):
+        """Takes over the run of another copy of this job, in its VM and slot, for when a speculative copy is the one
+        which carries on
+        
+        """
+        
+        for attribute in ['_vm', '_slot', '_state', '_exitCode', '_progress', '_lastHeartbeat', '_pid', '_startTime', '_finishTime']:
+            setattr(self, attribute, getattr(other, attribute))
+        
+    def updateProgress(self, progress):
+    
+        self._progress = progress
+        
+    def setStatus(self, state, exitCode = None):
+    
+        if state == 'running' and self._state != 'running':
+            self._startTime = time.time()
+            self._finishTime = None
+        elif state in ('completed', 'failed') and self._finishTime is None:
+            self._finishTime = time.time()
+        elif state == 'idle':
+            self._startTime = None
+            self._finishTime = None
+            self._progress = None
+    
+        self._state = state
+        self._exitCode = exitCode
+        
+    def handleEvent(self, event):
+        """Updates the job from an event pushed by the agent running it
+        
+        """
+        
+        self._lastHeartbeat = time.time()
+        
+        if event.get('progress') is not None:
+            self._progress = event['progress']
+            
+        if event['event'] == 'exit':
+            exitCode = event.get('exitCode')
+            self.setStatus('completed' if exitCode == 0 else 'failed', exitCode)
+        
     
     
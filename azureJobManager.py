@@ -1,10 +1,42 @@
 import subprocess as sp
 import numpy as np
 from virtualMachine import VirtualMachine
+from computeBackend import AzureBackend
+from workerPool import WorkerPool
+from sizeCalibration import SizeCalibration, defaultPriceTable
+from runJournal import RunJournal
+from runMetrics import RunMetrics
+from jobEvents import EventMonitor, RemoteFileTail, agentPath, remoteAgentDirectory, remoteEventLog, \
+                      remoteListenerPidFile
 import warnings
 import time
 import jinja2 as jj2
 
+def reapExpiredWarmPools(exclude = None, backend = None):
+    """Deletes every resource group left as a warm pool whose time to live has run out, apart from exclude. Each
+    manager which uses a warm pool calls this, and it can also be run on a timer so forgotten pools don't linger
+    
+    """
+    
+    if backend is None:
+        backend = AzureBackend()
+    
+    try:
+        warmPools = backend.taggedGroups('warmPoolExpiry')
+    except sp.CalledProcessError:
+        print "there was an error listing the warm pools"
+        return
+        
+    for resourceGroup, expiry in warmPools:
+    
+        if resourceGroup == exclude:
+            continue
+            
+        if float(expiry) < time.time():
+            print "the warm pool in resource group " + resourceGroup + " has expired, deleting it"
+            backend.deleteGroup(resourceGroup, wait = False)
+            
+
 class AzureJobManager(object):
 
     @property
@@ -31,6 +63,14 @@ class AzureJobManager(object):
         
         return self._completedJobs
         
+    @property
+    def downloadingJobs(self):
+        """The array of jobs which have finished running, whose outputs are waiting for or being downloaded
+        
+        """
+        
+        return self._downloadingJobs
+        
     @property
     def verbose(self):
         """Whether or not we're printing a load of stuff about the job. Useful for debugging
@@ -47,6 +87,14 @@ class AzureJobManager(object):
         
         return self._virtualMachines
         
+    @property
+    def allVirtualMachines(self):
+        """Every virtual machine made during the run, including those which have since been deleted
+        
+        """
+        
+        return self._allVirtualMachines
+        
     @property  
     def publicSSHKeyPath(self):
         """The public SSH key to be given to the VM as a trusted user
@@ -87,9 +135,324 @@ class AzureJobManager(object):
         
         return self._htmlPath
         
+    @property
+    def maxConcurrentLaunches(self):
+        """The maximum number of VMs which are created at the same time
+        
+        """
+        
+        return self._maxConcurrentLaunches
+        
+    @property
+    def headNode(self):
+        """The VM holding the public IP address, through which all of the other VMs are reached
+        
+        """
+        
+        return self._virtualMachines[0]
+        
+    @property
+    def cacheHits(self):
+        """The number of uploads skipped across all of the VMs because the file was already in the VM's cache
+        
+        """
+        
+        return sum(vm.cacheHits for vm in self._allVirtualMachines)
+        
+    @property
+    def cacheMisses(self):
+        """The number of cached uploads across all of the VMs which had to be transferred
+        
+        """
+        
+        return sum(vm.cacheMisses for vm in self._allVirtualMachines)
+        
+    @property
+    def sharedFiles(self):
+        """Local files every VM needs, such as the COMPAS executable. They are uploaded to the head node once, and
+        copied from there into the cache of each VM as it's launched
+        
+        """
+        
+        return self._sharedFiles
+        
+    @property
+    def maxConcurrentDownloads(self):
+        """The maximum number of jobs whose outputs are downloaded at the same time
+        
+        """
+        
+        return self._maxConcurrentDownloads
+        
+    @property
+    def spot(self):
+        """Whether the worker VMs are spot VMs, which are much cheaper but may be evicted at any time. The head node
+        is always a regular VM
+        
+        """
+        
+        return self._spot
+        
+    @property
+    def maxEvictionRate(self):
+        """The fraction of spot VMs being evicted above which replacements are launched as regular VMs instead
+        
+        """
+        
+        return self._maxEvictionRate
+        
+    @property
+    def nEvictions(self):
+        """The number of spot VMs which have been evicted
+        
+        """
+        
+        return self._nEvictions
+        
+    @property
+    def evictionRate(self):
+        """The fraction of the spot VMs launched which have been evicted
+        
+        """
+        
+        nSpotLaunches = len([vm for vm in self._allVirtualMachines if vm.isSpot and vm.isLaunched])
+        
+        return float(self._nEvictions) / max(1, nSpotLaunches)
+        
+    @property
+    def warmPool(self):
+        """Whether the VMs are kept, deallocated, at the end of the run for the next run to start again, rather than deleted
+        
+        """
+        
+        return self._warmPool
+        
+    @property
+    def warmPoolTtl(self):
+        """How many seconds a warm pool is kept after the end of a run, or after the manager was last seen running,
+        before it's torn down
+        
+        """
+        
+        return self._warmPoolTtl
+        
+    @property
+    def workerImage(self):
+        """The WorkerImage the VMs are made from, None to use a plain Ubuntu image
+        
+        """
+        
+        return self._workerImage
+        
+    @property
+    def startOnBoot(self):
+        """Whether each worker VM is given its first job as custom data, so it starts as soon as the VM boots rather
+        than being activated over SSH
+        
+        """
+        
+        return self._startOnBoot
+        
+    @property
+    def speculate(self):
+        """Whether straggling jobs are raced by speculative copies on VMs with nothing else to do, once there are no 
+        idle jobs left
+        
+        """
+        
+        return self._speculate
+        
+    @property
+    def stragglerFactor(self):
+        """How many times slower than its peers a job has to be going to count as a straggler
+        
+        """
+        
+        return self._stragglerFactor
+        
+    @property
+    def minStragglerTime(self):
+        """How many seconds a job must have been running before it can count as a straggler
+        
+        """
+        
+        return self._minStragglerTime
+        
+    @property
+    def jobTimeout(self):
+        """How many seconds a job may run for before it's killed and run again, None for no limit
+        
+        """
+        
+        return self._jobTimeout
+        
+    @property
+    def maxRetries(self):
+        """How many times a job which timed out, or whose outputs couldn't be downloaded, is run again before it's 
+        given up on
+        
+        """
+        
+        return self._maxRetries
+        
+    @property
+    def maxActivationFailures(self):
+        """How many jobs in a row may fail to be activated on a VM before it's retired, and its jobs run elsewhere
+        
+        """
+        
+        return self._maxActivationFailures
+        
+    @property
+    def maxDownloadAttempts(self):
+        """How many times the download of a job's outputs is tried before the job is run again
+        
+        """
+        
+        return self._maxDownloadAttempts
+        
+    @property
+    def splitJobs(self):
+        """Whether, once there are no idle jobs left, the unfinished work of the active jobs is split off into sub-jobs
+        to keep the free slots busy
+        
+        """
+        
+        return self._splitJobs
+        
+    @property
+    def minWorkToSplit(self):
+        """The least amount of work, in units of job progress, a job must have left to be split
+        
+        """
+        
+        return self._minWorkToSplit
+        
+    @property
+    def vmSizes(self):
+        """The sizes the VMs are made with, VM i having size vmSizes[i % len(vmSizes)]
+        
+        """
+        
+        return self._vmSizes
+        
+    @property
+    def autoscaler(self):
+        """The Autoscaler which adjusts the number of VMs as the run goes along, None to keep the VMs it starts with
+        until they run out of work
+        
+        """
+        
+        return self._autoscaler
+        
+    @property
+    def metrics(self):
+        """The RunMetrics which each phase of the run is timed into, None unless metricsPath or prometheusPath is given
+        
+        """
+        
+        return self._metrics
+        
+    @property
+    def backend(self):
+        """The ComputeBackend the VMs come from, Azure unless another is given
+        
+        """
+        
+        return self._backend
+        
+    @property
+    def activatingJobs(self):
+        """A list of (job, vm, slot) for the jobs being activated in the background
+        
+        """
+        
+        return self._activatingJobs
+        
+    @property
+    def timeouts(self):
+        """The time limits, in seconds, given to the VMs: a dictionary with 'commandTimeout', 'transferTimeout' and 
+        'provisionTimeout' keys
+        
+        """
+        
+        return self._timeouts
+        
+    @property
+    def speculativeCopies(self):
+        """A dictionary mapping each job being raced to its speculative copy
+        
+        """
+        
+        return self._speculativeCopies
+        
+    @property
+    def journal(self):
+        """The RunJournal every change in the state of the run is recorded in, None if there isn't one
+        
+        """
+        
+        return self._journal
+        
+    @property
+    def sweepParallelism(self):
+        """The number of VMs the head node queries at the same time during a status sweep
+        
+        """
+        
+        return self._sweepParallelism
+        
+    @property
+    def useAgent(self):
+        """Whether jobs are run under jobAgent.py, which pushes their events to a listener on the head node
+        
+        """
+        
+        return self._useAgent
+        
+    @property
+    def agentPort(self):
+        """The port the event listener on the head node listens on
+        
+        """
+        
+        return self._agentPort
+        
+    @property
+    def slotsPerVm(self):
+        """How many jobs each VM runs at once, either a number or 'auto' for one per core
+        
+        """
+        
+        return self._slotsPerVm
+        
+    @property
+    def memoryPerJob(self):
+        """The memory, in MB, each job needs. If given, VMs only run as many jobs as fit into their memory
+        
+        """
+        
+        return self._memoryPerJob
+        
+    @property
+    def slotAssignments(self):
+        """A dictionary mapping (VM name, slot) to the active job running there
+        
+        """
+        
+        return dict(((job.vm.name, job.slot), job) for job in self._activeJobs)
+        
 
     def __init__(self, resourceGroupName, nVirtualMachines, jobs, publicSshKeyPath = '~/.ssh/id_rsa.pub', privateSshKeyPath = '~/.ssh/id_rsa', verbose = False, \
-                sleepTime = 300, htmlPath = None):
+                sleepTime = 300, htmlPath = None, maxConcurrentLaunches = 20, \
+                sweepParallelism = 50, useAgent = False, agentPort = 5555, slotsPerVm = 1, memoryPerJob = None, \
+                sharedFiles = None, maxConcurrentDownloads = 8, journalPath = None, spot = False, maxEvictionRate = 0.2, \
+                maxUnreachableSweeps = 3, warmPool = False, warmPoolTtl = 12 * 3600, workerImage = None, \
+                startOnBoot = False, speculate = False, stragglerFactor = 2., minStragglerTime = 600, jobTimeout = None, \
+                maxRetries = 2, splitJobs = False, minWorkToSplit = 1000, vmSize = 'Basic_A0', \
+                autoscaler = None, maxConcurrentActivations = 20, maxConcurrentDeletions = 20, commandTimeout = 600, \
+                transferTimeout = 3600, provisionTimeout = 1800, backend = None, \
+                metricsPath = None, prometheusPath = None, maxDownloadAttempts = 3, maxActivationFailures = 3):
     
         
         self._resourceGroupName = resourceGroupName
@@ -98,11 +461,69 @@ class AzureJobManager(object):
         self._verbose = verbose
         self._sleepTime = sleepTime
         self._htmlPath = htmlPath
+        self._maxConcurrentLaunches = maxConcurrentLaunches
+        self._sweepParallelism = sweepParallelism
+        self._useAgent = useAgent
+        self._agentPort = agentPort
+        self._eventMonitor = None
+        self._slotsPerVm = slotsPerVm
+        self._memoryPerJob = memoryPerJob
+        self._sharedFiles = list(sharedFiles) if sharedFiles is not None else []
+        self._maxConcurrentDownloads = maxConcurrentDownloads
+        self._journal = RunJournal(journalPath) if journalPath is not None else None
+        self._spot = spot
+        self._maxEvictionRate = maxEvictionRate
+        self._maxUnreachableSweeps = maxUnreachableSweeps
+        self._nEvictions = 0
+        self._unreachableSweeps = {}
+        self._retiredVms = []
+        self._warmPool = warmPool
+        self._warmPoolTtl = warmPoolTtl
+        self._warmPoolExpiry = None
+        self._warmVms = set()
+        self._workerImage = workerImage
+        self._imageId = None
+        self._startOnBoot = startOnBoot
+        self._bootingJobs = {}
+        self._speculate = speculate
+        self._stragglerFactor = stragglerFactor
+        self._minStragglerTime = minStragglerTime
+        self._jobTimeout = jobTimeout
+        self._maxRetries = maxRetries
+        self._maxDownloadAttempts = maxDownloadAttempts
+        self._maxActivationFailures = maxActivationFailures
+        self._activationFailures = {}
+        self._speculativeCopies = {}
+        self._activatingCopies = {}
+        self._activatingSplits = set()
+        self._nRetries = {}
+        self._splitJobs = splitJobs
+        self._minWorkToSplit = minWorkToSplit
+        self._mergedJobs = set()
+        self._vmSizes = vmSize if isinstance(vmSize, list) else [vmSize]
+        self._autoscaler = autoscaler
+        self._nRequeues = 0
+        self._activationPool = WorkerPool(maxConcurrentActivations)
+        self._deletionPool = WorkerPool(maxConcurrentDeletions)
+        self._activatingJobs = []
+        self._timeouts = {'commandTimeout' : commandTimeout, 'transferTimeout' : transferTimeout, 'provisionTimeout' : provisionTimeout}
+        self._backend = backend if backend is not None else AzureBackend(commandTimeout = commandTimeout, provisionTimeout = provisionTimeout)
+        self._metrics = RunMetrics(metricsPath, prometheusPath) if metricsPath is not None or prometheusPath is not None else None
+        self._lastSeenRunning = {}
+        
+        assert not startOnBoot or workerImage is not None, "jobs can only be started on boot from a worker image"
+        assert workerImage is None or isinstance(self._backend, AzureBackend), "worker images are only used on Azure"
         
         self._virtualMachines = []
+        self._allVirtualMachines = []
         self._idleJobs = jobs
         self._activeJobs = []
         self._completedJobs = []
+        self._downloadingJobs = []
+        self._downloadStatus = {}
+        self._downloadPool = WorkerPool(maxConcurrentDownloads)
+        self._launchPool = WorkerPool(maxConcurrentLaunches)
+        self._launchingVms = []
         
         self._nJobs = len(jobs)
         
@@ -110,8 +531,20 @@ class AzureJobManager(object):
             warnings.warn("requested more VMs than jobs, reducing the number of VMs")
             nVirtualMachines = self._nJobs
       
+        if self._warmPool:
+            reapExpiredWarmPools(exclude = self._resourceGroupName, backend = self._backend)
+            self.expireWarmPool()
+      
         self.makeResourceGroup()
         
+        if self._warmPool:
+            self._warmVms = set(self.listVirtualMachines())
+            self.verbosePrint('found ' + str(len(self._warmVms)) + ' VMs in the warm pool')
+        
+        if self._workerImage is not None:
+            #rebuilt only if one of the files baked into it, or the packages installed on it, has changed since it was last built
+            self._imageId = self._workerImage.ensureBuilt()
+        
         self.constructVirtualMachines(nVirtualMachines)
         
     
@@ -120,11 +553,56 @@ class AzureJobManager(object):
         
         """
         
-        command = 'az group create --name ' + self._resourceGroupName + ' -l centralus'
+        self.verbosePrint('Now creating the resource group ' + self._resourceGroupName)
+        
+        self._backend.makeGroup(self._resourceGroupName)
+        
+        if self._warmPool:
+            #the pool is in use, but it mustn't be left for good if the manager dies
+            self.refreshWarmPoolExpiry(force = True)
+            
+    def refreshWarmPoolExpiry(self, force = False):
+        """Pushes back when the warm pool expires to warmPoolTtl from now. It's done once less than half of the time 
+        to live is left, so that it costs an az call only every so often
+        
+        """
+        
+        now = time.time()
+        
+        if not force and self._warmPoolExpiry is not None and self._warmPoolExpiry - now > self._warmPoolTtl / 2.:
+            return
+            
+        self._warmPoolExpiry = int(now + self._warmPoolTtl)
+        
+        self._backend.setGroupTag(self._resourceGroupName, 'warmPoolExpiry', self._warmPoolExpiry)
+        
+    def expireWarmPool(self):
+        """Tears down the resource group if it's a warm pool which has outlived its time to live
+        
+        """
+        
+        expiry = self._backend.groupTag(self._resourceGroupName, 'warmPoolExpiry')
+            
+        if expiry is not None and float(expiry) < time.time():
+            print "the warm pool has expired, deleting it"
+            self._backend.deleteGroup(self._resourceGroupName)
+        
+    def listVirtualMachines(self):
+        """The names of all of the VMs in the resource group, whether they are running or not
+        
+        """
+        
+        return self._backend.listVirtualMachines(self._resourceGroupName)
+        
+    def startOrLaunch(self, vm, headNodeIp = None):
+        """Starts the VM if it's in the warm pool, otherwise creates it
         
-        self.verbosePrint('Now creating a resource group with command ' + command)
+        """
         
-        sp.call(command,shell=True)
+        if vm.name in self._warmVms:
+            vm.start(headNodeIp)
+        else:
+            vm.launch(headNodeIp)
         
     def constructVirtualMachines(self, nVirtualMachines):
         """Construct the VirtualMachine objects with the necessary information
@@ -133,123 +611,913 @@ class AzureJobManager(object):
     
         for i in range(nVirtualMachines):
         
-            vmName = self._resourceGroupName + 'vm' + str(i)
-            
-            vmOptions = {
-        
-                '--image' : 'UbuntuLTS',
-                '--admin-username' : 'ops',
-                '--ssh-key-value' : self._publicSSHKeyPath,
-                '--resource-group' : self._resourceGroupName,
-                '--location' : 'centralus',
-                '--name' : vmName,
-                '--size' : 'Basic_A0',
-                '--storage-sku' : 'Standard_LRS',
-                '--public-ip-address' : self._resourceGroupName + 'PublicIp',
-                '--vnet-name' : self._resourceGroupName + 'VNet',
-                '--nsg' : self._resourceGroupName + 'NSG',
-                '--subnet' : self._resourceGroupName + 'Subnet'
-            }
-            
-            if i>0:
-                vmOptions['--public-ip-address'] = "\"\""  
-#                vmOptions['--nsg'] = ""  
-            
-            vm = VirtualMachine(vmName, self._resourceGroupName, vmOptions, sshKeyPath = self._publicSSHKeyPath, \
-                                verbose = self._verbose)
-                                
-            self._virtualMachines.append(vm)
+            self._virtualMachines.append(self.constructVirtualMachine(spot = self._spot and i > 0))
             
-    def run(self):
-        """Launches all of the virtual machines, then monitors the progress of the jobs, until they're all done,
-        finally destroying the VMs and the resource group once everything's done
+    def constructVirtualMachine(self, spot = False):
+        """Construct one VirtualMachine object, named after the number of VMs constructed so far. The first is the
+        head node, which holds the public IP address
         
         """
         
-        assert self._nJobs == len(self._idleJobs)
-        assert self._nJobs >= len(self._virtualMachines)
+        i = len(self._allVirtualMachines)
         
-        headNodeIp = None
+        vmName = self._resourceGroupName + 'vm' + str(i)
         
-        #initally launch the virtual machines, putting one job on each of them
-        for i,vm in enumerate(self._virtualMachines):
-            
-            try:
-                vm.launch(headNodeIp)
-                if i == 0:
-                    command = 'scp -o  StrictHostKeyChecking=no ' + self._publicSSHKeyPath + ' ops@' + vm._publicIpAddress + ':.ssh/.'
-                    sp.call(command,shell=True)
-                    command = 'scp -o  StrictHostKeyChecking=no ' + self._privateSSHKeyPath + ' ops@' + vm._publicIpAddress + ':.ssh/.'
-                    sp.call(command,shell=True)
-                    
-                    headNodeIp = vm._publicIpAddress
-                    
-            except:
-                print "there was an error launching one of the VMs. we may have hit a usage limit..."
-                print "making do with the ones already launched"
-                self._virtualMachines = self._virtualMachines[:i]
-                break
-            if not self._htmlPath == None:
-                try:
-                    self.updateHtml()
-                except:
-                    print "there was an error writing the HTML page"
-            self._activeJobs.append(self._idleJobs[0])
-            self._idleJobs[0].activate(vm)
-            self._idleJobs = self._idleJobs[1:]
-           
+        vmOptions = {
+    
+            '--image' : self._imageId if self._imageId is not None else 'UbuntuLTS',
+            '--admin-username' : 'ops',
+            '--ssh-key-value' : self._publicSSHKeyPath,
+            '--resource-group' : self._resourceGroupName,
+            '--location' : 'centralus',
+            '--name' : vmName,
+            '--size' : self._vmSizes[i % len(self._vmSizes)],
+            '--storage-sku' : 'Standard_LRS',
+            '--public-ip-address' : self._resourceGroupName + 'PublicIp',
+            '--vnet-name' : self._resourceGroupName + 'VNet',
+            '--nsg' : self._resourceGroupName + 'NSG',
+            '--subnet' : self._resourceGroupName + 'Subnet'
+        }
+        
+        if i>0:
+            vmOptions['--public-ip-address'] = "\"\""  
+#            vmOptions['--nsg'] = ""  
+
+        if spot:
+            #pay at most the regular price, and keep the disk if the VM is evicted
+            vmOptions['--priority'] = 'Spot'
+            vmOptions['--eviction-policy'] = 'Deallocate'
+            vmOptions['--max-price'] = '-1'
+        
+        vm = VirtualMachine(vmName, self._resourceGroupName, vmOptions, sshKeyPath = self._publicSSHKeyPath, \
+                            verbose = self._verbose, headNode = self._allVirtualMachines[0] if i > 0 else None, backend = self._backend, \
+                            metrics = self._metrics, **self._timeouts)
+                            
+        if self._imageId is not None:
+            #there's no need to check for the files baked into the image before using them
+            vm._cachedHashes.update(self._workerImage.bakedHashes)
+                            
+        self._allVirtualMachines.append(vm)
+        
+        return vm
             
-        #wait before starting the checking loop
-        time.sleep(self._sleepTime)
+    def setVmSizes(self, sizes):
+        """Changes the sizes of the VMs which haven't been launched yet, and of any made later, VM i having size 
+        sizes[i % len(sizes)]
         
-        while self.completed() == False:
+        """
         
-            self.updateJobs()
-            
-            time.sleep(self._sleepTime)
-  
-        self.cleanUp()
-                
-    
-    def updateJobs(self):
-        """Checks all of the active jobs for completion, and moves them to the completed queue,
-        before replacing them with one from the idle queue
+        self._vmSizes = sizes
+        
+        for i, vm in enumerate(self._allVirtualMachines):
+            if not vm.isLaunched:
+                vm.vmOptions['--size'] = sizes[i % len(sizes)]
+        
+    def calibrateVmSize(self, candidateSizes, priceTable = defaultPriceTable, nSampleBinaries = 100, mix = False, maxPerSize = None, \
+                        measurementsPath = '~/.azureJobManager/sizeCalibration.json'):
+        """Times a short sample of the first idle job on a VM of each candidate size, and makes the VMs the size which
+        simulates the most binaries per dollar or, with mix, as many of each size as maxPerSize allows, best first. The 
+        first job must be a CompasJob running a single command. Call this before run(), and consider slotsPerVm = 'auto' 
+        for sizes with several cores. Measurements saved by earlier calibrations are reused. Returns the SizeCalibration
         
         """
-
+        
+        assert isinstance(self._backend, AzureBackend), "VM sizes are only calibrated on Azure"
+        
+        sampleJob = self._idleJobs[0]
+        
+        calibration = SizeCalibration(self._resourceGroupName + 'Calibration', candidateSizes, sampleJob.sampleCommand(nSampleBinaries), \
+                                      sampleJob.compasPath, priceTable = priceTable, publicSshKeyPath = self._publicSSHKeyPath, \
+                                      image = self._imageId if self._imageId is not None else 'UbuntuLTS', \
+                                      nSampleBinaries = nSampleBinaries, measurementsPath = measurementsPath, verbose = self._verbose, \
+                                      commandTimeout = self._timeouts['commandTimeout'], provisionTimeout = self._timeouts['provisionTimeout'])
+                                      
+        calibration.calibrate()
+        
+        if mix:
+            sizes = calibration.chooseSizes(len(self._allVirtualMachines), maxPerSize)
+        else:
+            sizes = [calibration.bestSize()]
+            
+        print "making the VMs with sizes " + ', '.join(sorted(set(sizes)))
+            
+        self.setVmSizes(sizes)
+        
+        return calibration
+            
+    def run(self):
+        """Launches all of the virtual machines, then monitors the progress of the jobs, until they're all done,
+        finally destroying the VMs and the resource group once everything's done. The journal of an earlier run is 
+        archived, so that this one starts afresh
+        
+        """
+        
+        assert self._nJobs == len(self._idleJobs)
+        assert self._nJobs >= len(self._virtualMachines)
+        
+        if self._journal is not None:
+            self._journal.archive()
+        
+        if self._autoscaler is not None:
+            self._autoscaler.start()
+        
+        self.launchVirtualMachines()
+        
+        self.monitor()
+        
+    def resume(self):
+        """Picks up a run which was interrupted, from its journal. The VMs which are still running in the resource group
+        are reattached to, the jobs which completed are skipped, and the jobs which were running on those VMs are left 
+        running and monitored, or have their outputs downloaded if they had already finished. Jobs on VMs which have
+        gone are started again. If the head node has gone, the jobs which didn't complete are run on new VMs instead.
+        The sub-jobs split off during the interrupted run are split off again at the same points. If the journalled
+        run had finished, a new one is started. Job ids must be the same as in the interrupted run.
+        
+        """
+        
+        assert self._journal is not None, "can only resume a run with a journal"
+        
+        if self._journal.finished():
+            print "the journalled run had already finished, starting it afresh"
+            self.run()
+            return
+        
+        if self._autoscaler is not None:
+            self._autoscaler.start()
+            
+        nVirtualMachines = len(self._virtualMachines)
+        
+        launchedVms, journalledJobs = self._journal.replayState()
+        runningVms = self.listRunningVirtualMachines()
+        
+        #VMs launched as replacements during the interrupted run need constructing too
+        prefix = self._resourceGroupName + 'vm'
+        nLaunched = max([int(name[len(prefix):]) for name in launchedVms if name.startswith(prefix)] + [-1]) + 1
+        
+        while len(self._allVirtualMachines) < nLaunched:
+            self._virtualMachines.append(self.constructVirtualMachine(spot = self._spot))
+        
+        attachedVms = []
+        
+        for vm in self._virtualMachines:
+        
+            if vm.name in launchedVms and vm.name in runningVms:
+                details = launchedVms[vm.name]
+                vm.attach(details['privateIp'], details['publicIp'], details['nSlots'])
+                attachedVms.append(vm)
+                
+        headNodeGone = len(attachedVms) == 0 or not attachedVms[0] is self.headNode
+                
+        if headNodeGone:
+        
+            print "the head node of resource group " + self._resourceGroupName + " is gone, the jobs which didn't complete will be run on new VMs"
+            
+            #the workers can't be reached without it
+            for vm in attachedVms:
+                self.deleteVirtualMachine(vm)
+                
+            while self._deletionPool.nPending > 0:
+                time.sleep(1)
+                
+            self.collectDeletions()
+            
+            attachedVms = []
+            
+        self._virtualMachines = attachedVms
+        vmsByName = dict((vm.name, vm) for vm in attachedVms)
+        
+        if self._useAgent and not headNodeGone:
+            self.startEventListener()
+            
+        jobsById = dict((str(job.id), job) for job in self._idleJobs)
+        
+        #a sub-job is always journalled after the job it was split from
+        for parentId, subJobId, splitAt in self._journal.splits():
+            subJob = jobsById[parentId].split(splitAt)
+            jobsById[str(subJob.id)] = subJob
+            self._idleJobs.append(subJob)
+            self._nJobs += 1
+        
+        idleJobs = []
+        
+        for job in self._idleJobs:
+        
+            details = journalledJobs.get(str(job.id))
+            
+            if details is None:
+                idleJobs.append(job)
+            elif details['state'] == 'completed':
+                self._completedJobs.append(job)
+                self._mergedJobs.add(job)
+            elif details['vm'] in vmsByName:
+                job.reattach(vmsByName[details['vm']], details['slot'])
+                if details['state'] == 'finished':
+                    #a job which failed is still counted as one
+                    job.setStatus(details['jobState'], details['exitCode'])
+                    self.queueDownload(job)
+                else:
+                    self._activeJobs.append(job)
+            else:
+                self.verbosePrint('the VM job ' + str(job.id) + ' was running on has gone, it will be run again')
+                idleJobs.append(job)
+                
+        self._idleJobs = idleJobs
+        
+        if headNodeGone and len(self._idleJobs) > 0:
+            self._allVirtualMachines = []
+            self.constructVirtualMachines(min(nVirtualMachines, len(self._idleJobs)))
+            self.launchVirtualMachines()
+        
+        self.verbosePrint('resuming with ' + str(len(self._virtualMachines)) + ' VMs, ' + str(len(self._completedJobs)) + ' completed jobs and ' + \
+                          str(len(self._activeJobs) + len(self._downloadingJobs)) + ' jobs in flight')
+        
+        for vm in attachedVms:
+            self.fillSlots(vm)
+        
+        self.monitor()
+        
+    def monitor(self):
+        """Monitors the progress of the jobs until they're all done, then destroys the VMs and the resource group
+        
+        """
+            
+        #wait before starting the checking loop
+        lastSweep = time.time()
+        self.waitForEvents(self._sleepTime)
+        
+        while self.completed() == False:
+        
+            #between sweeps, only the jobs the agents have reported as finished are dealt with
+            sweep = time.time() - lastSweep >= self._sleepTime
+            if sweep:
+                lastSweep = time.time()
+        
+            self.updateJobs(sweep)
+            
+            self.waitForEvents(self._sleepTime - (time.time() - lastSweep))
+  
+        self.cleanUp()
+                
+    
+    def listRunningVirtualMachines(self):
+        """The names of the VMs in the resource group which are running
+        
+        """
+        
+        return self._backend.listVirtualMachines(self._resourceGroupName, running = True)
+        
+    def observe(self, phase, start, **labels):
+        """Records how long a phase which began at start took, if the run is being timed
+        
+        """
+        
+        if self._metrics is not None:
+            self._metrics.observe(phase, time.time() - start, **labels)
+            
+    def record(self, event, **fields):
+        """Records an event in the journal, if there is one
+        
+        """
+        
+        if self._journal is not None:
+            self._journal.record(event, **fields)
+            
+    def recordLaunch(self, vm):
+    
+        self.record('vmLaunched', vm = vm.name, privateIp = vm.privateIpAddress, publicIp = vm.publicIpAddress, nSlots = vm.nSlots)
+        
+        if self._metrics is not None:
+            self._metrics.vmLaunched(vm.name, vm.nSlots)
+        
+    def deleteVirtualMachine(self, vm):
+        """Gets rid of a VM which is no longer needed. With a warm pool it's deallocated instead, ready for the next run
+        
+        """
+    
+        #in the background, since deleting a VM can take minutes
+        if self._warmPool:
+            self._deletionPool.submit(vm, vm.deallocate)
+        else:
+            self._deletionPool.submit(vm, vm.delete)
+        
+        if vm in self._virtualMachines:
+            self._virtualMachines.remove(vm)
+            
+        self.record('vmDeleted', vm = vm.name)
+        
+        if self._metrics is not None:
+            self._metrics.vmReleased(vm.name)
+        
+    def launchHeadNode(self):
+        """Launches the head node on its own, since it creates the public IP address and network which
+        the rest of the VMs use, then gives it the SSH keys it needs to reach the rest of the VMs
+        
+        """
+        
+        headNode = self.headNode
+        
+        self.startOrLaunch(headNode)
+        
+        self._backend.installClusterKeys(headNode, self._publicSSHKeyPath, self._privateSSHKeyPath)
+        
+        for filePath in self._sharedFiles:
+            headNode.ensureCached(filePath)
+        
+    def launchVirtualMachines(self):
+        """Launches the head node, then launches the rest of the VMs concurrently, at most maxConcurrentLaunches
+        at a time. Each VM is given a job as soon as it's ready. VMs which fail to launch are dropped.
+        
+        """
+        
+        try:
+            self.launchHeadNode()
+        except:
+            print "there was an error launching the head node, cannot continue"
+            raise
+            
+        if self._useAgent:
+            self.startEventListener()
+            
+        self.headNode.setSlots(self._slotsPerVm, self._memoryPerJob)
+        self.recordLaunch(self.headNode)
+            
+        launchedVms = [self.headNode]
+        self.fillSlots(self.headNode)
+        
+        workers = self._virtualMachines[1:]
+        
+        if len(workers) > 0:
+        
+            for vm in workers:
+                self._launchPool.submit(vm, self.launchWorker, vm, self.takeBootJob(vm))
+                
+            for i in range(len(workers)):
+            
+                vm, returnValue, exception = self._launchPool.results.get()
+                
+                if exception is not None:
+                    print "there was an error launching " + vm.name + ". we may have hit a usage limit..."
+                    
+                    if self._autoscaler is not None:
+                        print "the autoscaler will try again later"
+                        self._autoscaler.recordLaunchFailure()
+                    else:
+                        print "making do with the ones which did launch"
+                        
+                    self.abandonBootJob(vm)
+                    continue
+                    
+                self.recordLaunch(vm)
+                self.startBootJob(vm)
+                self.fillSlots(vm)
+                
+                if self.nBusySlots(vm) == 0:
+                    #the other VMs have already taken all of the jobs
+                    self.deleteVirtualMachine(vm)
+                    continue
+                    
+                launchedVms.append(vm)
+            
+        self._virtualMachines = [vm for vm in self._virtualMachines if vm in launchedVms]
+        
+    def startEventListener(self):
+        """Starts the listener which the agents push their events to on the head node, and starts following
+        its log. Every VM is told to send its events there.
+        
+        """
+        
+        headNode = self.headNode
+        
+        #a listener left over from an interrupted run is replaced, going by the pid it left, so that no other run's
+        #listener is touched, and a pid which has since been reused by something else is left alone
+        headNode.sendCommand('pid=$(cat ' + remoteListenerPidFile + ' 2>/dev/null) && grep -q jobAgent.py /proc/$pid/cmdline 2>/dev/null && ' + \
+                             'kill $pid; mkdir -p ' + remoteAgentDirectory + ' && : > ' + remoteEventLog)
+        headNode.uploadFile(agentPath, remoteAgentDirectory)
+        headNode.sendCommand('setsid nohup python ' + remoteAgentDirectory + '/jobAgent.py listen --port ' + str(self._agentPort) + \
+                             ' --output ' + remoteEventLog + ' --pid-file ' + remoteListenerPidFile + ' < /dev/null > /dev/null 2>&1 &')
+        
+        for vm in self._virtualMachines:
+            vm._agentTransport = 'tcp:' + headNode.privateIpAddress + ':' + str(self._agentPort)
+            
+        if self._eventMonitor is not None:
+            self._eventMonitor.stop()
+            
+        self._eventMonitor = EventMonitor(RemoteFileTail(headNode, remoteEventLog))
+        
+    def waitForEvents(self, timeout):
+        """Waits for timeout seconds, returning early if an agent reports that one of the active jobs has exited,
+        or a download finishes, so that its slot can be reused straight away
+        
+        """
+            
+        deadline = time.time() + timeout
+        
+        while time.time() < deadline:
+        
+            if not self._downloadPool.results.empty():
+                return
+                
+            wait = min(1., deadline - time.time())
+            
+            if self._eventMonitor is None:
+                time.sleep(max(0, wait))
+            elif self.handleEvents(self._eventMonitor.waitForEvents(wait)):
+                return
+                
+    def handleEvents(self, events):
+        """Passes events on to the active jobs they belong to, returning True if any of them exited
+        
+        """
+        
+        jobsById = dict((str(job.id), job) for job in self._activeJobs)
+        
+        anyExited = False
+        
+        for event in events:
+        
+            job = jobsById.get(str(event.get('job')))
+            
+            if job is None:
+                continue
+                
+            job.handleEvent(event)
+            
+            #the job was running until the event was sent
+            self._lastSeenRunning[job] = event.get('time', time.time())
+            
+            if event['event'] == 'exit':
+                anyExited = True
+                
+        return anyExited
+        
+    def launchWorker(self, vm, bootScript = None):
+        """Launches a worker VM and works out how many slots it has. This is run in the background. If there's a boot
+        script, the VM runs it as soon as it has booted
+        
+        """
+        
+        if bootScript is not None:
+            vm.launch(self.headNode._publicIpAddress, customData = bootScript)
+        else:
+            self.startOrLaunch(vm, self.headNode._publicIpAddress)
+        vm.setSlots(self._slotsPerVm, self._memoryPerJob)
+        
+        for filePath in self._sharedFiles:
+            vm.ensureCached(filePath)
+        
+    def launchReplacement(self, reason = 'to replace an evicted one'):
+        """Launches another worker VM in the background, to replace one which was evicted, or when scaling up. It's a
+        spot VM unless too many spot VMs have been evicted
+        
+        """
+        
+        spot = self._spot and self.evictionRate <= self._maxEvictionRate
+        
+        vm = self.constructVirtualMachine(spot = spot)
+        
+        self.verbosePrint('launching ' + vm.name + ' as a ' + ('spot' if spot else 'regular') + ' VM ' + reason)
+        
+        self._launchingVms.append(vm)
+        self._launchPool.submit(vm, self.launchWorker, vm, self.takeBootJob(vm))
+        
+    def takeBootJob(self, vm):
+        """Takes the next idle job to start on the given VM as soon as it boots, returning the script which starts it,
+        or None if the VM will be given its jobs over SSH once it's up. VMs from a warm pool have booted before, so 
+        they don't run custom data again
+        
+        """
+        
+        if not self._startOnBoot or vm.name in self._warmVms or len(self._idleJobs) == 0:
+            return None
+            
+        if self._eventMonitor is not None:
+            vm._agentTransport = 'tcp:' + self.headNode.privateIpAddress + ':' + str(self._agentPort)
+            
+        job = self._idleJobs[0]
+        
+        bootScript = job.bootScript(vm, 0)
+        
+        if bootScript is None:
+            return None
+            
+        self._idleJobs = self._idleJobs[1:]
+        self._bootingJobs[vm] = job
+        
+        return bootScript
+        
+    def startBootJob(self, vm):
+        """Counts the job started on boot as active, once its VM has launched
+        
+        """
+        
+        job = self._bootingJobs.pop(vm, None)
+        
+        if job is None:
+            return
+            
+        job.reattach(vm, 0)
+        self._activeJobs.append(job)
+        
+        self.record('jobActivated', job = job.id, vm = vm.name, slot = 0)
+        
+    def abandonBootJob(self, vm):
+        """Puts the job which was to start on boot back in the idle queue, when its VM failed to launch
+        
+        """
+        
+        job = self._bootingJobs.pop(vm, None)
+        
+        if job is not None:
+            self.requeueJob(job)
+        
+    def collectDeletions(self):
+        """Reports the VMs which couldn't be deleted. The resource group is deleted at the end anyway
+        
+        """
+        
+        while not self._deletionPool.results.empty():
+        
+            vm, returnValue, exception = self._deletionPool.results.get()
+            
+            if exception is not None:
+                print "there was an error deleting " + vm.name + ": " + str(exception)
+        
+    def collectLaunches(self):
+        """Puts the VMs launched in the background since the last check to work
+        
+        """
+        
+        while not self._launchPool.results.empty():
+        
+            vm, returnValue, exception = self._launchPool.results.get()
+            self._launchingVms.remove(vm)
+            
+            if exception is not None:
+                print "there was an error launching " + vm.name + ": " + str(exception)
+                self.abandonBootJob(vm)
+                
+                if self._autoscaler is not None:
+                    self._autoscaler.recordLaunchFailure()
+                    
+                continue
+                
+            if self._autoscaler is not None:
+                self._autoscaler.recordLaunchSuccess()
+                
+            self.recordLaunch(vm)
+            self._virtualMachines.append(vm)
+            self.startBootJob(vm)
+            self.fillSlots(vm)
+            
+            if self.nBusySlots(vm) == 0 and self._autoscaler is None:
+                self.deleteVirtualMachine(vm)
+                
+    def detectEvictions(self, statuses):
+        """Finds the spot VMs which have been evicted: those which are no longer running according to Azure, and those
+        which haven't answered for maxUnreachableSweeps sweeps in a row. If Azure can't be asked which VMs are running,
+        only the latter are counted as evicted this time
+        
+        """
+        
+        try:
+            runningVms = self.listRunningVirtualMachines()
+        except sp.CalledProcessError:
+            print "there was an error listing the running VMs, skipping that check for evictions this time"
+            runningVms = None
+        
+        evictedVms = []
+        
+        for vm in self._virtualMachines:
+        
+            if not vm.isSpot:
+                continue
+                
+            jobStates = [statuses.get(job.id, ('running', None))[0] for job in self._activeJobs if job.vm is vm]
+            
+            if len(jobStates) > 0 and all(state == 'unreachable' for state in jobStates):
+                self._unreachableSweeps[vm] = self._unreachableSweeps.get(vm, 0) + 1
+            else:
+                self._unreachableSweeps[vm] = 0
+                
+            if (runningVms is not None and not vm.name in runningVms) or self._unreachableSweeps[vm] >= self._maxUnreachableSweeps:
+                evictedVms.append(vm)
+                
+        return evictedVms
+        
+    def handleEviction(self, vm):
+        """Puts the jobs on an evicted VM back at the front of the idle queue, after trying to save whatever they've 
+        output so far, then replaces the VM
+        
+        """
+        
+        print vm.name + " has been evicted, its jobs will be run again"
+        
+        self._nEvictions += 1
+        
+        self.retireVirtualMachine(vm)
+        
+        if self.evictionRate > self._maxEvictionRate:
+            warnings.warn("the eviction rate is " + str(self.evictionRate) + ", falling back to regular VMs")
+            
+        self.launchReplacement()
+        
+    def retireVirtualMachine(self, vm):
+        """Stops using a VM which has gone, or can't be relied on. The jobs on it are put back at the front of the idle
+        queue, to be run again from the start, and it's deleted. Jobs still being activated on it, or downloaded from it,
+        are dealt with as they come back
+        
+        """
+        
+        self._retiredVms.append(vm)
+        
+        for job in [job for job in self._activeJobs if job.vm is vm]:
+        
+            if self.speculativePartner(job) is not None:
+                #the other copy carries on
+                self.resolveRace(job, False)
+                continue
+                
+            self._activeJobs.remove(job)
+            self.requeueJob(job)
+            
+        self.deleteVirtualMachine(vm)
+        
+    def requeueJob(self, job):
+        """Puts a job back at the front of the idle queue, so it's the next one started
+        
+        """
+        
+        job.setStatus('idle')
+        self._idleJobs.insert(0, job)
+        self._nRequeues += 1
+        self.record('jobRequeued', job = job.id)
+        
+    def nBusySlots(self, vm):
+        """The number of slots on the given VM with a job in them, counting jobs whose outputs are still downloading
+        
+        """
+        
+        return len([job for job in self._activeJobs + self._downloadingJobs if job.vm is vm]) + \
+               len([job for job, jobVm, slot in self._activatingJobs if jobVm is vm])
+        
+    def freeSlots(self, vm):
+        """The slots of the given VM which don't have a job in them. A VM which has failed to activate too many jobs
+        in a row, which can only be the head node, since the others are retired, is given no more
+        
+        """
+        
+        if self._activationFailures.get(vm, 0) >= self._maxActivationFailures:
+            return []
+        
+        usedSlots = [job.slot for job in self._activeJobs + self._downloadingJobs if job.vm is vm] + \
+                    [slot for job, jobVm, slot in self._activatingJobs if jobVm is vm]
+        
+        return [slot for slot in range(vm.nSlots) if not slot in usedSlots]
+        
+    def fillSlots(self, vm):
+        """Starts idle jobs in all of the free slots of the given VM
+        
+        """
+        
+        for slot in self.freeSlots(vm):
+        
+            if len(self._idleJobs) == 0:
+                break
+                
+            self.startNextJob(vm, slot)
+        
+    def startNextJob(self, vm, slot = 0):
+        """Moves the next idle job onto the given slot of the given VM and activates it
+        
+        """
+        
         if not self._htmlPath == None:
             try:
                 self.updateHtml()
             except:
                 print "there was an error writing the HTML page"
         
-        remainingActiveJobs = []
-        availableVms = []
+        job = self._idleJobs[0]
+        self._idleJobs = self._idleJobs[1:]
+        
+        self.startActivation(job, vm, slot)
+        
+    def startActivation(self, job, vm, slot):
+        """Hands a job to the activation workers, which start it in the given slot of the given VM in the background,
+        so that one slow VM doesn't hold up the others
+        
+        """
+        
+        self._activatingJobs.append((job, vm, slot))
+        self._activationPool.submit((job, vm, slot), self.activateJob, job, vm, slot)
+        
+    def activateJob(self, job, vm, slot):
+        """Run by the activation workers. The job is journalled as activated as soon as it's started, rather than when
+        it's collected, which may be a whole sleepTime later, so that a crash in between doesn't make resume() start it
+        a second time
+        
+        """
+        
+        start = time.time()
+        
+        try:
+            job.activate(vm, slot)
+        finally:
+            self.observe('activation', start, vm = vm.name, job = job.id)
+            
+        #only the original of a raced job is ever journalled, and a sub-job is journalled with where it was split off
+        if job.parentJob is not None:
+            self.record('jobActivated', job = job.id, vm = vm.name, slot = slot, parentJob = job.parentJob.id, splitAt = job.parentJob.stopAt)
+        elif not job in self._activatingCopies:
+            self.record('jobActivated', job = job.id, vm = vm.name, slot = slot)
+        
+    def collectActivations(self):
+        """Moves the jobs which have been activated since the last check to the active jobs. Those which couldn't be 
+        are put back at the front of the idle queue, and the (vm, slot) they were to use are returned. A VM which fails
+        to activate maxActivationFailures jobs in a row is retired, rather than being handed the same jobs forever.
+        A speculative copy which couldn't be activated is dropped, leaving the straggler to carry on alone, and one whose
+        straggler has finished in the meantime is killed. A sub-job which couldn't be activated is handed back to the
+        job it was split from
+        
+        """
+        
+        freedSlots = []
+        
+        while not self._activationPool.results.empty():
+        
+            (job, vm, slot), returnValue, exception = self._activationPool.results.get()
+            self._activatingJobs.remove((job, vm, slot))
+            
+            original = self._activatingCopies.pop(job, None)
+            
+            splitting = job in self._activatingSplits
+            self._activatingSplits.discard(job)
+            
+            if vm in self._retiredVms:
+                print "job " + str(job.id) + " was being activated on " + vm.name + ", which has been retired, it will be run again"
+                if splitting and exception is not None:
+                    self.undoSplit(job)
+                elif original is None:
+                    self.requeueJob(job)
+                continue
+            
+            if exception is not None:
+                print "there was an error activating job " + str(job.id) + " on " + vm.name + ": " + str(exception)
+                if splitting:
+                    self.undoSplit(job)
+                elif original is None:
+                    self.requeueJob(job)
+                
+                self._activationFailures[vm] = self._activationFailures.get(vm, 0) + 1
+                
+                if self._activationFailures[vm] < self._maxActivationFailures:
+                    if vm in self._virtualMachines:
+                        freedSlots.append((vm, slot))
+                elif vm is self.headNode:
+                    warnings.warn("the head node has failed to activate " + str(self._activationFailures[vm]) + \
+                                  " jobs in a row, no more will be started on it")
+                else:
+                    print vm.name + " has failed to activate " + str(self._activationFailures[vm]) + " jobs in a row, retiring it"
+                    self.retireVirtualMachine(vm)
+                    
+                continue
+                
+            self._activationFailures[vm] = 0
+            
+            if original is not None and not original in self._activeJobs:
+                self.verbosePrint('job ' + str(original.id) + ' finished while its speculative copy was being started, killing the copy')
+                try:
+                    job.kill()
+                except:
+                    self.verbosePrint('could not kill job ' + str(job.id))
+                freedSlots.append((vm, slot))
+                continue
+                
+            if original is not None:
+                self._speculativeCopies[original] = job
+                
+            self._activeJobs.append(job)
+            self._lastSeenRunning[job] = time.time()
+            
+        return freedSlots
+        
+    def waitForActivations(self):
+        """Blocks until every job being activated has been dealt with
+        
+        """
+        
+        while len(self._activatingJobs) > 0:
+            self.collectActivations()
+            time.sleep(0.1)
+        
+    def updateJobs(self, sweep = True):
+        """Checks all of the active jobs for completion, and moves them to the completed queue,
+        before replacing them with one from the idle queue. Without a sweep, only the jobs which
+        the agents have already reported as finished are dealt with
+        
+        """
 
-        for jobToCheck in self._activeJobs:
+        if not self._htmlPath == None:
+            try:
+                self.updateHtml()
+            except:
+                print "there was an error writing the HTML page"
+                
+        if self._metrics is not None:
+            try:
+                self._metrics.writePrometheus()
+            except:
+                print "there was an error writing the metrics"
+                
+        if self._warmPool:
+            try:
+                self.refreshWarmPoolExpiry()
+            except sp.CalledProcessError:
+                print "there was an error pushing back when the warm pool expires"
+        
+        self.collectLaunches()
+        
+        freedSlots = self.collectDownloads() + self.collectActivations()
+        self.collectDeletions()
+        
+        activatingJobs = [activation[0] for activation in self._activatingJobs]
+        
+        statuses = {}
+        
+        if sweep:
+            try:
+                statuses = self.sweepJobStatuses()
+            except:
+                print "there was an error sweeping the job statuses through the head node, checking each job instead"
+                statuses = None
+                
+            if self._spot and statuses is not None:
+                for vm in self.detectEvictions(statuses):
+                    self.handleEviction(vm)
 
-            if jobToCheck.checkCompleted() == True:
-            
-                jobToCheck.postProcess()
-                availableVms.append(jobToCheck._vm)
-                self._completedJobs.append(jobToCheck)
+        for jobToCheck in list(self._activeJobs):
+        
+            if not jobToCheck in self._activeJobs:
+                #it lost a race which was settled earlier in the loop
+                continue
+        
+            if jobToCheck.state in ('completed', 'failed'):
+                finished = True
+                state, exitCode = jobToCheck.state, jobToCheck.exitCode
+            elif statuses is None:
+                finished = jobToCheck.checkCompleted() == True
+                state = None
                 
+                if finished:
+                    jobToCheck.setStatus('completed')
             else:
+                state, exitCode = statuses.get(jobToCheck.id, ('running', None))
+                finished = state in ('completed', 'failed')
+                
+                if finished:
+                    jobToCheck.setStatus(state, exitCode)
+                    
+            if not finished and jobToCheck.stopAt is not None and jobToCheck.progress >= jobToCheck.stopAt and \
+               not any(subJob in activatingJobs for subJob in jobToCheck.subJobs):
+                #the rest of its work has been split off, and is underway
+                self.verbosePrint('job ' + str(jobToCheck.id) + ' has reached the point it was split at, stopping it')
+                try:
+                    jobToCheck.kill()
+                except:
+                    self.verbosePrint('could not stop job ' + str(jobToCheck.id))
+                jobToCheck.setStatus('completed', 0)
+                finished = True
+                state = 'completed'
+
+            if finished and self.speculativePartner(jobToCheck) is not None:
             
-                remainingActiveJobs.append(jobToCheck)
+                #the first copy to succeed wins, and a copy which fails leaves the other to carry on
+                jobToCheck, freedSlot = self.resolveRace(jobToCheck, state != 'failed')
+                freedSlots.append(freedSlot)
                 
-        self._activeJobs = remainingActiveJobs
+                if state == 'failed':
+                    continue
 
-        if len(availableVms) > len(self._idleJobs):
-            while len(availableVms) > len(self._idleJobs):
-                availableVms[0].delete()
-                availableVms = availableVms[1:]
+            if finished and jobToCheck in self._lastSeenRunning:
+                self.observe('completionDetection', self._lastSeenRunning.pop(jobToCheck), job = jobToCheck.id)
+            elif not finished and (statuses is None or jobToCheck.id in statuses):
+                self._lastSeenRunning[jobToCheck] = time.time()
 
-        for vm in availableVms:
-        
-            vm.clean()
+            if finished:
+            
+                if state == 'failed':
+                    warnings.warn("job " + str(jobToCheck.id) + " failed with exit code " + str(exitCode))
+            
+                self._activeJobs.remove(jobToCheck)
+                self.queueDownload(jobToCheck)
+                
+        if self._jobTimeout is not None:
+            freedSlots += self.killTimedOutJobs()
+
+        #fill the slots on the busiest VMs first, so that whole VMs are freed up to be deleted
+        freedSlots.sort(key = lambda freedSlot: -self.nBusySlots(freedSlot[0]))
             
-        for vm in availableVms:
+        for vm, slot in freedSlots:
 
             if len(self._idleJobs) == 0:
                 
@@ -257,26 +1525,475 @@ class AzureJobManager(object):
              
             else:
 
-                self._activeJobs.append(self._idleJobs[0])
-                self._idleJobs[0].activate(vm)
-                self._idleJobs = self._idleJobs[1:]
+                self.startNextJob(vm, slot)
+                
+        if self._splitJobs and len(self._idleJobs) == 0:
+            self.splitWork()
+                
+        if self._speculate and len(self._idleJobs) == 0:
+            self.speculateOnStragglers()
+                
+        if self._autoscaler is not None:
+            self.autoscale()
+            return
+                
+        #delete the VMs with nothing left to do, but never the head node, since everything else is reached through it
+        for vm in set(vm for vm, slot in freedSlots):
+        
+            if self.nBusySlots(vm) == 0 and not vm is self.headNode:
+                self.deleteVirtualMachine(vm)
+                
+    def autoscale(self):
+        """Launches more VMs when the autoscaler's target is above the number there are, and releases the VMs with
+        nothing to do which aren't worth keeping. The head node is never released
+        
+        """
+        
+        durations = [job.runTime for job in self._completedJobs if job.runTime is not None]
+        jobDuration = np.median(durations) if len(durations) > 0 else self._autoscaler.defaultJobDuration
+        
+        slotsPerVm = np.mean([vm.nSlots for vm in self._virtualMachines]) if len(self._virtualMachines) > 0 else 1
+        
+        nWaitingJobs = len(self._idleJobs) + len(self._bootingJobs)
+        nRunningJobs = len(self._activatingJobs) - len(self._activatingCopies) + len(self._activeJobs) - len(self._speculativeCopies) + len(self._downloadingJobs)
+        
+        target = self._autoscaler.targetVirtualMachines(nWaitingJobs, nRunningJobs, jobDuration, slotsPerVm)
+        
+        nVirtualMachines = len(self._virtualMachines) + len(self._launchingVms)
+        
+        if len(self._idleJobs) > 0:
+        
+            nToLaunch = self._autoscaler.nToLaunch(target, nVirtualMachines)
+            
+            if nToLaunch > 0:
+                self.verbosePrint('scaling up from ' + str(nVirtualMachines) + ' towards ' + str(target) + ' VMs')
+            
+            for i in range(nToLaunch):
+                self.launchReplacement('to scale up')
+                
+        idleVms = [vm for vm in self._virtualMachines if self.nBusySlots(vm) == 0 and not vm is self.headNode]
+        
+        nToKeep = self._autoscaler.nToKeepIdle(self._nRequeues) if len(self._idleJobs) == 0 else len(idleVms)
+        
+        for vm in idleVms[nToKeep:]:
+        
+            if len(self._virtualMachines) + len(self._launchingVms) <= self._autoscaler.minVirtualMachines and len(self._idleJobs) + \
+               len(self._activeJobs) > 0:
+                break
+                
+            self.verbosePrint('releasing ' + vm.name + ', which is not expected to get any work soon')
+            self.deleteVirtualMachine(vm)
+            
+    def speculativePartner(self, job):
+        """The other copy of a job which is being raced, None if it isn't
+        
+        """
+        
+        if job in self._speculativeCopies:
+            return self._speculativeCopies[job]
+            
+        for original, speculativeCopy in self._speculativeCopies.items():
+            if speculativeCopy is job:
+                return original
+                
+        return None
+        
+    def resolveRace(self, job, jobWon):
+        """Settles the race between a job and its speculative copy, once job has either finished first (jobWon) or 
+        can't carry on. When jobWon, the other copy is killed. The speculative copy always leaves the active jobs: if
+        it's the one which carries on, the original takes over its run, so that only the original is ever downloaded
+        or journalled. Returns the original and the (vm, slot) which the losing copy leaves free
+        
+        """
+        
+        partner = self.speculativePartner(job)
+        
+        if job in self._speculativeCopies:
+            original, speculativeCopy = job, partner
+        else:
+            original, speculativeCopy = partner, job
+            
+        del self._speculativeCopies[original]
+        
+        loser = partner if jobWon else job
+        freedSlot = (loser.vm, loser.slot)
+        
+        if jobWon:
+            try:
+                loser.kill()
+            except:
+                self.verbosePrint('could not kill job ' + str(loser.id) + ', which lost a race')
+                
+        self._activeJobs.remove(speculativeCopy)
+            
+        if not loser is speculativeCopy:
+            self.verbosePrint('the speculative copy of job ' + str(original.id) + ' on ' + speculativeCopy.vm.name + ' won its race')
+            original.adopt(speculativeCopy)
+            self.record('jobActivated', job = original.id, vm = original.vm.name, slot = original.slot)
+            
+        return original, freedSlot
+        
+    def racingJobs(self):
+        """The jobs which are being raced, or whose speculative copies are being activated, and the copies themselves
+        
+        """
+        
+        return set(self._speculativeCopies.keys() + self._speculativeCopies.values() + \
+                   self._activatingCopies.keys() + self._activatingCopies.values())
+        
+    def findStragglers(self):
+        """The active jobs which are far behind their peers, slowest first. A job is compared with the rate at which
+        the others are getting through their binaries, when their progress is known, and otherwise with how long 
+        the jobs which have already finished took
+        
+        """
+        
+        racing = self.racingJobs()
+        
+        rates = [float(job.progress) / job.runTime for job in self._activeJobs if job.progress and job.runTime > 0]
+        medianRate = np.median(rates) if len(rates) > 1 else None
+        
+        durations = [job.runTime for job in self._completedJobs if job.runTime is not None]
+        medianDuration = np.median(durations) if len(durations) > 0 else None
+        
+        stragglers = []
+        
+        for job in self._activeJobs:
+        
+            if job in racing or job.stopAt is not None or job.runTime is None or job.runTime < self._minStragglerTime:
+                continue
+                
+            if job.progress is not None and medianRate is not None:
+                slowness = medianRate / max(float(job.progress) / job.runTime, 1e-9)
+            elif medianDuration is not None:
+                slowness = job.runTime / medianDuration
+            else:
+                continue
+                
+            if slowness > self._stragglerFactor:
+                stragglers.append((slowness, job))
+                
+        stragglers.sort(key = lambda straggler: -straggler[0])
+        
+        return [job for slowness, job in stragglers]
+        
+    def speculateOnStragglers(self):
+        """Races each straggler with a copy in a free slot on another VM, for as long as there are free slots. The
+        copies are activated in the background, and the race starts once they're collected
+        
+        """
+        
+        for job in self.findStragglers():
+        
+            freeSlots = [(vm, slot) for vm in self._virtualMachines if not vm is job.vm for slot in self.freeSlots(vm)]
+            
+            if len(freeSlots) == 0:
+                return
+                
+            vm, slot = freeSlots[0]
+            
+            speculativeCopy = job.speculativeCopy()
+            
+            self.verbosePrint('job ' + str(job.id) + ' is straggling after ' + str(int(job.runTime)) + ' seconds, racing it with a copy on ' + vm.name)
+            
+            self._activatingCopies[speculativeCopy] = job
+            self.startActivation(speculativeCopy, vm, slot)
+            
+    def splitWork(self):
+        """Fills the free slots by splitting the job with the most work left in two, half carrying on where it is and 
+        half starting as a sub-job in the free slot, for as long as there's a job worth splitting. The sub-jobs are
+        activated in the background, and the job isn't stopped at the split until its sub-job has started
+        
+        """
+        
+        racing = self.racingJobs()
+        
+        for vm in list(self._virtualMachines):
+        
+            for slot in self.freeSlots(vm):
+            
+                candidates = [job for job in self._activeJobs if not job in racing and job.canSplit() and \
+                              job.remainingWork() >= self._minWorkToSplit]
+                              
+                if len(candidates) == 0:
+                    return
+                    
+                job = max(candidates, key = lambda candidate: candidate.remainingWork())
+                
+                splitAt = job.progress + job.remainingWork() / 2
+                
+                subJob = job.split(splitAt)
+                
+                self.verbosePrint('splitting job ' + str(job.id) + ' at ' + str(splitAt) + ', running the rest as ' + str(subJob.id) + \
+                                  ' on ' + vm.name)
+                                  
+                self._nJobs += 1
+                self._activatingSplits.add(subJob)
+                self.startActivation(subJob, vm, slot)
+                
+    def undoSplit(self, subJob):
+        """Hands the work of a sub-job which couldn't be started back to the job it was split from
+        
+        """
+        
+        job = subJob.parentJob
+        
+        self.verbosePrint('could not start ' + str(subJob.id) + ', job ' + str(job.id) + ' will run to the end instead')
+        
+        job.cancelSplit(subJob)
+        self._nJobs -= 1
+        
+        #the job may have finished while its sub-job was being started
+        self.mergeSplitJob(job)
+        
+    def mergeSplitJob(self, job):
+        """Merges the outputs of the sub-jobs split off from a job once it and all of them are complete, then does the 
+        same for the job it was split from in turn. A job is only journalled as completed once it's been merged, so
+        that a resumed run still has the sub-jobs' outputs to merge into it
+        
+        """
+        
+        while job is not None and job in self._completedJobs and all(subJob in self._mergedJobs for subJob in job.subJobs):
+        
+            if len(job.subJobs) > 0:
+                job.mergeSubJobs()
+                
+            self._mergedJobs.add(job)
+            self.record('jobCompleted', job = job.id)
+            job = job.parentJob
+        
+    def killTimedOutJobs(self):
+        """Kills the jobs which have run for longer than jobTimeout, running them again up to maxRetries times before
+        giving up on them. Returns the (vm, slot) of each, which are now free
+        
+        """
+        
+        freedSlots = []
+        
+        for job in list(self._activeJobs):
+        
+            if not job in self._activeJobs or job.runTime is None or job.runTime < self._jobTimeout:
+                continue
+                
+            print "job " + str(job.id) + " has timed out after " + str(int(job.runTime)) + " seconds, killing it"
+                
+            try:
+                job.kill()
+            except:
+                self.verbosePrint('could not kill job ' + str(job.id))
+            
+            if self.speculativePartner(job) is not None:
+                #the other copy carries on, with its own time limit
+                original, freedSlot = self.resolveRace(job, False)
+                freedSlots.append(freedSlot)
+                continue
+                
+            freedSlots.append((job.vm, job.slot))
+            self._activeJobs.remove(job)
             
+            self.retryJob(job, 'timed out')
+                
+        return freedSlots
+        
+    def retryJob(self, job, reason):
+        """Puts a job which couldn't be seen through back in the idle queue, up to maxRetries times, before giving up
+        on it and counting it as failed
+        
+        """
+        
+        self._nRetries[job.id] = self._nRetries.get(job.id, 0) + 1
+        
+        if self._nRetries[job.id] <= self._maxRetries:
+            self.requeueJob(job)
+        else:
+            warnings.warn("job " + str(job.id) + " " + reason + " " + str(self._nRetries[job.id]) + " times, giving up on it")
+            job.setStatus('failed')
+            self.completeJob(job)
+            
+    def completeJob(self, job):
+        """Moves a job which has been seen through, or given up on, to the completed jobs, and merges the outputs of 
+        any split jobs which that finishes
+        
+        """
+        
+        self._completedJobs.append(job)
+        
+        try:
+            self.mergeSplitJob(job)
+        except:
+            print "there was an error merging the outputs of the jobs split off from job " + str(job.id)
+        
+    def queueDownload(self, job):
+        """Hands a finished job to the download workers, which fetch its outputs in the background. Its slot 
+        is only reused once that's done
+        
+        """
+        
+        self.record('jobFinished', job = job.id, state = job.state, exitCode = job.exitCode)
+        
+        self._downloadingJobs.append(job)
+        self._downloadStatus[job] = 'queued'
+        self._downloadPool.submit(job, self.downloadOutputs, job)
+        
+    def downloadOutputs(self, job):
+        """Run by the download workers. The download is tried up to maxDownloadAttempts times, raising the last
+        error if none of them work
+        
+        """
+        
+        for attempt in range(self._maxDownloadAttempts):
+        
+            self._downloadStatus[job] = 'downloading'
+            
+            start = time.time()
+            
+            try:
+                job.postProcess()
+                return
+            except:
+                if attempt == self._maxDownloadAttempts - 1:
+                    raise
+                self.verbosePrint('there was an error downloading the outputs of job ' + str(job.id) + ', trying again')
+                self._downloadStatus[job] = 'retrying'
+            finally:
+                self.observe('download', start, vm = job.vm.name, job = job.id)
+        
+    def collectDownloads(self):
+        """Moves the jobs whose downloads have finished to the completed queue, returning the (vm, slot) of each,
+        since those slots can now be reused
+        
+        """
+        
+        freedSlots = []
+        
+        while not self._downloadPool.results.empty():
+        
+            job, returnValue, exception = self._downloadPool.results.get()
+            
+            if exception is not None and job.vm in self._retiredVms:
+                #the outputs went with the VM
+                self._downloadingJobs.remove(job)
+                del self._downloadStatus[job]
+                self.requeueJob(job)
+                continue
+            
+            if exception is not None:
+                #the job is run again, rather than its slot being reused with its outputs only on the VM
+                print "there was an error downloading the outputs of job " + str(job.id) + ": " + str(exception)
+                self._downloadingJobs.remove(job)
+                del self._downloadStatus[job]
+                self.retryJob(job, 'could not have its outputs downloaded')
+                
+                freedSlots.append((job.vm, job.slot))
+                continue
+                
+            if job.transferStats is not None:
+                self.verbosePrint('downloaded ' + str(job.transferStats['bytesTransferred']) + ' bytes for job ' + str(job.id) + \
+                                  ', a compression ratio of ' + '%.2f' % job.transferStats['compressionRatio'])
+                
+            self._downloadingJobs.remove(job)
+            del self._downloadStatus[job]
+            
+            if self._metrics is not None and job.runTime is not None:
+                self._metrics.vmBusy(job.vm.name, job.runTime)
+            freedSlots.append((job.vm, job.slot))
+            
+            self.completeJob(job)
+            
+        return freedSlots
+        
+    def sweepJobStatuses(self):
+        """Asks the head node to check every active job at once, fanning out to the other VMs over the VNet,
+        so the whole sweep is a single round trip from here. Returns a dictionary mapping each job id to a
+        (state, exitCode) tuple, where state is 'running', 'completed', 'failed' or 'unreachable'
+        
+        """
+        
+        script = ''
+        
+        for i, job in enumerate(self._activeJobs):
+        
+            remoteCommand = job.vm.backend.peerExecCommand(job.vm, job.statusCommand())
+                            
+            script += '( status=$(' + remoteCommand + ' 2>/dev/null) || status=unreachable; echo "' + str(i) + ' $status" ) &\n'
+            
+            if (i + 1) % self._sweepParallelism == 0:
+                script += 'wait\n'
+                
+        script += 'wait\n'
+        
+        output = self.headNode.sendScript(script)
+        
+        statuses = {}
+        
+        for line in output.split('\n'):
+        
+            fields = line.split()
+            if len(fields) < 2:
+                continue
+                
+            job = self._activeJobs[int(fields[0])]
+            exitCode = int(fields[2]) if len(fields) > 2 else None
+            
+            if fields[1] == 'running':
+                #running jobs may report their progress instead
+                if exitCode is not None:
+                    job.updateProgress(exitCode)
+                exitCode = None
+            
+            statuses[job.id] = (fields[1], exitCode)
+            
+        return statuses
+        
     def cleanUp(self):
-        """Cleans up everything: currently simply deletes the resource group
+        """Cleans up everything: deletes the resource group, or with a warm pool, deallocates the VMs and marks when
+        the pool should be torn down if no other run picks it up
         
         """
         
-        command = 'az group delete --force --name ' + self._resourceGroupName
+        self.verbosePrint('the upload cache had ' + str(self.cacheHits) + ' hits and ' + str(self.cacheMisses) + ' misses')
+        
+        if self._eventMonitor is not None:
+            self._eventMonitor.stop()
+        
+        #let the VMs released during the run finish being deleted, or deallocated
+        while self._deletionPool.nPending > 0:
+            time.sleep(1)
         
-        sp.call(command,shell=True)
+        self.collectDeletions()
         
+        if self._warmPool:
+        
+            for vm in self._virtualMachines:
+                vm.deallocate()
+                
+            self.refreshWarmPoolExpiry(force = True)
+            
+        else:
+        
+            start = time.time()
+        
+            self._backend.deleteGroup(self._resourceGroupName)
+            
+            self.observe('teardown', start, resourceGroup = self._resourceGroupName)
+            
+        if self._metrics is not None:
+        
+            for vm in self._virtualMachines:
+                self._metrics.vmReleased(vm.name)
+                
+            self._metrics.writePrometheus()
+            
+        #so that running the same script again starts a new run rather than resuming this one
+        self.record('runFinished')
 
     def completed(self):
         """returns True if all of the jobs are completed
         
         """
         
-        assert len(self._idleJobs) + len(self._activeJobs) + len(self._completedJobs) == self._nJobs
+        assert len(self._idleJobs) + len(self._bootingJobs) + len(self._activatingJobs) - \
+               len(self._activatingCopies) + len(self._activeJobs) - len(self._speculativeCopies) + len(self._downloadingJobs) + len(self._completedJobs) == self._nJobs
         
         return len(self._completedJobs) == self._nJobs
      
@@ -300,11 +2017,25 @@ class AzureJobManager(object):
                 jobStatus = aJob.getStatusMessage()
             except:
                 jobStatus = 'Error getting job status'
-            jobVm = aJob._vm._privateIpAddress
+            jobVm = aJob._vm._privateIpAddress + ' slot ' + str(aJob.slot)
             jobOutputPath = aJob._outputPath
             
             runStatus.append((jobId,jobStatus,jobVm,jobOutputPath))
     
+        for dJob in self._downloadingJobs:
+        
+            jobId = str(dJob._id)
+            if self._downloadStatus.get(dJob) == 'downloading':
+                jobStatus = "downloading outputs"
+            elif self._downloadStatus.get(dJob) == 'retrying':
+                jobStatus = "retrying the download of the outputs"
+            else:
+                jobStatus = "outputs waiting to be downloaded"
+            jobVm = dJob._vm._privateIpAddress + ' slot ' + str(dJob.slot)
+            jobOutputPath = dJob._outputPath
+            
+            runStatus.append((jobId,jobStatus,jobVm,jobOutputPath))
+    
         for iJob in self._idleJobs:
         
             jobId = str(iJob._id)
@@ -330,7 +2061,9 @@ class AzureJobManager(object):
         templateVars = {
             "title" : "jobs running under resource group " + self._resourceGroupName,
             "pagetitle" : "jobs running under resource group " + self._resourceGroupName,
-            "runStatus" : runStatus
+            "runStatus" : runStatus,
+            "downloadSummary" : str(len(self._completedJobs)) + ' of ' + str(self._nJobs) + ' jobs downloaded, ' + \
+                                str(len(self._downloadingJobs)) + ' waiting or in progress'
         }
         
         html = template.render(templateVars)
@@ -1,8 +1,25 @@
 import numpy as np
+import os
+import hashlib
+import tarfile
+import copy
+import re
+import subprocess as sp
 from azureJob import AzureJob
+from jobEvents import agentPath, remoteAgentDirectory
+from virtualMachine import fileHash, findCachedFile
 
 class CompasJob(AzureJob):
 
+    #the files COMPAS writes which are brought back once it's finished
+    outputFiles = ['initialParameters.txt', 'mergingParameters.txt', 'formationHistory.txt']
+    
+    #the HDF5 output CompasAzure turns on, which is included when the outputs are compressed
+    hdf5Output = 'compasOutput.h5'
+    
+    #how the outputs are compressed on the VM, and the extension of the archive
+    compressionCommands = {'gzip' : ('gzip -1 -c', '.tar.gz'), 'zstd' : ('zstd -q -3 -c', '.tar.zst')}
+
     @property
     def id(self):
         """A unique identifier for the job, used when creating unique names etc
@@ -13,12 +30,65 @@ class CompasJob(AzureJob):
 
     @property
     def compasCommand(self):
-        """The string of the command line call to COMPAS for this particular job
+        """The string of the command line call to COMPAS for this particular job, or a list of them if 
+        the job is a bundle of several tasks
         
         """
         
         return self._compasCommand
         
+    @property
+    def isBundle(self):
+        """Whether the job runs a bundle of several COMPAS commands
+        
+        """
+        
+        return isinstance(self._compasCommand, list)
+        
+    @property
+    def runInParallel(self):
+        """Whether the commands in a bundle are run at the same time, rather than one after another
+        
+        """
+        
+        return self._runInParallel
+        
+    @property
+    def taskResults(self):
+        """For a bundle, a list with a dictionary for each command, giving its index in the bundle ('task'), the grid
+        point it belongs to ('gridPoint'), its exit code once known ('exitCode') and where its output goes ('outputPath')
+        
+        """
+        
+        results = []
+        
+        for k in range(len(self._compasCommand)):
+        
+            results.append({
+                'task' : k,
+                'gridPoint' : self._gridPoints[k] if self._gridPoints is not None else None,
+                'exitCode' : self._taskExitCodes.get(k),
+                'outputPath' : os.path.join(self._outputPath, 'task' + str(k))
+            })
+            
+        return results
+        
+    @property
+    def nBinaries(self):
+        """How many binaries the job simulates, None for a bundle or if the command doesn't say
+        
+        """
+        
+        return self.commandOption('--number-of-binaries')
+        
+    @property
+    def seed(self):
+        """The random seed COMPAS is given, None for a bundle or if the command doesn't say
+        
+        """
+        
+        return self.commandOption('--random-seed')
+        
     @property    
     def outputPath(self):
         """The path the where the output from this path should be stored
@@ -34,41 +104,168 @@ class CompasJob(AzureJob):
         """
         
         return self._compasPath
+        
+    @property
+    def compression(self):
+        """How the outputs are compressed before being downloaded: None to copy them as they are, or 'gzip' or 'zstd'
+        
+        """
+        
+        return self._compression
 
-    def initialise(self, ID, compasCommand, outputPath, compasPath):
+    def initialise(self, ID, compasCommand, outputPath, compasPath, gridPoints = None, runInParallel = False, compression = None):
+        """compasCommand may be a list of commands, which are run as a bundle in one job. Each command in a bundle
+        writes its output to its own task<k> directory, and gridPoints optionally gives the grid point of each.
+        If compression is given, the outputs are packed into one compressed archive on the VM, which is downloaded 
+        resumably and checked against its checksum
+        
+        """
+        
+        assert compression is None or compression in self.compressionCommands
     
         # add an extra command to make a text file when COMPAS finishes
         self._id = ID
         self._compasCommand = compasCommand  
         self._outputPath = outputPath
         self._compasPath = compasPath
+        self._gridPoints = gridPoints
+        self._runInParallel = runInParallel
+        self._taskExitCodes = {}
+        self._compression = compression
         
-    def activate(self, virtualMachine):
+    def jobScript(self):
+        """The bash script which runs the job on the VM, recording the exit code and writing completed.txt 
+        once it's finished. A bundle runs each command in its own task directory, recording the exit code of 
+        each in bundleStatus.txt, and exits with the first non-zero one
+        
+        """
+        
+        script = "cd ~/" + self.workingDirectory + "\n"
+        
+        if not self.isBundle:
+            script += self._compasCommand + " &>/dev/null\n"
+            script += "echo $? > exitCode.txt\n"
+            
+        else:
+            ending = " &\n" if self._runInParallel else "\n"
+            
+            for k, command in enumerate(self._compasCommand):
+                task = 'task' + str(k)
+                script += "(mkdir -p " + task + " && cd " + task + " && (" + command + ") &>/dev/null; echo " + str(k) + \
+                          " $? >> ../bundleStatus.txt)" + ending
+                          
+            script += "wait\n"
+            script += "code=$(awk '$2 != 0 {print $2; exit}' bundleStatus.txt)\n"
+            script += "echo ${code:-0} > exitCode.txt\n"
+        
+        script += "echo completed >> completed.txt\n"
+        
+        return script
+        
+    def progressFile(self):
+        """The file, or pattern matching the files, whose line count shows how far the job has got
+        
+        """
+        
+        if self.isBundle:
+            return self.workingDirectory + '/task*/initialParameters.txt'
+            
+        return self.workingDirectory + '/initialParameters.txt'
+        
+    def launchScript(self, agentTransport = None):
+        """The commands which set the slot up and start the job in the background, with the job script written
+        inline rather than uploaded. COMPAS and the agent are copied out of the VM's cache, so they must already be
+        there
+        
+        """
+        
+        workingDirectory = self.workingDirectory
+        compasName = os.path.basename(self._compasPath)
+        bashFileName = 'bashFile' + str(self._id) + '.bash'
+        
+        launchCommand = 'bash ' + workingDirectory + '/' + bashFileName
+        
+        if agentTransport is not None:
+            #run COMPAS under the agent, so that it pushes events to the manager
+            launchCommand = 'python ' + remoteAgentDirectory + '/jobAgent.py run --job-id ' + str(self._id) + ' --transport ' + \
+                            agentTransport + ' --progress-file "' + self.progressFile() + '" --exit-code-file ' + \
+                            workingDirectory + '/exitCode.txt -- ' + launchCommand
+        
+        #anything left in the slot, say by a VM reused from a warm pool, would confuse the status checks
+        script = "cd ~ && rm -rf " + workingDirectory + " && mkdir -p " + workingDirectory + " " + remoteAgentDirectory + "\n"
+        
+        #the executable is shared between the slots, so it's copied to a temporary name and moved into place, 
+        #rather than being written over while another slot is running it
+        script += findCachedFile(fileHash(self._compasPath)) + "cp $src " + compasName + ".$$ && chmod --reference=$src " + \
+                  compasName + ".$$ && mv " + compasName + ".$$ " + compasName + "\n"
+                  
+        if agentTransport is not None:
+            script += findCachedFile(fileHash(agentPath)) + "cp $src " + remoteAgentDirectory + "/jobAgent.py\n"
+            
+        script += "cat > " + workingDirectory + "/" + bashFileName + " <<'JOBSCRIPT'\n"
+        script += self.jobScript()
+        script += "JOBSCRIPT\n"
+        script += "setsid nohup " + launchCommand + " < /dev/null > /dev/null 2>&1 &\n"
+        script += "echo $! > " + workingDirectory + "/jobPid.txt\n"
+        
+        return script
+        
+    def activate(self, virtualMachine, slot = 0):
+        """Starts the job in a single round trip, streaming the script which sets the slot up and launches the job, and 
+        keeping the PID it prints. Only the first job on a VM has to put COMPAS and the agent into its cache
+        
+        """
     
         self._vm = virtualMachine
+        self._slot = slot
         
-        self._vm.uploadFile(self._compasPath)
+        self._vm.ensureCached(self._compasPath)
         
-        bashFileName = 'bashFile' + str(self._id) + '.bash'
-        f = open(bashFileName,'w')
-        f.write(self._compasCommand)
-        f.write(" &>/dev/null\n")
-        f.write("echo completed >> completed.txt\n")
-        f.close()
-        
-        self._vm.uploadFile(bashFileName)
-        self._vm.sendCommand("chmod 744 " + bashFileName)
-        
-        pythonFileName = 'pythonFile' + str(self._id) + '.py'
-        f = open(pythonFileName,'w')
-        f.write("import subprocess\n")
-        f.write("subprocess.Popen([\"bash\",\"" + bashFileName + "\"],")
-        f.write("stdin=None, stdout=None, stderr=None, close_fds=True)\n")
-        f.close() 
-        
-        self._vm.uploadFile(pythonFileName)
-
-        self._vm.sendCommand('python ' + pythonFileName,waitToComplete=False)
+        if self._vm.agentTransport is not None:
+            self._vm.ensureCached(agentPath)
+        
+        output = self._vm.sendScript(self.launchScript(self._vm.agentTransport) + "echo $!\n")
+        
+        self._pid = int(output.split()[-1])
+        
+        self.setStatus('running')
+        
+    def bootScript(self, virtualMachine, slot = 0):
+        """Starts the job without any SSH round trips, taking COMPAS and the agent from the files baked into the VM's
+        image. cloud-init runs it as root, so the job itself is run as the admin user
+        
+        """
+    
+        self._slot = slot
+        
+        script = "#!/bin/bash\n"
+        script += "su - " + virtualMachine.vmOptions['--admin-username'] + " <<'AZUREJOBMANAGER'\n"
+        script += self.launchScript(virtualMachine.agentTransport)
+        script += "AZUREJOBMANAGER\n"
+        
+        return script
+        
+    def kill(self):
+        """Jobs started on boot, or picked up again after a restart, don't know their PID, so it's read from the slot
+        
+        """
+        
+        if self._pid is None:
+            output = self._vm.sendCommand('cat ~/' + self.workingDirectory + '/jobPid.txt 2>/dev/null; true')
+            if len(output.split()) > 0:
+                self._pid = int(output.split()[0])
+                
+        AzureJob.kill(self)
+        
+    def speculativeCopy(self):
+    
+        job = copy.copy(self)
+        AzureJob.__init__(job)
+        
+        job._id = str(self._id) + 'copy'
+        job._taskExitCodes = {}
+        
+        return job
         
     def checkCompleted(self):
         """check if the 'completed.txt exists and contains the word completed
@@ -76,7 +273,7 @@ class CompasJob(AzureJob):
         """
         
         try:
-            self._vm.getFile('~/completed.txt',self._outputPath)
+            self._vm.getFile('~/' + self.workingDirectory + '/completed.txt',self._outputPath)
             
             f = open(self._outputPath +'/completed.txt')
             f.close()
@@ -90,17 +287,240 @@ class CompasJob(AzureJob):
         
         return False
         
+    def statusCommand(self):
+        """reports the exit code written alongside completed.txt once COMPAS has finished, or how many binaries 
+        it has simulated so far. A job whose process has gone without writing completed.txt, say because it was
+        killed for running out of memory, has failed, with an exit code of -1
+        
+        """
+    
+        directory = '~/' + self.workingDirectory
+        
+        #completed.txt is checked again once the process has gone, in case the job finished in between
+        finished = '[ -f ' + directory + '/completed.txt ]'
+        died = '[ -f ' + directory + '/jobPid.txt ] && ! kill -0 $(cat ' + directory + '/jobPid.txt) 2>/dev/null && ! ' + finished
+    
+        return 'if ' + finished + '; then code=$(cat ' + directory + '/exitCode.txt 2>/dev/null || echo 0); ' + \
+                'if [ "$code" == "0" ]; then echo completed $code; else echo failed $code; fi; ' + \
+                'elif ' + died + '; then echo failed -1; ' + \
+                'else echo running $(cat ' + self.progressFile() + ' 2>/dev/null | wc -l); fi'
+        
     def postProcess(self):
     
-       self._vm.getFile('~/initialParameters.txt', self._outputPath)
-       self._vm.getFile('~/mergingParameters.txt', self._outputPath)
-       self._vm.getFile('~/formationHistory.txt', self._outputPath)
+       directory = '~/' + self.workingDirectory
        
-    def getStatusMessage(self):
+       if self._compression is not None:
+           self.downloadCompressedOutputs()
+       
+       elif not self.isBundle:
+           for outputFile in self.outputFiles:
+               self._vm.getFile(directory + '/' + outputFile, self._outputPath)
+               
+       else:
+           self._vm.getFile(directory + '/bundleStatus.txt', self._outputPath)
+           
+           for result in self.taskResults:
+               if not os.path.isdir(result['outputPath']):
+                   os.makedirs(result['outputPath'])
+               for outputFile in self.outputFiles:
+                   self._vm.getFile(directory + '/task' + str(result['task']) + '/' + outputFile, result['outputPath'])
+                   
+       if self.isBundle:
+           try:
+               for line in open(os.path.join(self._outputPath, 'bundleStatus.txt')):
+                   k, exitCode = line.split()
+                   self._taskExitCodes[int(k)] = int(exitCode)
+           except IOError:
+               pass
+               
+    def downloadCompressedOutputs(self):
+        """Packs the outputs into a compressed archive on the VM, downloads it, resuming if the transfer drops,
+        checks its checksum and unpacks it into the output path. If the checksum still doesn't match after downloading
+        it again, IOError is raised and the outputs are left on the VM, for the manager to try again
+        
+        """
+        
+        compressCommand, extension = self.compressionCommands[self._compression]
+        archiveName = 'outputs' + extension
+        
+        if self.isBundle:
+            patterns = ['bundleStatus.txt'] + ['task*/' + outputFile for outputFile in self.outputFiles + [self.hdf5Output]]
+        else:
+            patterns = self.outputFiles + [self.hdf5Output]
+        
+        #prints the uncompressed size, the archive size and its checksum
+        output = self._vm.sendCommand('cd ~/' + self.workingDirectory + ' && files=$(ls -d ' + ' '.join(patterns) + ' 2>/dev/null; true) && ' + \
+                                      'tar -cf - $files | ' + compressCommand + ' > ' + archiveName + ' && du -cb $files | tail -n 1 | cut -f 1 && ' + \
+                                      'stat -c %s ' + archiveName + ' && sha256sum ' + archiveName + ' | cut -d " " -f 1')
+                                      
+        uncompressedSize, archiveSize, checksum = output.split()
+        uncompressedSize = int(uncompressedSize)
+        archiveSize = int(archiveSize)
+        
+        localArchive = os.path.join(self._outputPath, archiveName)
+        remoteArchive = '~/' + self.workingDirectory + '/' + archiveName
+        
+        if os.path.exists(localArchive):
+            os.remove(localArchive)
+        
+        self._vm.getFileResumable(remoteArchive, localArchive, archiveSize)
+        
+        if self.fileChecksum(localArchive) != checksum:
+            #start again from scratch, once
+            self._vm.verbosePrint('the checksum of the outputs of job ' + str(self._id) + ' did not match, downloading again')
+            os.remove(localArchive)
+            self._vm.getFileResumable(remoteArchive, localArchive, archiveSize)
+            
+            if self.fileChecksum(localArchive) != checksum:
+                os.remove(localArchive)
+                raise IOError('the outputs of job ' + str(self._id) + ' were corrupted in transfer')
+                
+        if self._compression == 'gzip':
+            archive = tarfile.open(localArchive, 'r:gz')
+            archive.extractall(self._outputPath)
+            archive.close()
+        else:
+            sp.check_call('zstd -q -d -c ' + localArchive + ' | tar -xf - -C ' + self._outputPath, shell=True)
+            
+        os.remove(localArchive)
+        
+        self._transferStats = {
+            'bytesTransferred' : archiveSize,
+            'uncompressedBytes' : uncompressedSize,
+            'compressionRatio' : float(uncompressedSize) / max(1, archiveSize)
+        }
+        
+    def fileChecksum(self, path):
+    
+        sha256 = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                sha256.update(chunk)
+                
+        return sha256.hexdigest()
+       
+    def commandOption(self, option):
+    
+        if self.isBundle:
+            return None
+            
+        match = re.search(option + r' (\d+)', self._compasCommand)
+        
+        return int(match.group(1)) if match is not None else None
+        
+    def sampleCommand(self, nBinaries):
+        """The job's command cut down to nBinaries binaries, for timing it
+        
+        """
+        
+        assert not self.isBundle and self.nBinaries is not None, "only single commands giving the number of binaries can be sampled"
+        
+        return re.sub(r'--number-of-binaries \d+', '--number-of-binaries ' + str(nBinaries), self._compasCommand)
+        
+    def derivedSeed(self, k):
+        """The seed of the k'th sub-job split off from this one, which is derived from this job's seed so that a rerun
+        splitting the same way simulates the same binaries
+        
+        """
+        
+        return int(hashlib.sha1(str(self.seed) + ':' + str(k)).hexdigest(), 16) % 2**31
+        
+    def canSplit(self):
+        """Only single COMPAS commands which give the number of binaries and the seed can be split, and only once
+        they've reported how far they've got. The progress count is taken as the number of binaries simulated
+        
+        """
+        
+        return not self.isBundle and self._stopAt is None and self._progress is not None and \
+               self.nBinaries is not None and self.seed is not None
+               
+    def remainingWork(self):
     
-        op = self._vm.sendCommand('wc -l initialParameters.txt',waitToComplete=True)
+        if self.isBundle or self._progress is None or self.nBinaries is None:
+            return None
+            
+        end = self._stopAt if self._stopAt is not None else self.nBinaries
+            
+        return max(0, end - self._progress)
+        
+    def split(self, splitAt):
+        """The sub-job simulates the binaries after the first splitAt with its own seed, writing its outputs to a 
+        split<k> directory under this job's output path. If this job runs past splitAt before it's stopped, the
+        extra binaries are kept
+        
+        """
+        
+        k = len(self._subJobs)
+        
+        command = re.sub(r'--number-of-binaries \d+', '--number-of-binaries ' + str(self.nBinaries - splitAt), self._compasCommand)
+        command = re.sub(r'--random-seed \d+', '--random-seed ' + str(self.derivedSeed(k)), command)
+        
+        outputPath = os.path.join(self._outputPath, 'split' + str(k))
+        
+        if not os.path.isdir(outputPath):
+            os.makedirs(outputPath)
+        
+        subJob = CompasJob()
+        subJob.initialise(str(self._id) + 'split' + str(k), command, outputPath, self._compasPath, compression = self._compression)
+        subJob._parentJob = self
         
-        nBinsSimulated = str(op.split(' ')[0])
+        self._subJobs.append(subJob)
+        self._stopAt = splitAt
+        
+        return subJob
+        
+    def mergeSubJobs(self):
+        """Appends the rows of each sub-job's output files onto this job's, leaving out the header lines, so that the
+        grid point ends up with one set of outputs. A row left half written when the job was stopped is dropped.
+        The HDF5 outputs of the sub-jobs are left in their own directories
+        
+        """
+        
+        for outputFile in self.outputFiles:
+        
+            path = os.path.join(self._outputPath, outputFile)
+            
+            if not os.path.exists(path):
+                continue
+                
+            with open(path) as f:
+                lines = f.readlines()
+                
+            if len(lines) > 0 and not lines[-1].endswith('\n'):
+                lines = lines[:-1]
+                
+            nRows = len(lines)
+                
+            for subJob in self._subJobs:
+            
+                subPath = os.path.join(subJob.outputPath, outputFile)
+                
+                if not os.path.exists(subPath):
+                    continue
+                    
+                with open(subPath) as f:
+                    subLines = f.readlines()
+                    
+                #the header is whatever the files start with in common
+                nHeaderLines = 0
+                while nHeaderLines < min(len(lines), len(subLines)) and lines[nHeaderLines] == subLines[nHeaderLines]:
+                    nHeaderLines += 1
+                    
+                lines += subLines[nHeaderLines:]
+                
+            with open(path, 'w') as f:
+                f.writelines(lines)
+                
+            self._vm.verbosePrint('merged ' + str(len(lines) - nRows) + ' rows from sub-jobs into ' + path)
+        
+    def getStatusMessage(self):
+    
+        if self._progress is not None:
+            nBinsSimulated = str(self._progress)
+        else:
+            op = self._vm.sendCommand('cat ' + self.progressFile() + ' | wc -l',waitToComplete=True)
+            
+            nBinsSimulated = str(op.split()[0])
         
         return 'simulated ' + nBinsSimulated + ' binaries'
          
@@ -0,0 +1,519 @@
+import subprocess as sp
+import os
+import shutil
+import pipes
+import tempfile
+import signal
+import shellCommands
+
+#the options used for ssh and scp from one VM to another over the VNet
+peerSshOptions = '-o StrictHostKeyChecking=no -o BatchMode=yes -o ConnectTimeout=20'
+
+def killProcesses(directory):
+    """Kills whatever is running with its working directory inside the directory, as a real VM's processes go when
+    it does
+
+    """
+
+    directory = os.path.realpath(directory)
+
+    for pid in os.listdir('/proc'):
+
+        if not pid.isdigit() or int(pid) == os.getpid():
+            continue
+
+        try:
+            cwd = os.readlink(os.path.join('/proc', pid, 'cwd'))
+        except OSError:
+            continue
+
+        #as it reads once the directory has been removed
+        if cwd.endswith(' (deleted)'):
+            cwd = cwd[:-len(' (deleted)')]
+
+        if cwd == directory or cwd.startswith(directory + '/'):
+            try:
+                os.kill(int(pid), signal.SIGKILL)
+            except OSError:
+                pass
+
+class ComputeBackend(object):
+    """Where the VMs come from and how commands and files reach them. VirtualMachine and AzureJobManager go through a
+    backend for all of this, so the same scheduling code runs against Azure or against directories on this machine.
+
+    Methods which make, start or get rid of VMs and resource groups run their commands, raising sp.CalledProcessError
+    if they fail. The exec, put and get methods instead return the shell command which does the work, so that
+    VirtualMachine can put time limits on it, cancel it and retry it
+
+    """
+
+    def makeGroup(self, resourceGroup):
+
+        raise NotImplementedError("This is the base class, you should have implemented the makeGroup() method")
+
+    def deleteGroup(self, resourceGroup, wait = True):
+
+        raise NotImplementedError("This is the base class, you should have implemented the deleteGroup() method")
+
+    def groupTag(self, resourceGroup, tag):
+        """The value of a tag on the resource group, None if it isn't set, or if there's no such group
+
+        """
+
+        raise NotImplementedError("This is the base class, you should have implemented the groupTag() method")
+
+    def setGroupTag(self, resourceGroup, tag, value):
+        """Sets a tag on the resource group, or removes it if value is None
+
+        """
+
+        raise NotImplementedError("This is the base class, you should have implemented the setGroupTag() method")
+
+    def taggedGroups(self, tag):
+        """A list of (resourceGroup, value) for every resource group with the tag
+
+        """
+
+        raise NotImplementedError("This is the base class, you should have implemented the taggedGroups() method")
+
+    def listVirtualMachines(self, resourceGroup, running = False):
+        """The names of the VMs in the resource group, only those which are running if running is True
+
+        """
+
+        raise NotImplementedError("This is the base class, you should have implemented the listVirtualMachines() method")
+
+    def provision(self, vm, headNodeIp = None, customData = None):
+        """Makes the VM, returning its (privateIp, publicIp). Workers are reached through the head node's public IP
+
+        """
+
+        raise NotImplementedError("This is the base class, you should have implemented the provision() method")
+
+    def start(self, vm, headNodeIp = None):
+        """Starts a deallocated VM, returning its (privateIp, publicIp)
+
+        """
+
+        raise NotImplementedError("This is the base class, you should have implemented the start() method")
+
+    def deallocate(self, vm):
+
+        raise NotImplementedError("This is the base class, you should have implemented the deallocate() method")
+
+    def delete(self, vm):
+
+        raise NotImplementedError("This is the base class, you should have implemented the delete() method")
+
+    def installClusterKeys(self, headNode, publicKeyPath, privateKeyPath):
+        """Gives the head node what it needs to reach the other VMs itself
+
+        """
+
+        raise NotImplementedError("This is the base class, you should have implemented the installClusterKeys() method")
+
+    def execCommand(self, vm, command):
+        """The shell command which runs command on the VM
+
+        """
+
+        raise NotImplementedError("This is the base class, you should have implemented the execCommand() method")
+
+    def putCommand(self, vm, localPath, remotePath):
+        """The shell command which copies a local file to the VM
+
+        """
+
+        raise NotImplementedError("This is the base class, you should have implemented the putCommand() method")
+
+    def getCommand(self, vm, remotePath, localPath):
+        """The shell command which copies a file from the VM to here
+
+        """
+
+        raise NotImplementedError("This is the base class, you should have implemented the getCommand() method")
+
+    def peerExecCommand(self, vm, command):
+        """The shell command which, run on another VM of the cluster, runs command on this one
+
+        """
+
+        raise NotImplementedError("This is the base class, you should have implemented the peerExecCommand() method")
+
+    def peerPutCommand(self, vm, sourcePath, remotePath):
+        """The shell command which, run on another VM of the cluster, copies sourcePath there to remotePath on this one
+
+        """
+
+        raise NotImplementedError("This is the base class, you should have implemented the peerPutCommand() method")
+
+    def ensureConnected(self, vm):
+        """Makes sure commands can reach the VM, reconnecting if need be
+
+        """
+
+        pass
+
+    def isAlive(self, vm):
+        """Whether the connection to the VM is still up
+
+        """
+
+        return True
+
+    def reconnect(self, vm):
+
+        pass
+
+    def disconnect(self, vm):
+
+        pass
+
+class AzureBackend(ComputeBackend):
+    """VMs made with the Azure CLI, reached over SSH. The head node has the cluster's public IP address, and the other
+    VMs are reached through it
+
+    """
+
+    @property
+    def location(self):
+        """The Azure region the resource groups are made in
+
+        """
+
+        return self._location
+
+    @property
+    def commandTimeout(self):
+        """The time limit, in seconds, on the az commands which only look things up or tag them
+
+        """
+
+        return self._commandTimeout
+
+    @property
+    def provisionTimeout(self):
+        """The time limit, in seconds, on the az commands which make or get rid of resource groups
+
+        """
+
+        return self._provisionTimeout
+
+    def __init__(self, location = 'centralus', commandTimeout = 600, provisionTimeout = 1800):
+
+        self._location = location
+        self._commandTimeout = commandTimeout
+        self._provisionTimeout = provisionTimeout
+
+    def makeGroup(self, resourceGroup):
+
+        shellCommands.call('az group create --name ' + resourceGroup + ' -l ' + self._location, self._provisionTimeout)
+
+    def deleteGroup(self, resourceGroup, wait = True):
+
+        shellCommands.call('az group delete --yes ' + ('' if wait else '--no-wait ') + '--name ' + resourceGroup, self._provisionTimeout)
+
+    def groupTag(self, resourceGroup, tag):
+
+        command = 'az group show --name ' + resourceGroup + ' --query tags.' + tag + ' -o tsv'
+
+        try:
+            value = shellCommands.checkOutput(command, self._commandTimeout).strip()
+        except sp.CalledProcessError:
+            #there's no such resource group, or it couldn't be looked up
+            return None
+
+        return value if len(value) > 0 else None
+
+    def setGroupTag(self, resourceGroup, tag, value):
+
+        if value is None:
+            shellCommands.call('az group update --name ' + resourceGroup + ' --remove tags.' + tag, self._commandTimeout)
+        else:
+            shellCommands.call('az group update --name ' + resourceGroup + ' --set tags.' + tag + '=' + str(value), self._commandTimeout)
+
+    def taggedGroups(self, tag):
+
+        output = shellCommands.checkOutput('az group list --query "[?tags.' + tag + '].[name, tags.' + tag + ']" -o tsv', self._commandTimeout)
+
+        return [tuple(line.split()) for line in output.split('\n') if len(line.split()) == 2]
+
+    def listVirtualMachines(self, resourceGroup, running = False):
+
+        if running:
+            command = 'az vm list -d --resource-group ' + resourceGroup + ' --query "[?powerState==\'VM running\'].name" -o tsv'
+        else:
+            command = 'az vm list --resource-group ' + resourceGroup + ' --query "[].name" -o tsv'
+
+        return shellCommands.checkOutput(command, self._commandTimeout).split()
+
+    def provision(self, vm, headNodeIp = None, customData = None):
+
+        customDataPath = None
+
+        try:
+            command = 'az vm create '
+            for key in vm.vmOptions.keys():
+                command += key + ' ' + vm.vmOptions[key] + ' '
+
+            if customData is not None:
+                customDataFile = tempfile.NamedTemporaryFile(prefix = vm.name, suffix = '.sh', delete = False)
+                customDataFile.write(customData)
+                customDataFile.close()
+                customDataPath = customDataFile.name
+                command += '--custom-data ' + customDataPath + ' '
+
+            vmDetails = shellCommands.checkOutput(command, vm.provisionTimeout, runningCommands = vm.runningCommands)
+
+        finally:
+
+            if customDataPath is not None:
+                os.remove(customDataPath)
+
+        privateIp = None
+        publicIp = headNodeIp
+
+        for line in vmDetails.split('\n'):
+            if 'privateIpAddress' in line:
+                privateIp = line.split('"')[3]
+            if 'publicIpAddress' in line and headNodeIp == None:
+                publicIp = line.split('"')[3]
+
+        return privateIp, publicIp
+
+    def start(self, vm, headNodeIp = None):
+
+        command = 'az vm start --name ' + vm.name + ' --resource-group ' + vm.resourceGroup
+
+        vm.verbosePrint('starting a VM from the warm pool with command:\n' + command)
+
+        shellCommands.checkOutput(command, vm.provisionTimeout, runningCommands = vm.runningCommands)
+
+        command = 'az vm show -d --name ' + vm.name + ' --resource-group ' + vm.resourceGroup + ' --query "[privateIps, publicIps]" -o tsv'
+        addresses = shellCommands.checkOutput(command, vm.commandTimeout, runningCommands = vm.runningCommands).split()
+
+        return addresses[0], (addresses[1] if headNodeIp == None else headNodeIp)
+
+    def deallocate(self, vm):
+
+        command = 'az vm deallocate --no-wait --name ' + vm.name + ' --resource-group ' + vm.resourceGroup
+
+        shellCommands.call(command, vm.provisionTimeout)
+
+    def delete(self, vm):
+
+        command = 'az vm delete --force --name ' + vm.name + ' --resource-group ' + vm.resourceGroup
+
+        shellCommands.call(command, vm.provisionTimeout)
+
+    def installClusterKeys(self, headNode, publicKeyPath, privateKeyPath):
+
+        for keyPath in [publicKeyPath, privateKeyPath]:
+            command = 'scp -o  StrictHostKeyChecking=no ' + keyPath + ' ' + headNode.vmOptions['--admin-username'] + '@' + \
+                      headNode.publicIpAddress + ':.ssh/.'
+            shellCommands.call(command, headNode.commandTimeout, runningCommands = headNode.runningCommands)
+
+    def execCommand(self, vm, command):
+
+        return vm.connection.sshCommand(command)
+
+    def putCommand(self, vm, localPath, remotePath):
+
+        return vm.connection.uploadCommand(localPath, remotePath)
+
+    def getCommand(self, vm, remotePath, localPath):
+
+        return vm.connection.downloadCommand(remotePath, localPath)
+
+    def peerTarget(self, vm):
+
+        return vm.vmOptions['--admin-username'] + '@' + vm.privateIpAddress
+
+    def peerExecCommand(self, vm, command):
+
+        return 'ssh ' + peerSshOptions + ' ' + self.peerTarget(vm) + ' \'' + command + '\''
+
+    def peerPutCommand(self, vm, sourcePath, remotePath):
+
+        return 'scp -q -p ' + peerSshOptions + ' ' + sourcePath + ' ' + self.peerTarget(vm) + ':' + remotePath
+
+    def ensureConnected(self, vm):
+
+        vm.connection.ensureConnected()
+
+    def isAlive(self, vm):
+
+        return vm.connection.isAlive()
+
+    def reconnect(self, vm):
+
+        vm.connection.reconnect()
+
+    def disconnect(self, vm):
+
+        vm.connection.close()
+
+class LocalBackend(ComputeBackend):
+    """Each "VM" is a directory on this machine, which is its home directory, and its commands are subprocesses run
+    there. The whole of AzureJobManager runs unchanged on top of it, so a grid can be run on one many-core machine, and
+    changes to the scheduler can be tried out and benchmarked without Azure. Every VM sees all of this machine's cores,
+    so either use a single VM with slotsPerVm = 'auto', or several with a fixed number of slots between them.
+
+    Resource groups are directories under rootDirectory, and their tags are files. Worker images and custom data are
+    Azure only. Spot VMs are never evicted by the backend itself, but deleting one's directory drops it out of the
+    running VMs, as an eviction would
+
+    """
+
+    @property
+    def rootDirectory(self):
+        """The directory the resource groups are made in
+
+        """
+
+        return self._rootDirectory
+
+    def __init__(self, rootDirectory = '~/.azureJobManager/local'):
+
+        self._rootDirectory = os.path.abspath(os.path.expanduser(rootDirectory))
+
+    def groupDirectory(self, resourceGroup):
+
+        return os.path.join(self._rootDirectory, resourceGroup)
+
+    def vmDirectory(self, vm):
+        """The VM's home directory
+
+        """
+
+        return os.path.join(self.groupDirectory(vm.resourceGroup), vm.name)
+
+    def tagPath(self, resourceGroup, tag):
+
+        return os.path.join(self.groupDirectory(resourceGroup), '.tags', tag)
+
+    def makeGroup(self, resourceGroup):
+
+        if not os.path.isdir(self.groupDirectory(resourceGroup)):
+            os.makedirs(self.groupDirectory(resourceGroup))
+
+    def deleteGroup(self, resourceGroup, wait = True):
+
+        killProcesses(self.groupDirectory(resourceGroup))
+
+        shutil.rmtree(self.groupDirectory(resourceGroup), ignore_errors = True)
+
+    def groupTag(self, resourceGroup, tag):
+
+        if not os.path.exists(self.tagPath(resourceGroup, tag)):
+            return None
+
+        with open(self.tagPath(resourceGroup, tag)) as f:
+            return f.read().strip()
+
+    def setGroupTag(self, resourceGroup, tag, value):
+
+        tagPath = self.tagPath(resourceGroup, tag)
+
+        if value is None:
+            if os.path.exists(tagPath):
+                os.remove(tagPath)
+            return
+
+        if not os.path.isdir(os.path.dirname(tagPath)):
+            os.makedirs(os.path.dirname(tagPath))
+
+        with open(tagPath, 'w') as f:
+            f.write(str(value))
+
+    def taggedGroups(self, tag):
+
+        if not os.path.isdir(self._rootDirectory):
+            return []
+
+        return [(resourceGroup, self.groupTag(resourceGroup, tag)) for resourceGroup in sorted(os.listdir(self._rootDirectory)) \
+                if self.groupTag(resourceGroup, tag) is not None]
+
+    def listVirtualMachines(self, resourceGroup, running = False):
+
+        groupDirectory = self.groupDirectory(resourceGroup)
+
+        if not os.path.isdir(groupDirectory):
+            return []
+
+        names = [name for name in sorted(os.listdir(groupDirectory)) if not name.startswith('.')]
+
+        if running:
+            #a deallocated VM leaves a marker in its home directory
+            names = [name for name in names if not os.path.exists(os.path.join(groupDirectory, name, '.deallocated'))]
+
+        return names
+
+    def provision(self, vm, headNodeIp = None, customData = None):
+
+        if customData is not None:
+            raise sp.CalledProcessError(1, 'provision ' + vm.name, 'local VMs cannot run custom data')
+
+        if not os.path.isdir(self.vmDirectory(vm)):
+            os.makedirs(self.vmDirectory(vm))
+
+        return '127.0.0.1', '127.0.0.1'
+
+    def start(self, vm, headNodeIp = None):
+
+        deallocatedPath = os.path.join(self.vmDirectory(vm), '.deallocated')
+
+        if os.path.exists(deallocatedPath):
+            os.remove(deallocatedPath)
+
+        return self.provision(vm, headNodeIp)
+
+    def deallocate(self, vm):
+
+        killProcesses(self.vmDirectory(vm))
+
+        if os.path.isdir(self.vmDirectory(vm)):
+            open(os.path.join(self.vmDirectory(vm), '.deallocated'), 'w').close()
+
+    def delete(self, vm):
+
+        killProcesses(self.vmDirectory(vm))
+
+        shutil.rmtree(self.vmDirectory(vm), ignore_errors = True)
+
+    def installClusterKeys(self, headNode, publicKeyPath, privateKeyPath):
+
+        #the VMs reach each other through the filesystem
+        pass
+
+    def remotePath(self, vm, remotePath):
+        """Where a path on the VM is on this machine. Relative paths, and those starting with ~, are in its home directory
+
+        """
+
+        if remotePath == '~' or remotePath.startswith('~/'):
+            remotePath = remotePath[2:]
+
+        return os.path.join(self.vmDirectory(vm), remotePath)
+
+    def execCommand(self, vm, command):
+
+        vmDirectory = pipes.quote(self.vmDirectory(vm))
+
+        return 'cd ' + vmDirectory + ' && HOME=' + vmDirectory + ' bash -c ' + pipes.quote(command)
+
+    def putCommand(self, vm, localPath, remotePath):
+
+        return 'cp -p ' + localPath + ' ' + self.remotePath(vm, remotePath)
+
+    def getCommand(self, vm, remotePath, localPath):
+
+        return 'cp -p ' + self.remotePath(vm, remotePath) + ' ' + localPath
+
+    def peerExecCommand(self, vm, command):
+
+        return '(' + self.execCommand(vm, command) + ')'
+
+    def peerPutCommand(self, vm, sourcePath, remotePath):
+
+        return 'cp -p ' + sourcePath + ' ' + self.remotePath(vm, remotePath)
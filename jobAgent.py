@@ -0,0 +1,187 @@
+"""A small agent which runs alongside jobs on the VMs. It has two modes:
+
+    python jobAgent.py run --job-id ID --transport TRANSPORT [--heartbeat SECONDS] [--progress-file PATH] -- COMMAND...
+
+runs COMMAND, pushing start, heartbeat, progress and exit events for the job to TRANSPORT, and
+
+    python jobAgent.py listen --port PORT --output PATH [--pid-file PATH]
+
+runs on the head node, appending every event it receives to PATH, one JSON object per line, where the manager
+picks them up, and writing its process id to the pid file, so that it can be stopped without touching anyone else's. TRANSPORT is either tcp:HOST:PORT, to send events to a listener, or file:PATH, to append them
+straight to a file, which is the local stand-in used for testing without Azure.
+
+This file is copied onto the VMs and only uses the standard library.
+
+"""
+
+import sys
+import os
+import time
+import json
+import socket
+import subprocess
+import argparse
+import glob
+
+def countLines(pattern):
+    """The total number of lines in the files matching the pattern, None if there aren't any
+
+    """
+
+    paths = glob.glob(os.path.expanduser(pattern))
+
+    if len(paths) == 0:
+        return None
+
+    nLines = 0
+    for path in paths:
+        try:
+            with open(path) as f:
+                nLines += sum(1 for line in f)
+        except IOError:
+            pass
+
+    return nLines
+
+def sendEvent(transport, event):
+    """Sends a single event, returning False if it couldn't be delivered
+
+    """
+
+    line = json.dumps(event) + '\n'
+
+    kind, address = transport.split(':', 1)
+
+    try:
+        if kind == 'file':
+            with open(os.path.expanduser(address), 'a') as f:
+                f.write(line)
+        elif kind == 'tcp':
+            host, port = address.rsplit(':', 1)
+            connection = socket.create_connection((host, int(port)), 10)
+            connection.sendall(line.encode('utf-8'))
+            connection.close()
+        else:
+            raise ValueError('unknown transport ' + transport)
+    except (IOError, socket.error):
+        return False
+
+    return True
+
+def push(transport, jobId, eventType, **fields):
+    """Sends an event, retrying a few times, since losing an exit event would leave the manager waiting for a sweep
+
+    """
+
+    event = {'job': jobId, 'event': eventType, 'time': time.time()}
+    event.update(fields)
+
+    for attempt in range(5):
+        if sendEvent(transport, event):
+            return
+        time.sleep(2 ** attempt)
+
+def readExitCode(path, default):
+
+    try:
+        with open(path) as f:
+            return int(f.read().strip())
+    except (IOError, ValueError):
+        return default
+
+def run(args):
+
+    process = subprocess.Popen(args.command)
+
+    push(args.transport, args.job_id, 'start', pid=process.pid)
+
+    lastProgress = None
+    lastHeartbeat = time.time()
+
+    while process.poll() is None:
+
+        time.sleep(min(1., args.heartbeat))
+
+        if time.time() - lastHeartbeat < args.heartbeat:
+            continue
+        lastHeartbeat = time.time()
+
+        progress = countLines(args.progress_file) if args.progress_file else None
+
+        if progress is not None and progress != lastProgress:
+            push(args.transport, args.job_id, 'progress', progress=progress)
+            lastProgress = progress
+        else:
+            push(args.transport, args.job_id, 'heartbeat', progress=progress)
+
+    #the job script records the exit code of the job itself, which is more useful than that of the wrapper
+    exitCode = readExitCode(args.exit_code_file, process.returncode) if args.exit_code_file else process.returncode
+
+    push(args.transport, args.job_id, 'exit', exitCode=exitCode,
+         progress=countLines(args.progress_file) if args.progress_file else None)
+
+    return exitCode
+
+def listen(args):
+
+    if args.pid_file:
+        with open(os.path.expanduser(args.pid_file), 'w') as f:
+            f.write(str(os.getpid()) + '\n')
+
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind(('', args.port))
+    server.listen(128)
+
+    output = open(os.path.expanduser(args.output), 'a')
+
+    while True:
+
+        connection, address = server.accept()
+        connection.settimeout(30)
+
+        data = b''
+        try:
+            while True:
+                chunk = connection.recv(4096)
+                if not chunk:
+                    break
+                data += chunk
+        except socket.error:
+            pass
+        connection.close()
+
+        for line in data.decode('utf-8').splitlines():
+            if line.strip():
+                output.write(line.strip() + '\n')
+        output.flush()
+
+def main(argv):
+
+    parser = argparse.ArgumentParser(description='pushes job events to the AzureJobManager')
+    subparsers = parser.add_subparsers(dest='mode')
+
+    runParser = subparsers.add_parser('run')
+    runParser.add_argument('--job-id', required=True)
+    runParser.add_argument('--transport', required=True)
+    runParser.add_argument('--heartbeat', type=float, default=60.)
+    runParser.add_argument('--progress-file', default=None)
+    runParser.add_argument('--exit-code-file', default=None)
+    runParser.add_argument('command', nargs=argparse.REMAINDER)
+
+    listenParser = subparsers.add_parser('listen')
+    listenParser.add_argument('--port', type=int, default=5555)
+    listenParser.add_argument('--output', default='~/.azureJobManager/events.log')
+    listenParser.add_argument('--pid-file', default=None)
+
+    args = parser.parse_args(argv)
+
+    if args.mode == 'run':
+        if args.command and args.command[0] == '--':
+            args.command = args.command[1:]
+        return run(args)
+    else:
+        return listen(args)
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,159 @@
+import threading
+import Queue
+import json
+import time
+import os
+import subprocess as sp
+import shellCommands
+
+#the agent script which is copied onto the VMs, and where it goes. This is a hidden directory so that
+#VirtualMachine.clean() leaves it alone
+agentPath = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'jobAgent.py')
+remoteAgentDirectory = '.azureJobManager'
+remoteEventLog = remoteAgentDirectory + '/events.log'
+remoteListenerPidFile = remoteAgentDirectory + '/listener.pid'
+
+def tailLocalFile(path, pollTime = 0.5):
+    """Yields lines from a local file as they are appended to it, including those already there. This is the
+    local stand-in for the head node's event log, for use with the agent's file: transport
+
+    """
+
+    path = os.path.expanduser(path)
+
+    while not os.path.exists(path):
+        time.sleep(pollTime)
+
+    f = open(path)
+
+    while True:
+
+        line = f.readline()
+
+        if line:
+            yield line
+        else:
+            time.sleep(pollTime)
+
+class RemoteFileTail(object):
+    """Yields lines from a file on the VM as they are appended to it, over a long running session, such as an ssh one.
+    If the session drops, it's started again after a backoff, carrying on from the last whole line read, until stop()
+    is called. A session whose connection has died is ended by ssh's keepalives
+
+    """
+
+    def __init__(self, vm, path, maxBackoff = 60):
+
+        self._vm = vm
+        self._path = path
+        self._maxBackoff = maxBackoff
+        self._process = None
+        self._stopped = False
+        self._lock = threading.Lock()
+
+    def __iter__(self):
+
+        nLines = 0
+        backoff = 1
+
+        while True:
+
+            command = self._vm.backend.execCommand(self._vm, 'touch ' + self._path + ' && tail -n +' + str(nLines + 1) + ' -F ' + self._path)
+
+            self._vm.verbosePrint('following the event log with command:\n' + command)
+
+            with self._lock:
+                if self._stopped:
+                    return
+                self._process = sp.Popen(command, shell=True, stdout=sp.PIPE, preexec_fn=os.setsid)
+
+            for line in iter(self._process.stdout.readline, ''):
+
+                #a line cut off by the session dropping is read again in full by the next one
+                if not line.endswith('\n'):
+                    break
+
+                nLines += 1
+                backoff = 1
+                yield line
+
+            self._process.wait()
+
+            if self._stopped:
+                return
+
+            print "the event log on " + self._vm.name + " stopped being followed, following it again in " + str(backoff) + " s"
+
+            time.sleep(backoff)
+            backoff = min(2 * backoff, self._maxBackoff)
+
+    def stop(self):
+        """Ends the session, and stops it being started again
+
+        """
+
+        with self._lock:
+            self._stopped = True
+            if self._process is not None:
+                shellCommands.killProcessGroup(self._process)
+
+class EventMonitor(object):
+    """Reads the events pushed by jobAgent.py in a background thread, putting them on a queue for the manager
+
+    """
+
+    @property
+    def events(self):
+        """The queue of parsed events, each a dictionary with at least 'job', 'event' and 'time' keys
+
+        """
+
+        return self._events
+
+    def __init__(self, lines):
+
+        self._lines = lines
+        self._events = Queue.Queue()
+
+        self._thread = threading.Thread(target=self._read)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stops following the events, ending the session they come over, if they come over one
+
+        """
+
+        if hasattr(self._lines, 'stop'):
+            self._lines.stop()
+            self._thread.join(10)
+
+    def _read(self):
+
+        for line in self._lines:
+
+            try:
+                event = json.loads(line)
+            except ValueError:
+                continue
+
+            self._events.put(event)
+
+    def waitForEvents(self, timeout):
+        """Waits until at least one event arrives, or the timeout expires, returning all of the events that
+        are waiting
+
+        """
+
+        events = []
+
+        try:
+            events.append(self._events.get(True, timeout))
+        except Queue.Empty:
+            return events
+
+        while True:
+            try:
+                events.append(self._events.get_nowait())
+            except Queue.Empty:
+                return events
@@ -0,0 +1,410 @@
+"""Answers "what if" questions about a run's policy offline, before paying for it. A discrete-event model of
+AzureJobManager's policy (the head node launched first, then the workers at most maxConcurrentLaunches at a time,
+each VM's slots filled as soon as it's ready, finished jobs noticed at the next sweep or straight away with the
+agents, a slot reused once its job's outputs are downloaded, and a VM deleted once it has nothing left to do) is
+played through with the job run times and latencies of a Workload, and the makespan and cost are worked out.
+
+A Workload can come from a recorded run, from its journal and, better, its metrics JSON lines, or be drawn from
+distributions. Its latencies are drawn once, in order, so every policy variant simulated with it sees the same ones,
+and differences between the variants are down to the policy rather than the luck of the draw. Nothing sleeps and
+nothing is launched, so thousands of variants take seconds:
+
+    python replaySimulator.py --journal run.journal --metrics run.jsonl --vms 50 100 200 --sleep-time 60 300 \\
+        --slots-per-vm 1 2 --use-agent no yes
+
+prints the cheapest variants, with their makespans. The model leaves out evictions, retries, speculation, splitting
+and the autoscaler, and assumes a job's run time doesn't depend on how many others share its VM (pass a runTimeScale
+for a variant where it does), so it's for comparing policies rather than predicting a run to the minute. The
+SchedulerBenchmark, which runs the manager itself, is there to check it against.
+
+"""
+
+import sys
+import math
+import json
+import heapq
+import argparse
+import itertools
+from sizeCalibration import defaultPriceTable
+from schedulerBenchmark import lognormal, seededRandom
+from runJournal import RunJournal
+
+def empirical(values):
+    """Draws from a list of recorded values
+
+    """
+
+    values = list(values)
+
+    return lambda rng: values[int(rng.random() * len(values))]
+
+class Workload(object):
+    """The jobs' run times, in the order they're queued, and the distributions of the latencies of each step of a run:
+    'provision' (a VM being created), 'activation' (a job being started in its slot), 'download' (a job's outputs
+    being fetched), 'sweep' (a sweep of the job statuses through the head node), 'teardown' (a VM being deleted) and
+    'groupTeardown' (the resource group being deleted at the end). Each provisioning fails with provisionFailureRate
+
+    """
+
+    @property
+    def runTimes(self):
+
+        return self._runTimes
+
+    @property
+    def nJobs(self):
+
+        return len(self._runTimes)
+
+    @property
+    def seed(self):
+
+        return self._seed
+
+    @property
+    def provisionFailureRate(self):
+
+        return self._provisionFailureRate
+
+    def __init__(self, runTimes, seed = 0, provisionFailureRate = 0., provisionLatency = lognormal(100, 0.3), \
+                 activationLatency = lognormal(2, 0.5), downloadLatency = lognormal(2, 0.5), sweepLatency = lognormal(2, 0.5), \
+                 teardownLatency = lognormal(60, 0.3), groupTeardownLatency = lognormal(60, 0.3)):
+
+        self._runTimes = [max(0., runTime) for runTime in runTimes]
+        self._seed = seed
+        self._provisionFailureRate = provisionFailureRate
+        self._distributions = {
+            'provision' : provisionLatency,
+            'activation' : activationLatency,
+            'download' : downloadLatency,
+            'sweep' : sweepLatency,
+            'teardown' : teardownLatency,
+            'groupTeardown' : groupTeardownLatency,
+            'provisionFailure' : lambda rng: rng.random()
+        }
+        self._rngs = {}
+        self._draws = {}
+
+    def draws(self, kind, n):
+        """The first n draws of the kind. They're drawn the first time they're asked for and kept, so each is the same
+        whichever variant asks for it
+
+        """
+
+        if not kind in self._draws:
+            self._rngs[kind] = seededRandom(self._seed, 'workload', kind)
+            self._draws[kind] = []
+
+        draws = self._draws[kind]
+        distribution = self._distributions[kind]
+        rng = self._rngs[kind]
+
+        while len(draws) < n:
+            draws.append(max(0., distribution(rng)))
+
+        return draws
+
+    def draw(self, kind, i):
+
+        return self.draws(kind, i + 1)[i]
+
+def generatedWorkload(nJobs, jobRunTime = lognormal(1800, 0.5), seed = 0, **options):
+    """A Workload of nJobs jobs whose run times are drawn from jobRunTime. They're drawn as the SchedulerBenchmark
+    draws them, so the same seed gives the same jobs, and the simulator can be checked against the benchmark
+
+    """
+
+    runTimes = [jobRunTime(seededRandom(seed, 'job', i)) for i in range(nJobs)]
+
+    return Workload(runTimes, seed = seed, **options)
+
+def recordedWorkload(journalPath, metricsPath = None, recordedSleepTime = None, seed = 0, **options):
+    """A Workload taken from a recorded run. The jobs are those which finished, in the order they were first
+    activated. A job's run time is from when it was last activated to when it finished. With the run's metrics
+    JSON lines, the end of a job is taken to be halfway between when it was last seen running and when its end was
+    noticed, and the latencies are drawn from the recorded provisions, activations, downloads, sweeps (the ssh
+    calls) and teardowns. Without them, the journal only has when each job's end was noticed, so half of the
+    recordedSleepTime, if it's given, is taken off each run time, and the latencies keep their defaults unless
+    they're passed in options
+
+    """
+
+    activated = {}
+    finished = {}
+    order = []
+
+    for entry in RunJournal(journalPath).entries():
+
+        if entry['event'] == 'jobActivated':
+
+            job = str(entry['job'])
+
+            if not job in activated:
+                order.append(job)
+
+            activated[job] = entry['time']
+
+        elif entry['event'] == 'jobFinished':
+            finished[str(entry['job'])] = entry['time']
+
+    detectionDelay = dict((job, recordedSleepTime / 2.) for job in finished) if recordedSleepTime is not None else {}
+
+    if metricsPath is not None:
+
+        samples = {}
+
+        with open(metricsPath) as f:
+            for line in f:
+
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+
+                phase = entry.get('phase')
+
+                if phase is None:
+                    continue
+
+                if phase == 'activation':
+                    #the activation is observed once it's done, which is when the job really started
+                    activated[str(entry['job'])] = entry['time']
+                elif phase == 'completionDetection':
+                    detectionDelay[str(entry['job'])] = entry['seconds'] / 2.
+                elif phase == 'teardown' and 'resourceGroup' in entry:
+                    phase = 'groupTeardown'
+                elif phase == 'ssh':
+                    phase = 'sweep'
+
+                samples.setdefault(phase, []).append(entry['seconds'])
+
+        for kind in ['provision', 'activation', 'download', 'sweep', 'teardown', 'groupTeardown']:
+            if kind in samples and not kind + 'Latency' in options:
+                options[kind + 'Latency'] = empirical(samples[kind])
+
+    runTimes = [finished[job] - activated[job] - detectionDelay.get(job, 0.) for job in order if job in finished]
+
+    return Workload(runTimes, seed = seed, **options)
+
+class ReplaySimulator(object):
+    """Plays a Workload through a model of AzureJobManager's policy, for as many policy variants as you like. The
+    cost is the VM time, from the start of each VM's provisioning to the end of its deletion, priced from the
+    priceTable in dollars per hour
+
+    """
+
+    @property
+    def workload(self):
+
+        return self._workload
+
+    @property
+    def priceTable(self):
+
+        return self._priceTable
+
+    def __init__(self, workload, priceTable = defaultPriceTable):
+
+        self._workload = workload
+        self._priceTable = priceTable
+
+    def simulate(self, nVirtualMachines, sleepTime = 300, slotsPerVm = 1, maxConcurrentLaunches = 20, useAgent = False, \
+                 releaseIdleVms = True, vmSize = 'Basic_A0', runTimeScale = 1.):
+        """Simulates one run with the given policy. releaseIdleVms False keeps every VM until the end, as a warm pool
+        does, and runTimeScale stretches every job's run time, for a VM size or number of slots which runs them
+        faster or slower than the recorded run did. Returns a dictionary of the policy, the makespan and VM time in
+        seconds, the cost, the fraction of slot time spent idle and the number of VMs launched
+
+        """
+
+        assert vmSize in self._priceTable, "there's no price for " + vmSize
+
+        workload = self._workload
+        nJobs = workload.nJobs
+        nVirtualMachines = max(1, min(nVirtualMachines, nJobs))
+
+        runTimes = workload.runTimes
+        provision = workload.draws('provision', nVirtualMachines)
+        failures = workload.draws('provisionFailure', nVirtualMachines)
+        activation = workload.draws('activation', nJobs)
+        download = workload.draws('download', nJobs)
+        teardown = workload.draws('teardown', nVirtualMachines)
+        groupTeardown = workload.draw('groupTeardown', 0)
+        sweeps = workload.draws('sweep', 1)
+        heappush = heapq.heappush
+        heappop = heapq.heappop
+
+        #the head node on its own, then the workers through a pool of maxConcurrentLaunches launchers
+        launchStart = [0.] * nVirtualMachines
+        ready = [provision[0]] * nVirtualMachines
+        launched = [True] * nVirtualMachines
+
+        launchers = [provision[0]] * max(1, min(maxConcurrentLaunches, nVirtualMachines - 1))
+
+        for i in range(1, nVirtualMachines):
+            launchStart[i] = heapq.heappop(launchers)
+            ready[i] = launchStart[i] + provision[i]
+            launched[i] = failures[i] >= workload.provisionFailureRate
+            heapq.heappush(launchers, ready[i])
+
+        #the jobs are only checked on once every launch has come back
+        monitorStart = max(ready)
+
+        #a slot of -1 is a VM becoming ready, with all of its slots to fill
+        events = [(ready[i], i, -1) for i in range(nVirtualMachines) if launched[i]]
+        heapq.heapify(events)
+
+        busySlots = [0] * nVirtualMachines
+        released = [None] * nVirtualMachines
+        nextJob = 0
+        busySeconds = 0.
+        lastFreed = monitorStart
+
+        while len(events) > 0:
+
+            now, vm, slot = heappop(events)
+
+            if slot < 0:
+                slots = range(slotsPerVm)
+            else:
+                busySlots[vm] -= 1
+                lastFreed = max(lastFreed, now)
+                slots = [slot]
+
+            for slot in slots:
+
+                if nextJob == nJobs:
+                    break
+
+                runTime = runTimes[nextJob] * runTimeScale
+                finish = now + activation[nextJob] + runTime
+
+                if useAgent:
+                    noticed = max(finish, monitorStart)
+                else:
+                    nSweeps = max(1, int(math.ceil((finish - monitorStart) / sleepTime)))
+
+                    if nSweeps >= len(sweeps):
+                        sweeps = workload.draws('sweep', 2 * nSweeps)
+
+                    noticed = monitorStart + nSweeps * sleepTime + sweeps[nSweeps]
+
+                heappush(events, (noticed + download[nextJob], vm, slot))
+
+                busySlots[vm] += 1
+                busySeconds += runTime
+                nextJob += 1
+
+            #never the head node, since everything else is reached through it
+            if busySlots[vm] == 0 and vm != 0 and releaseIdleVms:
+                released[vm] = now + teardown[vm]
+
+        makespan = lastFreed + groupTeardown
+
+        vmSeconds = 0.
+
+        for i in range(nVirtualMachines):
+            if launched[i]:
+                vmSeconds += (released[i] if released[i] is not None else makespan) - launchStart[i]
+
+        slotSeconds = vmSeconds * slotsPerVm
+
+        return {
+            'nVirtualMachines' : nVirtualMachines,
+            'sleepTime' : sleepTime,
+            'slotsPerVm' : slotsPerVm,
+            'maxConcurrentLaunches' : maxConcurrentLaunches,
+            'useAgent' : useAgent,
+            'releaseIdleVms' : releaseIdleVms,
+            'vmSize' : vmSize,
+            'runTimeScale' : runTimeScale,
+            'makespan' : makespan,
+            'vmSeconds' : vmSeconds,
+            'cost' : vmSeconds / 3600. * self._priceTable[vmSize],
+            'idleFraction' : 1. - busySeconds / slotSeconds if slotSeconds > 0 else 0.,
+            'nLaunched' : sum(launched)
+        }
+
+    def explore(self, options):
+        """Simulates every combination of the options, a dictionary mapping the names of simulate's arguments to
+        lists of values, returning the results in the order itertools.product gives the combinations
+
+        """
+
+        names = sorted(options)
+
+        return [self.simulate(**dict(zip(names, values))) for values in itertools.product(*[options[name] for name in names])]
+
+def printResults(results, nResults = 10):
+
+    print 'makespan (s)    cost ($)  idle   VMs  slots  sleepTime  agent  release  size'
+
+    for result in results[:nResults]:
+        print '%12.0f  %10.2f  %4.0f%%  %4d  %5d  %9.0f  %5s  %7s  %s' % (result['makespan'], result['cost'], 100 * result['idleFraction'], \
+              result['nVirtualMachines'], result['slotsPerVm'], result['sleepTime'], result['useAgent'], result['releaseIdleVms'], result['vmSize'])
+
+def main(argv):
+
+    yesNo = {'yes' : True, 'no' : False}
+
+    parser = argparse.ArgumentParser(description='predicts the makespan and cost of AzureJobManager policies, from a recorded run or distributions')
+    parser.add_argument('--journal', default=None, help='the journal of a recorded run to take the jobs from')
+    parser.add_argument('--metrics', default=None, help='the metrics JSON lines of the recorded run, to take the latencies from')
+    parser.add_argument('--recorded-sleep-time', type=float, default=None, help='the sleep time of the recorded run, used without its metrics')
+    parser.add_argument('--jobs', type=int, default=100, help='the number of jobs, without a journal')
+    parser.add_argument('--job-run-time', type=float, default=1800., help='the median run time of a job, without a journal')
+    parser.add_argument('--provision-latency', type=float, default=None, help='the median time to provision a VM')
+    parser.add_argument('--provision-failure-rate', type=float, default=0.)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--vms', type=int, nargs='+', default=[20])
+    parser.add_argument('--sleep-time', type=float, nargs='+', default=[300.])
+    parser.add_argument('--slots-per-vm', type=int, nargs='+', default=[1])
+    parser.add_argument('--max-concurrent-launches', type=int, nargs='+', default=[20])
+    parser.add_argument('--use-agent', choices=sorted(yesNo), nargs='+', default=['no'])
+    parser.add_argument('--release-idle-vms', choices=sorted(yesNo), nargs='+', default=['yes'])
+    parser.add_argument('--vm-size', nargs='+', default=['Basic_A0'])
+    parser.add_argument('--run-time-scale', type=float, nargs='+', default=[1.])
+    parser.add_argument('--deadline', type=float, default=None, help='leave out the variants with a longer makespan')
+    parser.add_argument('--top', type=int, default=10, help='how many of the cheapest variants to print')
+    parser.add_argument('--output', default=None, help='where to write every result as JSON')
+
+    args = parser.parse_args(argv)
+
+    options = {'seed' : args.seed, 'provisionFailureRate' : args.provision_failure_rate}
+
+    if args.provision_latency is not None:
+        options['provisionLatency'] = lognormal(args.provision_latency, 0.3)
+
+    if args.journal is not None:
+        workload = recordedWorkload(args.journal, args.metrics, args.recorded_sleep_time, **options)
+    else:
+        workload = generatedWorkload(args.jobs, lognormal(args.job_run_time, 0.5), **options)
+
+    simulator = ReplaySimulator(workload)
+
+    results = simulator.explore({
+        'nVirtualMachines' : args.vms,
+        'sleepTime' : args.sleep_time,
+        'slotsPerVm' : args.slots_per_vm,
+        'maxConcurrentLaunches' : args.max_concurrent_launches,
+        'useAgent' : [yesNo[value] for value in args.use_agent],
+        'releaseIdleVms' : [yesNo[value] for value in args.release_idle_vms],
+        'vmSize' : args.vm_size,
+        'runTimeScale' : args.run_time_scale
+    })
+
+    print 'simulated ' + str(len(results)) + ' variants of a run of ' + str(workload.nJobs) + ' jobs'
+
+    if args.deadline is not None:
+        results = [result for result in results if result['makespan'] <= args.deadline]
+
+    printResults(sorted(results, key = lambda result: (result['cost'], result['makespan'])), args.top)
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent = 2, sort_keys = True)
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,124 @@
+import json
+import os
+import time
+import threading
+
+class RunJournal(object):
+    """An append-only record of every change in the state of a run, one JSON object per line, written so that
+    it survives the manager crashing. Replaying it gives back where the VMs and jobs had got to.
+
+    """
+
+    @property
+    def path(self):
+        """The path of the journal file
+
+        """
+
+        return self._path
+
+    def __init__(self, path):
+
+        self._path = os.path.expanduser(path)
+        self._lock = threading.Lock()
+
+    def record(self, event, **fields):
+        """Appends an event to the journal, only returning once it's on disk
+
+        """
+
+        entry = {'event' : event, 'time' : time.time()}
+        entry.update(fields)
+
+        with self._lock:
+            with open(self._path, 'a') as f:
+                f.write(json.dumps(entry) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+
+    def entries(self):
+        """All of the events in the journal, in order. A line left half written by a crash is ignored
+
+        """
+
+        entries = []
+
+        if not os.path.exists(self._path):
+            return entries
+
+        with open(self._path) as f:
+            for line in f:
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    continue
+
+        return entries
+
+    def finished(self):
+        """Whether the run the journal records saw all of its jobs through and cleaned up
+
+        """
+
+        entries = self.entries()
+
+        return len(entries) > 0 and entries[-1]['event'] == 'runFinished'
+
+    def archive(self):
+        """Moves the journal aside, with the time appended to its name, so that a new run starts with an empty one
+
+        """
+
+        with self._lock:
+            if os.path.exists(self._path):
+                os.rename(self._path, self._path + '.' + str(int(time.time())))
+
+    def replayState(self):
+        """Works out where the run had got to. Returns a dictionary of the VMs which were launched and not deleted,
+        mapping their names to dictionaries of 'privateIp', 'publicIp' and 'nSlots', and a dictionary mapping the
+        string form of each job id which was ever activated to a dictionary of 'state' ('active', 'finished' or
+        'completed'), 'vm' and 'slot'. A job which finished also has the 'jobState' ('completed' or 'failed') and
+        'exitCode' it finished with. Jobs which were put back in the idle queue are left out, and jobs which finished
+        without having been seen to start have no 'vm' or 'slot'
+
+        """
+
+        vms = {}
+        jobs = {}
+
+        for entry in self.entries():
+
+            event = entry['event']
+
+            if event == 'vmLaunched':
+                vms[entry['vm']] = {'privateIp' : entry['privateIp'], 'publicIp' : entry['publicIp'], 'nSlots' : entry['nSlots']}
+            elif event == 'vmDeleted':
+                vms.pop(entry['vm'], None)
+            elif event == 'jobActivated':
+                jobs[str(entry['job'])] = {'state' : 'active', 'vm' : entry['vm'], 'slot' : entry['slot']}
+            elif event == 'jobFinished':
+                details = jobs.setdefault(str(entry['job']), {'vm' : None, 'slot' : None})
+                details.update({'state' : 'finished', 'jobState' : str(entry['state']), 'exitCode' : entry['exitCode']})
+            elif event == 'jobCompleted':
+                jobs.setdefault(str(entry['job']), {'vm' : None, 'slot' : None})['state'] = 'completed'
+            elif event == 'jobRequeued':
+                jobs.pop(str(entry['job']), None)
+
+        return vms, jobs
+
+    def splits(self):
+        """The sub-jobs which were split off during the run, as a list of tuples of the string forms of the ids of
+        the job split and of the sub-job, and the point it was split at, in the order they were started
+
+        """
+
+        splits = []
+        seen = set()
+
+        for entry in self.entries():
+
+            if entry['event'] == 'jobActivated' and 'parentJob' in entry and not str(entry['job']) in seen:
+                seen.add(str(entry['job']))
+                splits.append((str(entry['parentJob']), str(entry['job']), entry['splitAt']))
+
+        return splits
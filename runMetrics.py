@@ -0,0 +1,202 @@
+import json
+import os
+import time
+import threading
+
+#the upper bounds, in seconds, of the histogram buckets. They run from a quick ssh call to a long job
+defaultBuckets = [0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600, 7200, 14400]
+
+class Histogram(object):
+    """Counts how many observations fall at or below each bucket's upper bound, as a Prometheus histogram does
+
+    """
+
+    @property
+    def buckets(self):
+
+        return self._buckets
+
+    @property
+    def counts(self):
+        """The number of observations at or below each bucket's upper bound
+
+        """
+
+        return self._counts
+
+    @property
+    def count(self):
+
+        return self._count
+
+    @property
+    def sum(self):
+
+        return self._sum
+
+    def __init__(self, buckets = defaultBuckets):
+
+        self._buckets = buckets
+        self._counts = [0] * len(buckets)
+        self._count = 0
+        self._sum = 0.
+
+    def observe(self, value):
+
+        for i, bound in enumerate(self._buckets):
+            if value <= bound:
+                self._counts[i] += 1
+
+        self._count += 1
+        self._sum += value
+
+class RunMetrics(object):
+    """Times each phase of a run, and keeps track of how much of each VM's time was spent running jobs. Every
+    observation is appended to a JSON-lines file as it happens, if there is one, and the histograms and per-VM totals
+    can be written out as a Prometheus text file, for the node exporter's textfile collector or anything else which
+    reads that format.
+
+    The phases are 'provision' (az vm create), 'start' (az vm start), 'ssh' and 'scp' (each call), 'activation' (a job
+    being started in its slot), 'completionDetection' (how long after a job was last seen running its end was noticed,
+    an upper bound on how late it was noticed), 'download' (a job's outputs being fetched) and 'teardown' (a VM, or
+    at the end the resource group, being deleted or deallocated)
+
+    """
+
+    @property
+    def histograms(self):
+        """A dictionary mapping each phase to its Histogram
+
+        """
+
+        return self._histograms
+
+    @property
+    def jsonLinesPath(self):
+
+        return self._jsonLinesPath
+
+    @property
+    def prometheusPath(self):
+
+        return self._prometheusPath
+
+    def __init__(self, jsonLinesPath = None, prometheusPath = None, buckets = defaultBuckets):
+
+        self._jsonLinesPath = os.path.expanduser(jsonLinesPath) if jsonLinesPath is not None else None
+        self._prometheusPath = os.path.expanduser(prometheusPath) if prometheusPath is not None else None
+        self._buckets = buckets
+        self._histograms = {}
+        self._vms = {}
+        self._lock = threading.Lock()
+
+    def write(self, entry):
+
+        if self._jsonLinesPath is None:
+            return
+
+        entry['time'] = time.time()
+
+        with open(self._jsonLinesPath, 'a') as f:
+            f.write(json.dumps(entry) + '\n')
+
+    def observe(self, phase, seconds, **labels):
+        """Records how many seconds one go at a phase took. The labels, such as the VM or job, only go into the JSON lines
+
+        """
+
+        with self._lock:
+
+            if not phase in self._histograms:
+                self._histograms[phase] = Histogram(self._buckets)
+
+            self._histograms[phase].observe(seconds)
+
+            entry = {'phase' : phase, 'seconds' : seconds}
+            entry.update(labels)
+            self.write(entry)
+
+    def vmLaunched(self, name, nSlots):
+
+        with self._lock:
+            self._vms[name] = {'launched' : time.time(), 'released' : None, 'nSlots' : nSlots, 'busySeconds' : 0.}
+            self.write({'event' : 'vmLaunched', 'vm' : name, 'nSlots' : nSlots})
+
+    def vmBusy(self, name, seconds):
+        """Adds the time a job spent running in one of the VM's slots
+
+        """
+
+        with self._lock:
+            if name in self._vms:
+                self._vms[name]['busySeconds'] += seconds
+
+    def vmReleased(self, name):
+
+        with self._lock:
+
+            if not name in self._vms or self._vms[name]['released'] is not None:
+                return
+
+            self._vms[name]['released'] = time.time()
+
+            busySeconds, idleSeconds = self.vmSeconds(name)
+            self.write({'event' : 'vmReleased', 'vm' : name, 'busySeconds' : busySeconds, 'idleSeconds' : idleSeconds})
+
+    def vmSeconds(self, name):
+        """The slot seconds the VM has spent running jobs and not, so far
+
+        """
+
+        vm = self._vms[name]
+
+        end = vm['released'] if vm['released'] is not None else time.time()
+        slotSeconds = (end - vm['launched']) * vm['nSlots']
+
+        return vm['busySeconds'], max(0., slotSeconds - vm['busySeconds'])
+
+    def prometheusText(self):
+
+        lines = ['# HELP azurejobmanager_phase_seconds How long each phase of the run took',
+                 '# TYPE azurejobmanager_phase_seconds histogram']
+
+        with self._lock:
+
+            for phase in sorted(self._histograms):
+
+                histogram = self._histograms[phase]
+
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    lines.append('azurejobmanager_phase_seconds_bucket{phase="' + phase + '",le="' + str(bound) + '"} ' + str(count))
+
+                lines.append('azurejobmanager_phase_seconds_bucket{phase="' + phase + '",le="+Inf"} ' + str(histogram.count))
+                lines.append('azurejobmanager_phase_seconds_sum{phase="' + phase + '"} ' + repr(histogram.sum))
+                lines.append('azurejobmanager_phase_seconds_count{phase="' + phase + '"} ' + str(histogram.count))
+
+            for kind in ['busy', 'idle']:
+
+                lines.append('# HELP azurejobmanager_vm_' + kind + '_seconds The slot seconds each VM has spent ' + \
+                             ('running jobs' if kind == 'busy' else 'with a slot not running a job'))
+                lines.append('# TYPE azurejobmanager_vm_' + kind + '_seconds gauge')
+
+                for name in sorted(self._vms):
+                    seconds = self.vmSeconds(name)[0 if kind == 'busy' else 1]
+                    lines.append('azurejobmanager_vm_' + kind + '_seconds{vm="' + name + '"} ' + repr(seconds))
+
+        return '\n'.join(lines) + '\n'
+
+    def writePrometheus(self):
+        """Writes the Prometheus text file, if there is one. It's written to a temporary file and moved into place,
+        so that whatever reads it never sees half of it
+
+        """
+
+        if self._prometheusPath is None:
+            return
+
+        partialPath = self._prometheusPath + '.partial'
+
+        with open(partialPath, 'w') as f:
+            f.write(self.prometheusText())
+
+        os.rename(partialPath, self._prometheusPath)
@@ -0,0 +1,565 @@
+"""Measures how AzureJobManager copes with large runs, without Azure. The manager's own run() and updateJobs() are run
+against a SimulatedBackend, whose stand-ins for az, ssh and scp take a random time drawn from configurable
+distributions, and whose VMs are directories on this machine as with the LocalBackend. Provisioning can fail at
+random or run into a quota, spot VMs can be evicted at random, and the jobs are SimulatedJobs which just sleep for a
+random run time.
+
+Time is scaled down by timeScale, so that a run which would take hours on Azure takes minutes here. Every time given
+to or reported by the benchmark is in simulated seconds. Each random draw is seeded by the seed and what it's for,
+so the same seed gives the same latencies, failures and run times from one benchmark to the next, whatever order
+the manager's threads happen to ask for them in. The manager really does sleep and wait for subprocesses though, so
+the makespan still varies by a few percent between runs, and comparisons should allow for that.
+
+    python schedulerBenchmark.py --vms 200 --jobs 1000 --seed 1 --output benchmark.json
+
+prints the makespan, the fraction of VM time spent idle, the number of control plane calls per job and the manager's
+own CPU time and peak memory.
+
+"""
+
+import sys
+import os
+import copy
+import math
+import time
+import json
+import random
+import hashlib
+import resource
+import shutil
+import tempfile
+import threading
+import argparse
+import subprocess as sp
+from computeBackend import LocalBackend, killProcesses
+from azureJob import AzureJob
+from azureJobManager import AzureJobManager
+
+def fixed(value):
+
+    return lambda rng: value
+
+def uniform(low, high):
+
+    return lambda rng: rng.uniform(low, high)
+
+def exponential(mean):
+
+    return lambda rng: rng.expovariate(1. / mean)
+
+def lognormal(median, sigma):
+
+    return lambda rng: rng.lognormvariate(math.log(median), sigma)
+
+def seededRandom(seed, *key):
+    """A random number generator seeded by the seed and the key, so that each draw is the same from one run to the next
+
+    """
+
+    return random.Random(int(hashlib.md5(':'.join(str(part) for part in (seed,) + key)).hexdigest()[:15], 16))
+
+class SimulatedBackend(LocalBackend):
+    """A LocalBackend whose operations are slowed down to take as long as they might on Azure, whose VMs may fail
+    to provision, and whose spot VMs are evicted at evictionRate times per simulated hour each, which is noticed the
+    next time the VMs are listed. Every az, ssh and scp call the manager makes is counted, and the hops the head node
+    makes to the other VMs over the VNet are counted apart from them
+
+    """
+
+    @property
+    def calls(self):
+        """A dictionary mapping 'az', 'ssh' and 'scp' to the number of calls made so far
+
+        """
+
+        return dict(self._calls)
+
+    @property
+    def peerCalls(self):
+        """The number of ssh and scp hops made from the head node to the other VMs so far
+
+        """
+
+        return self._peerCalls
+
+    @property
+    def launchTimes(self):
+        """A dictionary mapping the name of each VM which was provisioned or started to when that happened
+
+        """
+
+        return self._launchTimes
+
+    @property
+    def deleteTimes(self):
+        """A dictionary mapping the name of each VM which has gone to when it went
+
+        """
+
+        return self._deleteTimes
+
+    @property
+    def evictedVirtualMachines(self):
+        """The names of the spot VMs which have been evicted
+
+        """
+
+        return sorted(self._evicted)
+
+    def __init__(self, rootDirectory, seed = 0, timeScale = 1., provisionLatency = lognormal(100, 0.3), startLatency = lognormal(40, 0.3), \
+                 deleteLatency = lognormal(60, 0.3), azLatency = lognormal(2, 0.3), sshLatency = lognormal(0.3, 0.5), \
+                 scpLatency = lognormal(1, 0.5), peerLatency = lognormal(0.05, 0.5), provisionFailureRate = 0., quota = None, \
+                 evictionRate = 0.):
+
+        LocalBackend.__init__(self, rootDirectory)
+
+        self._seed = seed
+        self._timeScale = timeScale
+        self._provisionLatency = provisionLatency
+        self._startLatency = startLatency
+        self._deleteLatency = deleteLatency
+        self._azLatency = azLatency
+        self._sshLatency = sshLatency
+        self._scpLatency = scpLatency
+        self._peerLatency = peerLatency
+        self._provisionFailureRate = provisionFailureRate
+        self._quota = quota
+        self._evictionRate = evictionRate
+
+        self._lock = threading.Lock()
+        self._calls = {'az' : 0, 'ssh' : 0, 'scp' : 0}
+        self._peerCalls = 0
+        self._draws = {}
+        self._launchTimes = {}
+        self._deleteTimes = {}
+        self._evictionTimes = {}
+        self._evicted = set()
+
+    def draw(self, distribution, kind, name):
+        """Draws from the distribution, for the next call of the kind to do with name
+
+        """
+
+        with self._lock:
+            k = self._draws.get((kind, name), 0)
+            self._draws[(kind, name)] = k + 1
+
+        return max(0., distribution(seededRandom(self._seed, kind, name, k)))
+
+    def count(self, kind):
+
+        with self._lock:
+            if kind == 'peer':
+                self._peerCalls += 1
+            else:
+                self._calls[kind] += 1
+
+    def wait(self, distribution, kind, name):
+        """Sleeps for as long as an az call takes
+
+        """
+
+        self.count('az')
+        time.sleep(self.draw(distribution, kind, name) / self._timeScale)
+
+    def nLiveVirtualMachines(self):
+
+        return len([name for name in self._launchTimes if not name in self._deleteTimes])
+
+    def launched(self, vm):
+        """Notes that the VM has been provisioned or started, drawing when it's to be evicted if it's a spot VM
+
+        """
+
+        with self._lock:
+            self._launchTimes[vm.name] = time.time()
+            self._deleteTimes.pop(vm.name, None)
+            self._evicted.discard(vm.name)
+
+        if vm.isSpot and self._evictionRate > 0:
+            lifetime = self.draw(exponential(3600. / self._evictionRate), 'eviction', vm.name) / self._timeScale
+            with self._lock:
+                self._evictionTimes[vm.name] = (time.time() + lifetime, self.vmDirectory(vm))
+
+    def gone(self, vm):
+        """Notes that the VM has been deallocated or deleted, unless it was evicted first
+
+        """
+
+        with self._lock:
+            self._evictionTimes.pop(vm.name, None)
+            if not vm.name in self._evicted:
+                self._deleteTimes[vm.name] = time.time()
+
+    def evict(self):
+        """Gets rid of the spot VMs whose time has come, as Azure would
+
+        """
+
+        now = time.time()
+
+        with self._lock:
+            due = [(name, directory) for name, (evictionTime, directory) in self._evictionTimes.items() if evictionTime <= now]
+            for name, directory in due:
+                del self._evictionTimes[name]
+                self._deleteTimes[name] = now
+                self._evicted.add(name)
+
+        for name, directory in due:
+            killProcesses(directory)
+            shutil.rmtree(directory, ignore_errors = True)
+
+    def makeGroup(self, resourceGroup):
+
+        self.wait(self._azLatency, 'group', resourceGroup)
+        LocalBackend.makeGroup(self, resourceGroup)
+
+    def deleteGroup(self, resourceGroup, wait = True):
+
+        self.wait(self._deleteLatency, 'group', resourceGroup)
+
+        with self._lock:
+            for name in self._launchTimes:
+                if not name in self._deleteTimes:
+                    self._deleteTimes[name] = time.time()
+
+        LocalBackend.deleteGroup(self, resourceGroup)
+
+    def groupTag(self, resourceGroup, tag):
+
+        self.wait(self._azLatency, 'tag', resourceGroup)
+        return LocalBackend.groupTag(self, resourceGroup, tag)
+
+    def setGroupTag(self, resourceGroup, tag, value):
+
+        self.wait(self._azLatency, 'tag', resourceGroup)
+        LocalBackend.setGroupTag(self, resourceGroup, tag, value)
+
+    def taggedGroups(self, tag):
+
+        self.wait(self._azLatency, 'tag', tag)
+        return LocalBackend.taggedGroups(self, tag)
+
+    def listVirtualMachines(self, resourceGroup, running = False):
+
+        self.wait(self._azLatency, 'list', resourceGroup)
+        self.evict()
+        return LocalBackend.listVirtualMachines(self, resourceGroup, running)
+
+    def provision(self, vm, headNodeIp = None, customData = None):
+
+        self.wait(self._provisionLatency, 'provision', vm.name)
+
+        with self._lock:
+            if self._quota is not None and self.nLiveVirtualMachines() >= self._quota:
+                raise sp.CalledProcessError(1, 'az vm create --name ' + vm.name, 'QuotaExceeded')
+
+        if seededRandom(self._seed, 'provisionFailure', vm.name).random() < self._provisionFailureRate:
+            raise sp.CalledProcessError(1, 'az vm create --name ' + vm.name, 'the simulated VM failed to provision')
+
+        addresses = LocalBackend.provision(self, vm, headNodeIp, customData)
+
+        self.launched(vm)
+
+        return addresses
+
+    def start(self, vm, headNodeIp = None):
+
+        self.wait(self._startLatency, 'start', vm.name)
+
+        addresses = LocalBackend.start(self, vm, headNodeIp)
+
+        self.launched(vm)
+
+        return addresses
+
+    def deallocate(self, vm):
+
+        self.wait(self._deleteLatency, 'deallocate', vm.name)
+
+        self.gone(vm)
+
+        LocalBackend.deallocate(self, vm)
+
+    def delete(self, vm):
+
+        self.wait(self._deleteLatency, 'delete', vm.name)
+
+        self.gone(vm)
+
+        LocalBackend.delete(self, vm)
+
+    def execCommand(self, vm, command):
+
+        self.count('ssh')
+        latency = self.draw(self._sshLatency, 'ssh', vm.name) / self._timeScale
+
+        return 'sleep ' + '%.4f' % latency + '; ' + LocalBackend.execCommand(self, vm, command)
+
+    def putCommand(self, vm, localPath, remotePath):
+
+        self.count('scp')
+        latency = self.draw(self._scpLatency, 'scp', vm.name) / self._timeScale
+
+        return 'sleep ' + '%.4f' % latency + '; ' + LocalBackend.putCommand(self, vm, localPath, remotePath)
+
+    def getCommand(self, vm, remotePath, localPath):
+
+        self.count('scp')
+        latency = self.draw(self._scpLatency, 'scp', vm.name) / self._timeScale
+
+        return 'sleep ' + '%.4f' % latency + '; ' + LocalBackend.getCommand(self, vm, remotePath, localPath)
+
+    def peerExecCommand(self, vm, command):
+
+        self.count('peer')
+        latency = self.draw(self._peerLatency, 'peer', vm.name) / self._timeScale
+
+        return '(sleep ' + '%.4f' % latency + '; ' + LocalBackend.execCommand(self, vm, command) + ')'
+
+    def peerPutCommand(self, vm, sourcePath, remotePath):
+
+        self.count('peer')
+        latency = self.draw(self._peerLatency, 'peer', vm.name) / self._timeScale
+
+        return '(sleep ' + '%.4f' % latency + '; ' + LocalBackend.peerPutCommand(self, vm, sourcePath, remotePath) + ')'
+
+class SimulatedJob(AzureJob):
+    """A job which sleeps for its run time, then exits with its exit code, in the way a CompasJob runs COMPAS
+
+    """
+
+    @property
+    def id(self):
+
+        return self._id
+
+    @property
+    def simulatedRunTime(self):
+        """How many seconds the job sleeps for on its VM
+
+        """
+
+        return self._simulatedRunTime
+
+    def initialise(self, ID, runTime, outputPath, exitCode = 0):
+
+        self._id = ID
+        self._simulatedRunTime = runTime
+        self._outputPath = outputPath
+        self._simulatedExitCode = exitCode
+
+    def activate(self, virtualMachine, slot = 0):
+
+        self._vm = virtualMachine
+        self._slot = slot
+
+        directory = self.workingDirectory
+
+        script = 'cd ~ && rm -rf ' + directory + ' && mkdir -p ' + directory + '\n'
+        script += 'setsid nohup bash -c "sleep ' + '%.4f' % self._simulatedRunTime + '; echo ' + str(self._simulatedExitCode) + ' > ' + \
+                  directory + '/exitCode.txt; echo completed > ' + directory + '/completed.txt" < /dev/null > /dev/null 2>&1 &\n'
+        script += 'echo $! > ' + directory + '/jobPid.txt\n'
+        script += 'echo $!\n'
+
+        output = self._vm.sendScript(script)
+
+        self._pid = int(output.split()[-1])
+
+        self.setStatus('running')
+
+    def statusCommand(self):
+
+        directory = '~/' + self.workingDirectory
+
+        return 'if [ -f ' + directory + '/completed.txt ]; then code=$(cat ' + directory + '/exitCode.txt); ' + \
+               'if [ "$code" == "0" ]; then echo completed $code; else echo failed $code; fi; else echo running; fi'
+
+    def checkCompleted(self):
+
+        self._vm.getFile('~/' + self.workingDirectory + '/completed.txt', self._outputPath)
+
+        return os.path.exists(os.path.join(self._outputPath, 'completed.txt'))
+
+    def postProcess(self):
+
+        self._vm.getFile('~/' + self.workingDirectory + '/exitCode.txt', self._outputPath)
+
+    def speculativeCopy(self):
+
+        job = copy.copy(self)
+        AzureJob.__init__(job)
+
+        job._id = str(self._id) + 'copy'
+
+        return job
+
+class SchedulerBenchmark(object):
+    """Runs AzureJobManager on nJobs SimulatedJobs with nVirtualMachines simulated VMs, and reports how it did.
+    managerOptions are passed on to the manager, so that different policies can be compared, and backendOptions to
+    the SimulatedBackend
+
+    """
+
+    @property
+    def report(self):
+        """The measurements of the last run, None before one
+
+        """
+
+        return self._report
+
+    def __init__(self, nVirtualMachines, nJobs, jobRunTime = lognormal(1800, 0.5), jobFailureRate = 0., seed = 0, timeScale = 100., \
+                 sleepTime = 300, managerOptions = None, backendOptions = None):
+
+        self._nVirtualMachines = nVirtualMachines
+        self._nJobs = nJobs
+        self._jobRunTime = jobRunTime
+        self._jobFailureRate = jobFailureRate
+        self._seed = seed
+        self._timeScale = timeScale
+        self._sleepTime = sleepTime
+        self._managerOptions = dict(managerOptions) if managerOptions is not None else {}
+        self._backendOptions = dict(backendOptions) if backendOptions is not None else {}
+        self._report = None
+
+    def makeJobs(self, outputDirectory):
+
+        jobs = []
+
+        for i in range(self._nJobs):
+
+            rng = seededRandom(self._seed, 'job', i)
+            runTime = max(0., self._jobRunTime(rng))
+            exitCode = 1 if rng.random() < self._jobFailureRate else 0
+
+            outputPath = os.path.join(outputDirectory, str(i))
+            os.makedirs(outputPath)
+
+            job = SimulatedJob()
+            job.initialise(i, runTime / self._timeScale, outputPath, exitCode)
+            jobs.append(job)
+
+        return jobs
+
+    def run(self):
+        """Runs the benchmark, returning the report: a dictionary of the makespan and total VM time, in simulated
+        seconds, the fraction of slot time spent idle, the control plane calls made in total and per job, the hops
+        made from the head node to the other VMs, the number
+        of spot VMs evicted and how many of those evictions the manager noticed, and the manager's CPU seconds and
+        peak memory
+
+        """
+
+        workDirectory = tempfile.mkdtemp(prefix = 'schedulerBenchmark')
+
+        try:
+
+            backend = SimulatedBackend(os.path.join(workDirectory, 'vms'), seed = self._seed, timeScale = self._timeScale, \
+                                       **self._backendOptions)
+
+            jobs = self.makeJobs(os.path.join(workDirectory, 'outputs'))
+
+            usageBefore = resource.getrusage(resource.RUSAGE_SELF)
+            start = time.time()
+
+            manager = AzureJobManager('benchmark', self._nVirtualMachines, jobs, sleepTime = self._sleepTime / self._timeScale, \
+                                      backend = backend, **self._managerOptions)
+            manager.run()
+
+            end = time.time()
+            usageAfter = resource.getrusage(resource.RUSAGE_SELF)
+
+            self._report = self.measure(manager, backend, start, end, usageBefore, usageAfter)
+
+        finally:
+
+            shutil.rmtree(workDirectory, ignore_errors = True)
+
+        return self._report
+
+    def measure(self, manager, backend, start, end, usageBefore, usageAfter):
+
+        slotsPerVm = dict((vm.name, vm.nSlots) for vm in manager.allVirtualMachines)
+
+        vmSeconds = 0.
+        slotSeconds = 0.
+
+        for name, launchTime in backend.launchTimes.items():
+            lifetime = backend.deleteTimes.get(name, end) - launchTime
+            vmSeconds += lifetime
+            slotSeconds += lifetime * slotsPerVm.get(name, 1)
+
+        busySeconds = sum(job.runTime for job in manager.completedJobs if job.runTime is not None)
+
+        calls = backend.calls
+        nCalls = sum(calls.values())
+
+        return {
+            'seed' : self._seed,
+            'nVirtualMachines' : self._nVirtualMachines,
+            'nJobs' : self._nJobs,
+            'nCompleted' : len([job for job in manager.completedJobs if job.state == 'completed']),
+            'makespan' : (end - start) * self._timeScale,
+            'vmSeconds' : vmSeconds * self._timeScale,
+            'idleFraction' : 1. - busySeconds / slotSeconds if slotSeconds > 0 else 0.,
+            'calls' : calls,
+            'callsPerJob' : float(nCalls) / max(self._nJobs, 1),
+            'peerCalls' : backend.peerCalls,
+            'nEvicted' : len(backend.evictedVirtualMachines),
+            'nEvictionsHandled' : manager.nEvictions,
+            'managerCpuSeconds' : (usageAfter.ru_utime + usageAfter.ru_stime) - (usageBefore.ru_utime + usageBefore.ru_stime),
+            'managerPeakMemoryMb' : usageAfter.ru_maxrss / 1024.
+        }
+
+def printReport(report):
+
+    print 'makespan: ' + '%.0f' % report['makespan'] + ' s for ' + str(report['nCompleted']) + ' of ' + str(report['nJobs']) + \
+          ' jobs completed on ' + str(report['nVirtualMachines']) + ' VMs'
+    print 'VM time: ' + '%.0f' % report['vmSeconds'] + ' s, ' + '%.1f' % (100 * report['idleFraction']) + '% of it idle'
+    print 'control plane calls: ' + '%.1f' % report['callsPerJob'] + ' per job (' + \
+          ', '.join(kind + ' ' + str(report['calls'][kind]) for kind in sorted(report['calls'])) + '), ' + \
+          str(report['peerCalls']) + ' hops from the head node'
+    if report['nEvicted'] > 0:
+        print 'evictions: ' + str(report['nEvicted']) + ' spot VMs evicted, ' + str(report['nEvictionsHandled']) + ' handled'
+    print 'manager: ' + '%.1f' % report['managerCpuSeconds'] + ' CPU s, ' + '%.0f' % report['managerPeakMemoryMb'] + ' MB peak memory'
+
+def main(argv):
+
+    parser = argparse.ArgumentParser(description='benchmarks the AzureJobManager against simulated VMs')
+    parser.add_argument('--vms', type=int, default=20)
+    parser.add_argument('--jobs', type=int, default=100)
+    parser.add_argument('--slots-per-vm', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--time-scale', type=float, default=100.)
+    parser.add_argument('--sleep-time', type=float, default=300.)
+    parser.add_argument('--job-run-time', type=float, default=1800., help='the median run time of a job')
+    parser.add_argument('--job-failure-rate', type=float, default=0.)
+    parser.add_argument('--provision-latency', type=float, default=100., help='the median time to provision a VM')
+    parser.add_argument('--provision-failure-rate', type=float, default=0.)
+    parser.add_argument('--quota', type=int, default=None, help='the most VMs which may exist at once')
+    parser.add_argument('--spot', action='store_true', help='run the worker VMs as spot VMs')
+    parser.add_argument('--eviction-rate', type=float, default=0., help='how many times an hour each spot VM is evicted')
+    parser.add_argument('--output', default=None, help='where to write the report as JSON')
+
+    args = parser.parse_args(argv)
+
+    benchmark = SchedulerBenchmark(args.vms, args.jobs, jobRunTime = lognormal(args.job_run_time, 0.5), jobFailureRate = args.job_failure_rate, \
+                                   seed = args.seed, timeScale = args.time_scale, sleepTime = args.sleep_time, \
+                                   managerOptions = {'slotsPerVm' : args.slots_per_vm, 'spot' : args.spot}, \
+                                   backendOptions = {'provisionLatency' : lognormal(args.provision_latency, 0.3), \
+                                                     'provisionFailureRate' : args.provision_failure_rate, 'quota' : args.quota, \
+                                                     'evictionRate' : args.eviction_rate})
+
+    report = benchmark.run()
+
+    printReport(report)
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent = 2, sort_keys = True)
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
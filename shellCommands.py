@@ -0,0 +1,151 @@
+"""Stand-ins for subprocess.call and subprocess.check_output, which run a shell command with a time limit and can be
+cancelled from another thread. Python 2's subprocess has neither, so a hung ssh or az call would otherwise block
+whichever thread made it for good.
+
+Each command is run in a process group of its own, so that a timeout or cancellation kills everything it started,
+such as the ssh a ProxyCommand spawns, rather than just the shell.
+
+"""
+
+import subprocess as sp
+import threading
+import signal
+import os
+
+class CommandTimeout(sp.CalledProcessError):
+    """Raised when a command runs for longer than its time limit. It's a CalledProcessError, so code which already
+    handles commands failing handles this too
+
+    """
+
+    def __str__(self):
+
+        return "Command '" + self.cmd + "' timed out"
+
+class CommandCancelled(sp.CalledProcessError):
+
+    def __str__(self):
+
+        return "Command '" + self.cmd + "' was cancelled"
+
+class RunningCommands(object):
+    """The commands a thread, or an object such as a VM, has running, so that they can all be cancelled at once
+
+    """
+
+    def __init__(self):
+
+        self._processes = set()
+        self._lock = threading.Lock()
+
+    def add(self, process):
+
+        with self._lock:
+            self._processes.add(process)
+
+    def remove(self, process):
+
+        with self._lock:
+            self._processes.discard(process)
+
+    def __len__(self):
+
+        return len(self._processes)
+
+    def cancel(self):
+        """Kills every command which is running. Each raises CommandCancelled in the thread which ran it
+
+        """
+
+        with self._lock:
+            processes = list(self._processes)
+
+        for process in processes:
+            process.cancelled = True
+            killProcessGroup(process)
+
+def killProcessGroup(process):
+
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except OSError:
+        pass
+
+def run(command, timeout = None, input = None, stdout = sp.PIPE, runningCommands = None):
+    """Runs the command, returning its exit code and whatever it printed, if stdout is sp.PIPE
+
+    """
+
+    process = sp.Popen(command, shell = True, stdin = sp.PIPE if input is not None else None, stdout = stdout, \
+                       preexec_fn = os.setsid)
+    process.cancelled = False
+    process.timedOut = False
+
+    if runningCommands is not None:
+        runningCommands.add(process)
+
+    timer = None
+
+    if timeout is not None:
+
+        def expire():
+            process.timedOut = True
+            killProcessGroup(process)
+
+        timer = threading.Timer(timeout, expire)
+        timer.daemon = True
+        timer.start()
+
+    try:
+        output = process.communicate(input)[0]
+    finally:
+        if timer is not None:
+            timer.cancel()
+        if runningCommands is not None:
+            runningCommands.remove(process)
+
+    if process.cancelled:
+        raise CommandCancelled(process.returncode, command, output)
+
+    if process.timedOut:
+        raise CommandTimeout(process.returncode, command, output)
+
+    return process.returncode, output
+
+def call(command, timeout = None, stdout = None, runningCommands = None):
+    """Like subprocess.call(command, shell=True), but raises CommandTimeout if it takes longer than timeout seconds
+
+    """
+
+    return run(command, timeout, stdout = stdout, runningCommands = runningCommands)[0]
+
+def checkOutput(command, timeout = None, input = None, runningCommands = None):
+    """Like subprocess.check_output(command, shell=True), but raises CommandTimeout if it takes longer than timeout
+    seconds. input is written to the command's stdin
+
+    """
+
+    returnCode, output = run(command, timeout, input = input, runningCommands = runningCommands)
+
+    if returnCode != 0:
+        raise sp.CalledProcessError(returnCode, command, output)
+
+    return output
+
+def callInBackground(command, timeout = None, runningCommands = None):
+    """Like call, but returns straight away, running the command in a thread of its own, which is returned. Whether
+    the command succeeds isn't reported
+
+    """
+
+    def runCommand():
+        try:
+            call(command, timeout, runningCommands = runningCommands)
+        except sp.CalledProcessError:
+            pass
+
+    thread = threading.Thread(target = runCommand)
+    thread.daemon = True
+    thread.start()
+
+    return thread
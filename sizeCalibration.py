@@ -0,0 +1,261 @@
+import os
+import json
+from computeBackend import AzureBackend
+from virtualMachine import VirtualMachine, VirtualMachineException, fileHash, findCachedFile
+from workerPool import WorkerPool
+
+#rough pay-as-you-go prices, in dollars per hour, of Linux VMs in centralus. These go out of date, so pass in a
+#table from the Azure pricing page (or your own agreement) for anything that matters
+defaultPriceTable = {
+    'Basic_A0' : 0.018,
+    'Standard_F2s_v2' : 0.085,
+    'Standard_F4s_v2' : 0.169,
+    'Standard_F8s_v2' : 0.338,
+    'Standard_D2s_v3' : 0.096,
+    'Standard_D4s_v3' : 0.192,
+    'Standard_D8s_v3' : 0.384
+}
+
+class SizeCalibration(object):
+    """Works out which VM size simulates the most binaries per dollar, by running a short sample of a real COMPAS
+    command on a VM of each candidate size. Every core of the VM runs a copy of the sample at once, since that's
+    how the VM would be used with one slot per core. The measurements are saved, keyed by the hash of the COMPAS
+    executable, the size and the length of the sample, so later runs can reuse them without launching anything
+
+    """
+
+    @property
+    def candidateSizes(self):
+        """The VM sizes which are tried
+
+        """
+
+        return self._candidateSizes
+
+    @property
+    def priceTable(self):
+        """A dictionary mapping VM sizes to their prices, in dollars per hour
+
+        """
+
+        return self._priceTable
+
+    @property
+    def measurements(self):
+        """A dictionary mapping each size which has been measured to a dictionary of 'binariesPerSecond', 'nCores',
+        'memoryMb', 'pricePerHour' and 'binariesPerDollar'
+
+        """
+
+        return self._measurements
+
+    @property
+    def measurementsPath(self):
+        """Where the measurements are saved
+
+        """
+
+        return self._measurementsPath
+
+    def __init__(self, resourceGroupName, candidateSizes, sampleCommand, compasPath, priceTable = defaultPriceTable, \
+                 publicSshKeyPath = '~/.ssh/id_rsa.pub', image = 'UbuntuLTS', location = 'centralus', nSampleBinaries = 100, \
+                 measurementsPath = '~/.azureJobManager/sizeCalibration.json', verbose = False, commandTimeout = 600, provisionTimeout = 1800):
+
+        for size in candidateSizes:
+            assert size in priceTable, "there's no price for " + size
+
+        self._resourceGroupName = resourceGroupName
+        self._candidateSizes = candidateSizes
+        self._sampleCommand = sampleCommand
+        self._compasPath = compasPath
+        self._priceTable = priceTable
+        self._publicSshKeyPath = publicSshKeyPath
+        self._image = image
+        self._location = location
+        self._nSampleBinaries = nSampleBinaries
+        self._measurementsPath = os.path.expanduser(measurementsPath)
+        self._verbose = verbose
+        self._measurements = {}
+        self._commandTimeout = commandTimeout
+        self._provisionTimeout = provisionTimeout
+        self._backend = AzureBackend(location, commandTimeout = commandTimeout, provisionTimeout = provisionTimeout)
+
+    def measurementKey(self, size):
+
+        return fileHash(self._compasPath) + ':' + size + ':' + str(self._nSampleBinaries)
+
+    def loadMeasurements(self):
+
+        if not os.path.exists(self._measurementsPath):
+            return {}
+
+        with open(self._measurementsPath) as f:
+            return json.load(f)
+
+    def saveMeasurements(self):
+        """Adds the measurements to those saved by earlier calibrations
+
+        """
+
+        saved = self.loadMeasurements()
+
+        for size, measurement in self._measurements.items():
+            saved[self.measurementKey(size)] = measurement
+
+        directory = os.path.dirname(self._measurementsPath)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        with open(self._measurementsPath, 'w') as f:
+            json.dump(saved, f, indent = 2, sort_keys = True)
+
+    def calibrate(self):
+        """Measures every candidate size which hasn't been measured before, all at once, each on a VM of its own in a
+        resource group which is deleted afterwards. Sizes which can't be launched, say for lack of quota, are left out.
+        Returns the measurements
+
+        """
+
+        saved = self.loadMeasurements()
+
+        toMeasure = []
+
+        for size in self._candidateSizes:
+
+            key = self.measurementKey(size)
+
+            if key in saved:
+                self.verbosePrint('reusing the saved measurement of ' + size)
+                self._measurements[size] = saved[key]
+                self._measurements[size]['pricePerHour'] = self._priceTable[size]
+                self._measurements[size]['binariesPerDollar'] = saved[key]['binariesPerSecond'] * 3600. / self._priceTable[size]
+            else:
+                toMeasure.append(size)
+
+        if len(toMeasure) > 0:
+
+            self._backend.makeGroup(self._resourceGroupName)
+
+            pool = WorkerPool(len(toMeasure))
+
+            try:
+
+                for size in toMeasure:
+                    pool.submit(size, self.measure, size)
+
+                for i in range(len(toMeasure)):
+
+                    size, measurement, exception = pool.results.get()
+
+                    if exception is not None:
+                        print "could not measure " + size + ": " + str(exception)
+                        continue
+
+                    self._measurements[size] = measurement
+
+            finally:
+
+                pool.shutdown()
+                self._backend.deleteGroup(self._resourceGroupName, wait = False)
+
+            self.saveMeasurements()
+
+        for size in sorted(self._measurements, key = lambda size: -self._measurements[size]['binariesPerDollar']):
+            measurement = self._measurements[size]
+            print size + ': ' + '%.2f' % measurement['binariesPerSecond'] + ' binaries per second on ' + str(measurement['nCores']) + \
+                  ' cores, ' + '%.0f' % measurement['binariesPerDollar'] + ' binaries per dollar'
+
+        return self._measurements
+
+    def measure(self, size):
+        """Launches a VM of the given size, runs the sample on every one of its cores and times it
+
+        """
+
+        name = self._resourceGroupName + size.replace('_', '')
+
+        vmOptions = {
+            '--image' : self._image,
+            '--admin-username' : 'ops',
+            '--ssh-key-value' : self._publicSshKeyPath,
+            '--resource-group' : self._resourceGroupName,
+            '--location' : self._location,
+            '--name' : name,
+            '--size' : size,
+            '--storage-sku' : 'Standard_LRS',
+            '--public-ip-address' : name + 'PublicIp'
+        }
+
+        vm = VirtualMachine(name, self._resourceGroupName, vmOptions, sshKeyPath = self._publicSshKeyPath, verbose = self._verbose, \
+                            commandTimeout = self._commandTimeout, provisionTimeout = self._provisionTimeout, backend = self._backend)
+
+        vm.launch()
+
+        nCores, memoryMb = vm.detectResources()
+
+        vm.ensureCached(self._compasPath)
+
+        compasName = os.path.basename(self._compasPath)
+
+        script = 'cd ~ && ' + findCachedFile(fileHash(self._compasPath)) + 'cp $src ' + compasName + ' && chmod --reference=$src ' + compasName + '\n'
+        script += 'mkdir -p calibration && cd calibration\n'
+        script += 'start=$(date +%s.%N)\n'
+        script += 'for k in $(seq 1 ' + str(nCores) + '); do (mkdir -p run$k && cd run$k && ' + self._sampleCommand + ' > /dev/null 2>&1) & done\n'
+        script += 'wait\n'
+        script += 'echo $start $(date +%s.%N)\n'
+
+        output = vm.sendScript(script)
+
+        vm.delete()
+
+        start, end = [float(field) for field in output.split()[-2:]]
+
+        if end <= start:
+            raise VirtualMachineException('The calibration run on ' + name + ' took no time, so the sample probably failed')
+
+        binariesPerSecond = nCores * self._nSampleBinaries / (end - start)
+
+        return {
+            'binariesPerSecond' : binariesPerSecond,
+            'nCores' : nCores,
+            'memoryMb' : memoryMb,
+            'pricePerHour' : self._priceTable[size],
+            'binariesPerDollar' : binariesPerSecond * 3600. / self._priceTable[size]
+        }
+
+    def bestSize(self):
+        """The measured size which simulates the most binaries per dollar
+
+        """
+
+        assert len(self._measurements) > 0, "no sizes have been measured"
+
+        return max(self._measurements, key = lambda size: self._measurements[size]['binariesPerDollar'])
+
+    def chooseSizes(self, nVirtualMachines, maxPerSize = None):
+        """The size of each of nVirtualMachines VMs, taking as many of the most cost effective size as maxPerSize allows
+        (typically because of quota), then the next best, and so on
+
+        """
+
+        if maxPerSize is None:
+            maxPerSize = {}
+
+        sizes = []
+
+        for size in sorted(self._measurements, key = lambda size: -self._measurements[size]['binariesPerDollar']):
+
+            nOfSize = min(nVirtualMachines - len(sizes), maxPerSize.get(size, nVirtualMachines))
+            sizes += [size] * nOfSize
+
+        assert len(sizes) == nVirtualMachines, "maxPerSize doesn't allow for " + str(nVirtualMachines) + " VMs"
+
+        return sizes
+
+    def verbosePrint(self,message):
+        """Only print the message if we have the verbose flag on
+
+        """
+
+        if self._verbose:
+            print message
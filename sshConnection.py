@@ -0,0 +1,167 @@
+import shellCommands
+
+class SshConnection(object):
+    """A persistent SSH session to a VM, reached through a proxy host. OpenSSH's ControlMaster is used to keep
+    one authenticated session open, which every ssh and scp call to the VM is multiplexed over, so each
+    operation only costs a round trip rather than two TCP+SSH handshakes.
+
+    """
+
+    @property
+    def user(self):
+        """The user to log in as
+
+        """
+
+        return self._user
+
+    @property
+    def host(self):
+        """The address of the VM at the far end of the connection
+
+        """
+
+        return self._host
+
+    @property
+    def proxyHost(self):
+        """The publicly reachable address through which the host is reached, or None to connect directly
+
+        """
+
+        return self._proxyHost
+
+    @property
+    def controlPath(self):
+        """The path of the control socket of the master connection. %C is expanded by ssh to a hash of
+        the connection details, so every host gets its own socket
+
+        """
+
+        return self._controlPath
+
+    @property
+    def persistTime(self):
+        """How many seconds the master connection stays open once the last session using it has finished
+
+        """
+
+        return self._persistTime
+
+    def __init__(self, user, host, proxyHost = None, controlPath = '~/.ssh/azureJobManager-%C', persistTime = 600, verbose = False, timeout = 60):
+
+        self._user = user
+        self._host = host
+        self._proxyHost = proxyHost
+        self._controlPath = controlPath
+        self._persistTime = persistTime
+        self._verbose = verbose
+        self._timeout = timeout
+
+    @property
+    def timeout(self):
+        """How many seconds opening, checking or closing the master connection may take
+
+        """
+
+        return self._timeout
+
+    def multiplexOptions(self):
+        """The options which make an ssh or scp call share the master connection
+
+        """
+
+        return '-o ControlMaster=auto -o ControlPath=' + self._controlPath + ' -o ControlPersist=' + str(self._persistTime) + ' '
+
+    def options(self):
+        """All of the options needed by an ssh or scp call to reach the host
+
+        """
+
+        options = '-o StrictHostKeyChecking=no -o ServerAliveInterval=15 -o ServerAliveCountMax=3 ' + self.multiplexOptions()
+
+        if self._proxyHost is not None:
+            #the hop through the proxy is multiplexed too, so all of the VMs share one connection to it. ssh expands
+            #the tokens in a ProxyCommand itself, and doesn't know %C there, so those meant for the inner ssh are escaped
+            options += '-o ProxyCommand="ssh -W %h:%p -o StrictHostKeyChecking=no ' + self.multiplexOptions().replace('%', '%%') + \
+                        self._user + '@' + self._proxyHost + '" '
+
+        return options
+
+    def target(self):
+
+        return self._user + '@' + self._host
+
+    def sshCommand(self, command):
+        """The full shell command which runs command on the host
+
+        """
+
+        return 'ssh ' + self.options() + self.target() + ' \'' + command + '\''
+
+    def uploadCommand(self, filePath, remoteDestination):
+
+        return 'scp ' + self.options() + filePath + ' ' + self.target() + ':' + remoteDestination
+
+    def downloadCommand(self, remotePath, localDestination):
+
+        return 'scp ' + self.options() + self.target() + ':' + remotePath + ' ' + localDestination
+
+    def isAlive(self):
+        """Asks the local master process whether it's still running. This doesn't touch the network
+
+        """
+
+        command = 'ssh -O check -o ControlPath=' + self._controlPath + ' ' + self.target() + ' 2>/dev/null'
+
+        try:
+            return shellCommands.call(command, self._timeout) == 0
+        except shellCommands.CommandTimeout:
+            return False
+
+    def connect(self):
+        """Starts the master connection in the background
+
+        """
+
+        command = 'ssh -M -N -f ' + self.options() + self.target()
+
+        self.verbosePrint('opening master connection with command:\n' + command)
+
+        try:
+            return shellCommands.call(command, self._timeout) == 0
+        except shellCommands.CommandTimeout:
+            return False
+
+    def ensureConnected(self):
+        """Health check, reconnecting if the master connection has gone away
+
+        """
+
+        if not self.isAlive():
+            self.connect()
+
+    def reconnect(self):
+
+        self.close()
+        self.connect()
+
+    def close(self):
+        """Tells the master connection to exit
+
+        """
+
+        command = 'ssh -O exit -o ControlPath=' + self._controlPath + ' ' + self.target() + ' 2>/dev/null'
+
+        try:
+            shellCommands.call(command, self._timeout)
+        except shellCommands.CommandTimeout:
+            pass
+
+    def verbosePrint(self,message):
+        """Only print the message if we have the verbose flag on
+
+        """
+
+        if self._verbose:
+            print message
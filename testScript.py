@@ -2,27 +2,37 @@ import sys
 sys.path.remove ('/net/lnx0/export/local/debian/lib/python2.7/dist-packages')
 sys.path.remove ('/usr/local/lib/python2.7/dist-packages')
 
-from CompasAzure import prepareCommands
+from CompasAzure import prepareBundles, runBundlesInParallel
 from azureJobManager import AzureJobManager
 from compasJob import CompasJob
 import os
 
-commands = prepareCommands()
+bundles = prepareBundles()
 
 jobs = []
-for i,command in enumerate(commands):
+for i,(commands,gridPoints) in enumerate(bundles):
 
     dirname = '/data0/jbarrett/output'+str(i)
     
-    os.makedirs(dirname)
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
 
     j = CompasJob()
-    j.initialise(i,command,dirname,'/home/jbarrett/AzureJobManager/COMPAS')
+    
+    #a bundle of one command is run as an ordinary job, which can still be split
+    if len(commands) == 1:
+        j.initialise(i,commands[0],dirname,'/home/jbarrett/AzureJobManager/COMPAS')
+    else:
+        j.initialise(i,commands,dirname,'/home/jbarrett/AzureJobManager/COMPAS',gridPoints=gridPoints,runInParallel=runBundlesInParallel)
     jobs.append(j)
 
-ajm = AzureJobManager('anotherGrid2',200,jobs,verbose=True,sleepTime=300,htmlPath = '/home/jbarrett/www_html')
+journalPath = '/data0/jbarrett/anotherGrid2.journal'
+resuming = os.path.exists(journalPath)
+
+ajm = AzureJobManager('anotherGrid2',200,jobs,verbose=True,sleepTime=300,htmlPath = '/home/jbarrett/www_html',journalPath = journalPath)
 
-try:
+#if this crashes, running it again picks up where it left off, and once it has finished, running it again starts afresh
+if resuming:
+    ajm.resume()
+else:
     ajm.run()
-except:
-    print 'aaahhhhhhhhh'
@@ -1,4 +1,46 @@
 import subprocess as sp
+import hashlib
+import os
+import threading
+import time
+import shellCommands
+from sshConnection import SshConnection
+from computeBackend import AzureBackend
+
+#files put in the cache by ensureCached() are kept here on the VMs, named after the hash of their contents. It's hidden,
+#so clean() leaves it alone
+remoteCacheDirectory = '.azureJobManager/cache'
+
+#files baked into a worker image are kept here, under the same names. It's outside the home directory, since that
+#is removed when the image is generalised
+bakedCacheDirectory = '/opt/azureJobManager/cache'
+
+def findCachedFile(hashValue):
+    """A shell snippet setting $src to where the file with the hash is cached on the VM, preferring the cache in 
+    the home directory and falling back to the files baked into the image
+    
+    """
+    
+    return 'src=' + remoteCacheDirectory + '/' + hashValue + '; if [ ! -f $src ]; then src=' + bakedCacheDirectory + '/' + hashValue + '; fi; '
+
+_fileHashes = {}
+
+def fileHash(filePath):
+    """The SHA-1 hash of the contents of a local file, remembered until the file changes
+    
+    """
+    
+    status = os.stat(filePath)
+    key = (os.path.abspath(filePath), status.st_mtime, status.st_size)
+    
+    if not key in _fileHashes:
+        sha1 = hashlib.sha1()
+        with open(filePath, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                sha1.update(chunk)
+        _fileHashes[key] = sha1.hexdigest()
+        
+    return _fileHashes[key]
 
 class VirtualMachineException(Exception):
     
@@ -73,8 +115,119 @@ class VirtualMachine(object):
         """
         
         return self._headNode
+        
+    @property
+    def backend(self):
+        """The ComputeBackend which makes the VM and reaches it
+        
+        """
+        
+        return self._backend
+        
+    @property
+    def connection(self):
+        """The persistent SSH connection to this VM, which is opened the first time it's needed. Only VMs on Azure
+        use one
+        
+        """
+        
+        if self._connection is None:
+            self._connection = SshConnection(self._vmOptions['--admin-username'], self._privateIpAddress, \
+                                            proxyHost = self._publicIpAddress, verbose = self._verbose)
+        
+        return self._connection
+        
+    @property
+    def agentTransport(self):
+        """Where agents running jobs on this VM should push their events, None if they shouldn't be used
+        
+        """
+        
+        return self._agentTransport
+        
+    @property
+    def nSlots(self):
+        """The number of jobs the VM runs at the same time
+        
+        """
+        
+        return self._nSlots
+        
+    @property
+    def cacheHits(self):
+        """The number of cached uploads which were skipped because the VM already had the file
+        
+        """
+        
+        return self._cacheHits
+        
+    @property
+    def cacheMisses(self):
+        """The number of cached uploads which had to be transferred
+        
+        """
+        
+        return self._cacheMisses
+        
+    @property
+    def isSpot(self):
+        """Whether this is a spot VM, which Azure may evict at any time
+        
+        """
+        
+        return self._vmOptions.get('--priority') == 'Spot'
+        
+    @property
+    def commandTimeout(self):
+        """How many seconds a command run on the VM may take before it's killed
+        
+        """
+        
+        return self._commandTimeout
+        
+    @property
+    def transferTimeout(self):
+        """How many seconds a file transfer to or from the VM may take before it's killed
+        
+        """
+        
+        return self._transferTimeout
+        
+    @property
+    def provisionTimeout(self):
+        """How many seconds creating, starting or deleting the VM may take before the az command is killed
+        
+        """
+        
+        return self._provisionTimeout
+        
+    @property
+    def metrics(self):
+        """The RunMetrics the VM's operations are timed into, None if they aren't
+        
+        """
+        
+        return self._metrics
+        
+    @property
+    def runningCommands(self):
+        """The commands running against the VM, which cancelOperations() kills
+        
+        """
+        
+        return self._runningCommands
+        
+    @property
+    def isLaunched(self):
+        """Whether the VM has been launched, or attached to
+        
+        """
+        
+        return self._privateIpAddress is not None
 
-    def __init__(self, name, resourceGroup, vmOptions, sshKeyPath = '~/.ssh/id_rsa.pub', verbose = False, publicIp = None):
+    def __init__(self, name, resourceGroup, vmOptions, sshKeyPath = '~/.ssh/id_rsa.pub', verbose = False, publicIp = None, headNode = None, \
+                 commandTimeout = 600, transferTimeout = 3600, provisionTimeout = 1800, backend = None, \
+                 metrics = None):
     
         self._name = name
         self._resourceGroup = resourceGroup
@@ -85,89 +238,364 @@ class VirtualMachine(object):
         self._vmOptions = vmOptions
        
         self._publicIpAddress = publicIp
-        
-    def launch(self,headNodeIp = None):
-        """Launches the VM and parses the returned info
+        self._privateIpAddress = None
+        self._headNode = headNode
+        
+        self._connection = None
+        self._agentTransport = None
+        self._nSlots = 1
+        self._cacheHits = 0
+        self._cacheMisses = 0
+        self._cacheLock = threading.Lock()
+        self._fillLock = threading.Lock()
+        self._cachedHashes = set()
+        self._commandTimeout = commandTimeout
+        self._transferTimeout = transferTimeout
+        self._provisionTimeout = provisionTimeout
+        self._runningCommands = shellCommands.RunningCommands()
+        self._backend = backend if backend is not None else AzureBackend()
+        self._metrics = metrics
+        
+    def launch(self,headNodeIp = None, customData = None):
+        """Launches the VM and finds its IP addresses. customData is passed to the VM, where cloud-init runs it 
+        once it has booted
         
         """
         
+        start = time.time()
+        
         try:
-            command = 'az vm create '
-            for key in self.vmOptions.keys():
-                command += key + ' ' + self._vmOptions[key] + ' '
-                
-            vmDetails = sp.check_output(command,shell=True)
-            vmDetails = vmDetails.split('\n')
-            
+            self._privateIpAddress, self._publicIpAddress = self._backend.provision(self, headNodeIp, customData)
         except sp.CalledProcessError:
-            
             raise VirtualMachineException('There was an error generating the virtual machine with name ' + self.name)
-
+        finally:
+            self.observe('provision', start)
+                
+        self.verbosePrint('found private IP address: ' + self._privateIpAddress)
+        self.verbosePrint('found public IP address: ' + self._publicIpAddress)
         
-        for line in vmDetails:
-            if 'privateIpAddress' in line:
-                s = line.split('"')
-                self._privateIpAddress = s[3]
+    def start(self, headNodeIp = None):
+        """Starts the VM when it already exists but is deallocated, as it is in a warm pool, rather than creating it,
+        then finds its IP addresses
         
-        if headNodeIp == None:
-            for line in vmDetails:
-                if 'publicIpAddress' in line:
-                    s = line.split('"')
-                    self._publicIpAddress = s[3]
-        else:
-            self._publicIpAddress = headNodeIp
-                
+        """
+        
+        start = time.time()
+        
+        try:
+            self._privateIpAddress, self._publicIpAddress = self._backend.start(self, headNodeIp)
+        except sp.CalledProcessError:
+            raise VirtualMachineException('There was an error starting the virtual machine with name ' + self.name)
+        finally:
+            self.observe('start', start)
+            
         self.verbosePrint('found private IP address: ' + self._privateIpAddress)
         self.verbosePrint('found public IP address: ' + self._publicIpAddress)
         
+    def deallocate(self):
+        """Stops the VM and releases its hardware, so it's no longer paid for, but keeps its disk so it can be started again
+        
+        """
+        
+        if self._connection is not None:
+            self._connection.close()
+            
+        start = time.time()
+            
+        self._backend.deallocate(self)
+        
+        self.observe('teardown', start)
+        
+    def attach(self, privateIp, publicIp, nSlots = 1):
+        """Takes over a VM which is already running, rather than launching it
+        
+        """
+        
+        self._privateIpAddress = privateIp
+        self._publicIpAddress = publicIp
+        self._nSlots = nSlots
+        
     def uploadFile(self,filePath, remoteDestination='.'):
     
-        command = 'scp -o StrictHostKeyChecking=no -o ProxyCommand="ssh -W %h:%p -o StrictHostKeyChecking=no ' + \
-                    self._vmOptions['--admin-username'] + '@' + self._publicIpAddress + '" ' + filePath + ' ' + \
-                    self._vmOptions['--admin-username'] + '@' + self._privateIpAddress + ':' + remoteDestination
+        self._backend.ensureConnected(self)
+        
+        command = self._backend.putCommand(self, filePath, remoteDestination)
                  
         self.verbosePrint("uploading file with command:\n" + command)
         
-        sp.call(command,shell=True)
+        if self.transfer(command) != 0 and not self._backend.isAlive(self):
+            self._backend.reconnect(self)
+            self.transfer(command)
+        
+    def fillCache(self, filePath):
+        """Puts a file into the VM's cache. If there's a head node, the file is copied over the VNet from the head 
+        node's cache, so it only has to be uploaded from here once for the whole cluster
+        
+        """
+        
+        if self._headNode is not None and not self._headNode is self:
+            self._headNode.ensureCached(filePath)
+            if len(self._headNode.pushCachedFile(filePath, [self])) == 0:
+                return
+            self.verbosePrint('copying ' + filePath + ' from the head node failed, uploading it directly')
+        
+        #the upload goes to a temporary name first, so an interrupted or concurrent transfer never looks like a cached file
+        cachedPath = remoteCacheDirectory + '/' + fileHash(filePath)
+        partialPath = cachedPath + '.partial' + os.urandom(4).encode('hex')
+        self.sendCommand('mkdir -p ' + remoteCacheDirectory)
+        self.uploadFile(filePath, partialPath)
+        self.sendCommand('chmod ' + oct(os.stat(filePath).st_mode & 0777) + ' ' + partialPath + ' && mv ' + partialPath + ' ' + cachedPath)
+        
+    def ensureCached(self, filePath):
+        """Makes sure a file is in the VM's cache, without copying it anywhere else
+        
+        """
+        
+        with self._fillLock:
+        
+            hashValue = fileHash(filePath)
+            
+            if hashValue in self._cachedHashes:
+                with self._cacheLock:
+                    self._cacheHits += 1
+                return
+                
+            output = self.sendCommand(findCachedFile(hashValue) + 'if [ -f $src ]; then echo hit; else echo miss; fi')
+            
+            with self._cacheLock:
+                if output.strip() == 'hit':
+                    self._cacheHits += 1
+                else:
+                    self._cacheMisses += 1
+            
+            if output.strip() != 'hit':
+                self.fillCache(filePath)
+                
+            self._cachedHashes.add(hashValue)
+            
+    def pushCachedFile(self, filePath, targets, parallelism = 20):
+        """Copies a file from this VM's cache into the caches of the target VMs over the VNet, at most parallelism
+        at a time, in a single round trip from here. The file must already be in this VM's cache. Returns the targets
+        which the copy failed for
+        
+        """
+        
+        cachedPath = remoteCacheDirectory + '/' + fileHash(filePath)
+        
+        #the head node may only have the file baked into its image, rather than in its cache
+        script = findCachedFile(fileHash(filePath)) + '\n'
+        
+        for i, target in enumerate(targets):
+        
+            backend = target.backend
+            partialPath = cachedPath + '.partial' + os.urandom(4).encode('hex')
+            
+            script += '( ' + backend.peerExecCommand(target, 'mkdir -p ' + remoteCacheDirectory) + ' && ' + \
+                      backend.peerPutCommand(target, '$src', partialPath) + ' && ' + \
+                      backend.peerExecCommand(target, 'mv ' + partialPath + ' ' + cachedPath) + ' || echo ' + str(i) + ' ) &\n'
+                      
+            if (i + 1) % parallelism == 0:
+                script += 'wait\n'
+                
+        script += 'wait\n'
+        
+        self.verbosePrint('copying ' + filePath + ' from ' + self._name + ' to ' + str(len(targets)) + ' VMs')
+        
+        output = self.sendScript(script)
+        
+        failed = [targets[int(line)] for line in output.split()]
+        
+        for target in targets:
+            if not target in failed:
+                target._cachedHashes.add(fileHash(filePath))
+        
+        return failed
+        
+    def transfer(self, command):
+        """Runs an scp command, returning its exit code. One which times out counts as having failed
+        
+        """
+        
+        start = time.time()
+        
+        try:
+            return shellCommands.call(command, self._transferTimeout, runningCommands = self._runningCommands)
+        except shellCommands.CommandTimeout:
+            self.verbosePrint('the transfer timed out')
+            return 1
+        finally:
+            self.observe('scp', start)
+            
+    def cancelOperations(self):
+        """Kills every command which is running against the VM, from any thread. Each of them fails as if it had 
+        timed out
+        
+        """
+        
+        self._runningCommands.cancel()
         
     def getFile(self,remotePath, localDestination = '.'):
     
-        command = 'scp -o StrictHostKeyChecking=no -o ProxyCommand="ssh -W %h:%p -o StrictHostKeyChecking=no ' + \
-                    self._vmOptions['--admin-username'] + '@' + self._publicIpAddress + '" ' + \
-                    self._vmOptions['--admin-username'] + '@' + self._privateIpAddress + ':' + remotePath + ' ' + \
-                    localDestination
+        self._backend.ensureConnected(self)
+    
+        command = self._backend.getCommand(self, remotePath, localDestination)
                    
         self.verbosePrint("downloading file with command:\n" + command)
         
-        sp.call(command, shell=True)
+        if self.transfer(command) != 0 and not self._backend.isAlive(self):
+            self._backend.reconnect(self)
+            self.transfer(command)
+        
+    def getFileResumable(self, remotePath, localPath, size, maxAttempts = 5):
+        """Downloads a file of known size by streaming it over ssh. If the transfer drops, the next attempt carries
+        on from the end of what has already arrived rather than starting again. Returns the number of bytes received
+        
+        """
+        
+        for attempt in range(maxAttempts):
+        
+            offset = os.path.getsize(localPath) if os.path.exists(localPath) else 0
+            
+            if offset >= size:
+                break
+                
+            self._backend.ensureConnected(self)
+            
+            command = self._backend.execCommand(self, 'tail -c +' + str(offset + 1) + ' ' + remotePath)
+            
+            self.verbosePrint('downloading ' + remotePath + ' from byte ' + str(offset) + ' with command:\n' + command)
+            
+            start = time.time()
+            
+            try:
+                with open(localPath, 'ab') as f:
+                    returnCode = shellCommands.call(command, self._transferTimeout, stdout = f, runningCommands = self._runningCommands)
+            except shellCommands.CommandTimeout:
+                #carry on from wherever it got to
+                returnCode = 255
+            finally:
+                self.observe('scp', start)
+                
+            if returnCode == 255:
+                self._backend.reconnect(self)
+                
+        received = os.path.getsize(localPath) if os.path.exists(localPath) else 0
+        
+        if received != size:
+            raise VirtualMachineException('Only received ' + str(received) + ' of ' + str(size) + ' bytes of ' + remotePath + \
+                                          ' from the virtual machine with name ' + self.name)
+                                          
+        return received
         
     def sendCommand(self,command,waitToComplete=True):
     
+        self._backend.ensureConnected(self)
         
-        fullCommand = 'ssh ' + self._vmOptions['--admin-username'] + '@' + self._privateIpAddress + ' -o StrictHostKeyChecking=no -o ProxyCommand="ssh -W %h:%p -o StrictHostKeyChecking=no '\
-                    + self._vmOptions['--admin-username'] + '@' + self._publicIpAddress + '" '\
-                    + '\'' + command + '\''
-                    
+        fullCommand = self._backend.execCommand(self, command)
                     
         self.verbosePrint('sending a command with the command:\n' + fullCommand)
 
         output = 'n/a'
         if not waitToComplete:
-            sp.Popen([fullCommand],shell=True,stdin=None,stdout=None,stderr=None,close_fds=True)
+            shellCommands.callInBackground(fullCommand, self._commandTimeout, runningCommands = self._runningCommands)
         
         else:
-            output = sp.check_output(fullCommand,shell=True)
+            start = time.time()
+            
+            try:
+                output = shellCommands.checkOutput(fullCommand, self._commandTimeout, runningCommands = self._runningCommands)
+            except sp.CalledProcessError as e:
+                #ssh exits with 255 when the connection itself failed, rather than the command
+                if e.returncode != 255:
+                    raise
+                self._backend.reconnect(self)
+                output = shellCommands.checkOutput(fullCommand, self._commandTimeout, runningCommands = self._runningCommands)
+            finally:
+                self.observe('ssh', start)
 
         self.verbosePrint('recieved the output:\n' + output)
         
         return output
         
-    def clean(self):
+    def sendScript(self, script):
+        """Runs a bash script on the VM by streaming it over stdin, so it costs a single round trip however 
+        many commands it contains. Returns whatever the script prints.
+        
+        """
+        
+        self._backend.ensureConnected(self)
+        
+        fullCommand = self._backend.execCommand(self, 'bash -s')
+        
+        self.verbosePrint('sending a script with the command:\n' + fullCommand + '\nand the script:\n' + script)
+        
+        start = time.time()
+        
+        try:
+            returnCode, output = shellCommands.run(fullCommand, self._commandTimeout, input = script, runningCommands = self._runningCommands)
+        except shellCommands.CommandTimeout:
+            raise VirtualMachineException('A script run on the virtual machine with name ' + self.name + ' timed out')
+        finally:
+            self.observe('ssh', start)
+        
+        if returnCode != 0:
+            raise VirtualMachineException('There was an error running a script on the virtual machine with name ' + self.name)
+            
+        self.verbosePrint('recieved the output:\n' + output)
+            
+        return output
+        
+    def detectResources(self):
+        """Returns the number of cores and the memory, in MB, of the VM
+        
+        """
+        
+        output = self.sendCommand('nproc && awk \'/MemTotal/ {print $2}\' /proc/meminfo')
+        
+        nCores, memoryKb = output.split()
+        
+        return int(nCores), int(memoryKb) / 1024
+        
+    def setSlots(self, slotsPerVm = 1, memoryPerSlot = None):
+        """Decides how many jobs the VM runs at once. slotsPerVm is either a number, or 'auto' for one per core.
+        If memoryPerSlot (in MB) is given, the VM is limited to as many slots as fit into its memory
+        
+        """
+        
+        if slotsPerVm == 'auto' or memoryPerSlot is not None:
+            nCores, memory = self.detectResources()
+            
+            if slotsPerVm == 'auto':
+                slotsPerVm = nCores
+                
+            if memoryPerSlot is not None:
+                slotsPerVm = min(slotsPerVm, memory / memoryPerSlot)
+                
+        self._nSlots = max(1, int(slotsPerVm))
+        
+        self.verbosePrint(self._name + ' will run ' + str(self._nSlots) + ' jobs at once')
+        
+    def clean(self, slot = None):
+        """Removes everything a job left behind in the given slot, or everything in the home directory if 
+        no slot is given. Hidden files are left alone
+        
+        """
     
-        command = 'rm -r ~/*'
+        if slot is None:
+            command = 'rm -r ~/*'
+        else:
+            command = 'rm -rf ~/slot' + str(slot)
         
         self.sendCommand(command)
             
+    def observe(self, phase, start):
+        """Records how long a phase which began at start took, if the VM's operations are being timed
+        
+        """
+        
+        if self._metrics is not None:
+            self._metrics.observe(phase, time.time() - start, vm = self._name)
+            
     def verbosePrint(self,message):
         """Only print the message if we have the verbose flag on
         
@@ -178,9 +606,14 @@ class VirtualMachine(object):
             
     def delete(self):
     
-        command = 'az vm delete --force --name ' + self._name + ' --resource-group ' + self._resourceGroup
+        if self._connection is not None:
+            self._connection.close()
+            
+        start = time.time()
+    
+        self._backend.delete(self)
         
-        sp.call(command,shell=True)
+        self.observe('teardown', start)
         
         
         
@@ -0,0 +1,184 @@
+import subprocess as sp
+import os
+import hashlib
+import shellCommands
+from computeBackend import AzureBackend
+from virtualMachine import VirtualMachine, VirtualMachineException, fileHash, bakedCacheDirectory
+from jobEvents import agentPath
+
+class WorkerImage(object):
+    """A generalised VM image with COMPAS, the job agent and the Python packages the jobs need already on it, so
+    that VMs made from it can start work without anything being uploaded. The image is named after the hashes of
+    the files baked into it and the Python packages installed on it, so it's only rebuilt when one of those changes.
+    Images are kept in their own resource group, which outlives the resource groups of the runs using them
+
+    """
+
+    @property
+    def name(self):
+        """The name of the image, which includes a hash of everything baked into it, so that VMs made from a stale
+        image are never taken to have files cached which they don't
+
+        """
+
+        contents = [fileHash(filePath) for filePath in self.files] + list(self._pythonPackages)
+
+        return 'compasWorker-' + hashlib.sha1('\n'.join(contents)).hexdigest()[:16]
+
+    @property
+    def resourceGroup(self):
+        """The resource group the images are kept in
+
+        """
+
+        return self._resourceGroup
+
+    @property
+    def files(self):
+        """The local files which are baked into the image
+
+        """
+
+        return [self._compasPath, agentPath] + self._extraFiles
+
+    @property
+    def bakedHashes(self):
+        """The hashes of the files baked into the image, which VMs made from it already have cached
+
+        """
+
+        return set(fileHash(filePath) for filePath in self.files)
+
+    @property
+    def pythonPackages(self):
+        """The Python packages installed on the image
+
+        """
+
+        return self._pythonPackages
+
+    def __init__(self, resourceGroup, compasPath, publicSshKeyPath = '~/.ssh/id_rsa.pub', extraFiles = None, pythonPackages = None, \
+                 location = 'centralus', baseImage = 'UbuntuLTS', size = 'Standard_D2s_v3', verbose = False, commandTimeout = 600, \
+                 provisionTimeout = 1800):
+
+        self._resourceGroup = resourceGroup
+        self._compasPath = compasPath
+        self._publicSshKeyPath = publicSshKeyPath
+        self._extraFiles = list(extraFiles) if extraFiles is not None else []
+        self._pythonPackages = list(pythonPackages) if pythonPackages is not None else ['numpy']
+        self._location = location
+        self._baseImage = baseImage
+        self._size = size
+        self._verbose = verbose
+        self._commandTimeout = commandTimeout
+        self._provisionTimeout = provisionTimeout
+        self._backend = AzureBackend(location, commandTimeout = commandTimeout, provisionTimeout = provisionTimeout)
+
+    def imageId(self):
+        """The full Azure ID of the image, which is what --image needs for an image in another resource group,
+        None if the image hasn't been built
+
+        """
+
+        command = 'az image show --resource-group ' + self._resourceGroup + ' --name ' + self.name + ' --query id -o tsv 2>/dev/null'
+
+        try:
+            imageId = shellCommands.checkOutput(command, self._commandTimeout).strip()
+        except sp.CalledProcessError:
+            return None
+
+        return imageId if len(imageId) > 0 else None
+
+    def ensureBuilt(self):
+        """Builds the image if there isn't one for the current files and packages, returning its ID
+
+        """
+
+        imageId = self.imageId()
+
+        if imageId is None:
+            self.build()
+            imageId = self.imageId()
+
+        if imageId is None:
+            raise VirtualMachineException('The image ' + self.name + ' could not be found after building it')
+
+        self.verbosePrint('using the worker image ' + imageId)
+
+        return imageId
+
+    def build(self):
+        """Sets up a VM with everything the jobs need, generalises it and captures it as the image. The VM is made
+        in a resource group of its own, which is deleted afterwards
+
+        """
+
+        buildGroup = self._resourceGroup + 'Build'
+
+        self._backend.makeGroup(self._resourceGroup)
+        self._backend.makeGroup(buildGroup)
+
+        vmName = self.name.replace('-', '') + 'Builder'
+
+        vmOptions = {
+            '--image' : self._baseImage,
+            '--admin-username' : 'ops',
+            '--ssh-key-value' : self._publicSshKeyPath,
+            '--resource-group' : buildGroup,
+            '--location' : self._location,
+            '--name' : vmName,
+            '--size' : self._size,
+            '--storage-sku' : 'Standard_LRS'
+        }
+
+        vm = VirtualMachine(vmName, buildGroup, vmOptions, sshKeyPath = self._publicSshKeyPath, verbose = self._verbose, \
+                            commandTimeout = self._commandTimeout, provisionTimeout = self._provisionTimeout, backend = self._backend)
+
+        print "building the worker image " + self.name
+
+        try:
+            vm.launch()
+
+            vm.sendCommand('sudo mkdir -p ' + bakedCacheDirectory + ' && sudo chown ops ' + bakedCacheDirectory)
+
+            for filePath in self.files:
+                bakedPath = bakedCacheDirectory + '/' + fileHash(filePath)
+                vm.uploadFile(filePath, bakedPath)
+                vm.sendCommand('chmod ' + oct(os.stat(filePath).st_mode & 0777) + ' ' + bakedPath)
+
+            vm.sendCommand('sudo chown -R root:root ' + bakedCacheDirectory + ' && sudo chmod -R a+rX ' + bakedCacheDirectory)
+
+            install = 'sudo apt-get update -q && sudo DEBIAN_FRONTEND=noninteractive apt-get install -q -y python python-pip zstd'
+            if len(self._pythonPackages) > 0:
+                install += ' && sudo pip install ' + ' '.join(self._pythonPackages)
+            vm.sendCommand(install)
+
+            #removes the ops user and its home directory, which is why the files are kept elsewhere
+            vm.sendCommand('sudo waagent -deprovision+user -force')
+            vm.connection.close()
+
+            for command in ['az vm deallocate --resource-group ' + buildGroup + ' --name ' + vmName,
+                            'az vm generalize --resource-group ' + buildGroup + ' --name ' + vmName]:
+                shellCommands.checkOutput(command, self._provisionTimeout)
+
+            vmId = shellCommands.checkOutput('az vm show --resource-group ' + buildGroup + ' --name ' + vmName + ' --query id -o tsv', \
+                                             self._commandTimeout).strip()
+
+            shellCommands.checkOutput('az image create --resource-group ' + self._resourceGroup + ' --name ' + self.name + \
+                                      ' --location ' + self._location + ' --source ' + vmId, self._provisionTimeout)
+
+        except sp.CalledProcessError:
+
+            raise VirtualMachineException('There was an error building the worker image ' + self.name)
+
+        finally:
+
+            self._backend.deleteGroup(buildGroup, wait = False)
+
+    def verbosePrint(self,message):
+        """Only print the message if we have the verbose flag on
+
+        """
+
+        if self._verbose:
+            print message
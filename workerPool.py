@@ -0,0 +1,89 @@
+import threading
+import Queue
+
+class WorkerPool(object):
+    """A fixed number of threads which run submitted tasks in the background, putting the outcome of
+    each task onto a results queue as soon as it's finished
+
+    """
+
+    @property
+    def nWorkers(self):
+        """The number of tasks which may run at the same time
+
+        """
+
+        return self._nWorkers
+
+    @property
+    def results(self):
+        """The queue onto which (tag, returnValue, exception) tuples are put as tasks finish
+
+        """
+
+        return self._results
+
+    @property
+    def nPending(self):
+        """The number of submitted tasks whose results haven't been put on the results queue yet
+
+        """
+
+        return self._nPending
+
+    def __init__(self, nWorkers, results = None):
+
+        self._nWorkers = max(1, int(nWorkers))
+        self._tasks = Queue.Queue()
+        self._results = results if results is not None else Queue.Queue()
+        self._nPending = 0
+        self._lock = threading.Lock()
+
+        self._threads = []
+        for i in range(self._nWorkers):
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, tag, function, *args):
+        """Queue function(*args) to be run by one of the workers. The tag is passed back alongside the
+        result so the caller knows which task finished
+
+        """
+
+        with self._lock:
+            self._nPending += 1
+
+        self._tasks.put((tag, function, args))
+
+    def shutdown(self):
+        """Stop the workers once they've finished the tasks already submitted
+
+        """
+
+        for thread in self._threads:
+            self._tasks.put(None)
+
+    def _work(self):
+
+        while True:
+
+            task = self._tasks.get()
+
+            if task is None:
+                break
+
+            tag, function, args = task
+
+            returnValue = None
+            exception = None
+            try:
+                returnValue = function(*args)
+            except Exception as e:
+                exception = e
+
+            with self._lock:
+                self._nPending -= 1
+
+            self._results.put((tag, returnValue, exception))